@@ -0,0 +1,268 @@
+"""Drive bot.py end to end with simulated users against a local fake Bot API server.
+
+The bot runs in this process with its real handlers, storage and scheduler,
+polling a stand-in for api.telegram.org that serves generated updates and
+answers sendMessage, editMessageText, answerCallbackQuery and friends.
+Every simulated user repeatedly runs /add_item, /list_items, /remove_item
+and taps a remove button, each time waiting for the bot's reply before the
+next step, so the numbers show what the bot sustains, not what it queues:
+
+    python bench/e2e_load.py --users 10000 --cycles 3 --backend sqlite --concurrency 64
+
+Latency is measured from handing an update to the bot (getUpdates response)
+to the bot's reply to it. Storage ops per update counts backend calls, i.e.
+what the caches did not answer. Nothing leaves localhost; the data lives in
+a temporary directory unless --data-dir is given. Load generator and bot
+share one event loop, compare runs with each other rather than with
+production numbers.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+import types
+from collections import Counter, defaultdict
+from pathlib import Path
+from urllib.parse import parse_qsl
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from webhook_load import make_update  # noqa: E402
+
+TOKEN = "1:bench"
+# API methods whose call completes the user's step
+REPLY_METHODS = frozenset({"sendMessage", "editMessageText", "editMessageReplyMarkup"})
+
+
+class FakeBotApi:
+    """ASGI app answering the Bot API methods the bot uses, with updates fed by the load generator"""
+
+    def __init__(self):
+        self._updates: list[dict] = []
+        self._first_update_id = 1
+        self._new_updates = asyncio.Event()
+        self._message_ids = itertools.count(10**6)
+        # chat id -> [future, replies still expected], the future gets the last reply
+        self.waiters: dict[int, list] = {}
+        self.delivered_at: dict[int, float] = {}
+        self.calls = Counter()
+
+    def expect(self, chat_id: int, replies: int) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self.waiters[chat_id] = [future, replies]
+        return future
+
+    def push(self, update: dict) -> None:
+        self._updates.append(update)
+        self._new_updates.set()
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] == "lifespan":
+            while (await receive())["type"] != "lifespan.shutdown":
+                await send({"type": "lifespan.startup.complete"})
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+        body = b""
+        while True:
+            message = await receive()
+            body += message.get("body", b"")
+            if not message.get("more_body"):
+                break
+        method = scope["path"].rsplit("/", 1)[-1]
+        params = {}
+        for key, value in parse_qsl(body.decode()):
+            try:
+                params[key] = json.loads(value)
+            except ValueError:
+                params[key] = value
+        self.calls[method] += 1
+        result = await self.handle(method, params)
+        payload = json.dumps({"ok": True, "result": result}).encode()
+        await send(
+            {
+                "type": "http.response.start",
+                "status": 200,
+                "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(payload)).encode())],
+            }
+        )
+        await send({"type": "http.response.body", "body": payload})
+
+    async def handle(self, method: str, params: dict):
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        if method == "getUpdates":
+            return await self._get_updates(params)
+        if method in REPLY_METHODS:
+            chat_id = int(params["chat_id"])
+            message = {
+                "message_id": int(params.get("message_id") or next(self._message_ids)),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "text": params.get("text", ""),
+            }
+            if "reply_markup" in params:
+                message["reply_markup"] = params["reply_markup"]
+            waiter = self.waiters.get(chat_id)
+            if waiter is not None:
+                waiter[1] -= 1
+                if waiter[1] <= 0:
+                    del self.waiters[chat_id]
+                    if not waiter[0].done():
+                        waiter[0].set_result(message)
+            return message
+        # answerCallbackQuery, setMyCommands, deleteWebhook, ...
+        return True
+
+    async def _get_updates(self, params: dict) -> list[dict]:
+        offset = int(params.get("offset") or 0)
+        if offset > self._first_update_id:
+            del self._updates[: offset - self._first_update_id]
+            self._first_update_id = offset
+        if not self._updates:
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), float(params.get("timeout") or 0))
+            except asyncio.TimeoutError:
+                return []
+        batch = self._updates[: int(params.get("limit") or 100)]
+        now = time.perf_counter()
+        for update in batch:
+            self.delivered_at.setdefault(update["update_id"], now)
+        return batch
+
+
+def callback_update(user_id: int, message: dict, data: str) -> dict:
+    update = make_update(user_id, "")
+    user = update["message"]["from"]
+    return {
+        "update_id": update["update_id"],
+        "callback_query": {
+            "id": str(update["update_id"]),
+            "from": user,
+            "chat_instance": str(user_id),
+            "message": message,
+            "data": data,
+        },
+    }
+
+
+async def run_user(api: FakeBotApi, user_id: int, cycles: int, timeout: float, results: dict) -> None:
+    async def step(kind: str, update: dict, replies: int = 1) -> dict | None:
+        waiter = api.expect(user_id, replies)
+        api.push(update)
+        try:
+            message = await asyncio.wait_for(waiter, timeout)
+        except asyncio.TimeoutError:
+            results["timeouts"][kind] += 1
+            api.waiters.pop(user_id, None)
+            return None
+        delivered = api.delivered_at.pop(update["update_id"], None)
+        if delivered is not None:
+            results["latencies"][kind].append(time.perf_counter() - delivered)
+        return message
+
+    # Selects the default list and sends the help
+    await step("start", make_update(user_id, "/start"), replies=2)
+    for cycle in range(cycles):
+        await step("add_item", make_update(user_id, "/add_item"))
+        await step("add_item_text", make_update(user_id, f"молоко {cycle}  хлеб {user_id % 97}"))
+        await step("list_items", make_update(user_id, "/list_items"))
+        keyboard = await step("remove_item", make_update(user_id, "/remove_item"))
+        buttons = [
+            button["callback_data"]
+            for row in ((keyboard or {}).get("reply_markup") or {}).get("inline_keyboard", [])
+            for button in row
+            if button.get("callback_data", "").startswith("remove_") and "_page_" not in button["callback_data"]
+        ]
+        if buttons:
+            await step("remove_tap", callback_update(user_id, keyboard, buttons[0]))
+
+
+def percentiles(values: list[float]) -> str:
+    if len(values) < 2:
+        return "n/a"
+    q = statistics.quantiles(values, n=100)
+    return f"p50={q[49] * 1000:.1f} p95={q[94] * 1000:.1f} p99={q[98] * 1000:.1f}"
+
+
+def load_bot(args):
+    """Import bot.py with settings taken from the command line instead of config.py"""
+    sys.modules["config"] = types.SimpleNamespace(
+        TOKEN=TOKEN,
+        STORAGE_BACKEND=args.backend,
+        CONCURRENT_UPDATES=args.concurrency,
+        MAX_PENDING_UPDATES=max(1024, args.users * 2),
+        STORAGE_WORKERS=args.storage_workers,
+        LIST_CACHE_MAX_BYTES=args.cache_mb * 1024 * 1024,
+        RATE_LIMIT_GLOBAL=args.rate_limit,
+    )
+    import bot
+
+    return bot
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--cycles", type=int, default=3, help="add/list/remove rounds per user")
+    parser.add_argument("--backend", choices=["files", "sqlite"], default="files")
+    parser.add_argument("--concurrency", type=int, default=32, help="CONCURRENT_UPDATES of the bot")
+    parser.add_argument("--storage-workers", type=int, default=8)
+    parser.add_argument("--cache-mb", type=int, default=16, help="list cache size, 0 disables it")
+    parser.add_argument("--rate-limit", type=float, default=0, help="outgoing messages per second, 0 disables")
+    parser.add_argument("--port", type=int, default=18081)
+    parser.add_argument("--timeout", type=float, default=60, help="seconds to wait for a reply")
+    parser.add_argument("--data-dir", help="where the lists are stored, a temporary directory by default")
+    args = parser.parse_args()
+
+    import uvicorn
+
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix="bot-bench-")
+    os.makedirs(data_dir, exist_ok=True)
+    os.chdir(data_dir)
+    bot = load_bot(args)
+
+    api = FakeBotApi()
+    server = uvicorn.Server(uvicorn.Config(api, host="127.0.0.1", port=args.port, log_level="error"))
+    serving = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.01)
+
+    application = bot.build_application(TOKEN, base_url=f"http://127.0.0.1:{args.port}/bot")
+    results = {"latencies": defaultdict(list), "timeouts": Counter()}
+    async with application:
+        await application.start()
+        await application.updater.start_polling(poll_interval=0, timeout=1)
+        calls_before = bot.storage.calls
+        started = time.perf_counter()
+        await asyncio.gather(
+            *(run_user(api, user_id, args.cycles, args.timeout, results) for user_id in range(1, args.users + 1))
+        )
+        elapsed = time.perf_counter() - started
+        storage_calls = bot.storage.calls - calls_before
+        await application.updater.stop()
+        await application.stop()
+    server.should_exit = True
+    await serving
+
+    updates = sum(len(values) for values in results["latencies"].values()) + sum(results["timeouts"].values())
+    all_latencies = [value for values in results["latencies"].values() for value in values]
+    print(f"setup:      {args.users} users, backend={args.backend}, concurrency={args.concurrency}, data={data_dir}")
+    print(f"updates:    {updates} in {elapsed:.2f}s ({updates / elapsed:.0f} updates/s)")
+    print(f"latency ms: {percentiles(all_latencies)}")
+    for kind, values in results["latencies"].items():
+        print(f"  {kind:<14}{percentiles(values)}")
+    print(f"timeouts:   {dict(results['timeouts'])}")
+    print(f"storage:    {storage_calls / max(updates, 1):.2f} backend calls per update, {bot.storage.stats()}")
+    print(f"api calls:  {dict(api.calls)}")
+    bot.storage.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
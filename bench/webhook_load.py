@@ -0,0 +1,128 @@
+"""POST synthetic Telegram updates to a webhook endpoint at high rate.
+
+Without --url an in-process WebhookApp is started on localhost, its update
+queue is drained by a consumer simulating handler time, so the numbers show
+the ingress overhead and how backpressure kicks in:
+
+    python bench/webhook_load.py --requests 20000 --concurrency 100 --handler-ms 1
+
+With --url the updates go to a running bot (use a test bot, the updates
+look like messages of made up users):
+
+    python bench/webhook_load.py --url http://localhost:8443/telegram --secret <token>
+"""
+import argparse
+import asyncio
+import itertools
+import statistics
+import sys
+import time
+from collections import Counter
+from pathlib import Path
+
+import httpx
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+_update_ids = itertools.count(1)
+
+
+def make_update(user_id: int, text: str) -> dict:
+    update_id = next(_update_ids)
+    user = {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": user,
+            "text": text,
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(text)}] if text.startswith("/") else [],
+        },
+    }
+
+
+async def start_local_server(port: int, secret: str, queue_size: int, handler_ms: float):
+    import uvicorn
+    from telegram.ext import ApplicationBuilder
+
+    from webhook import WebhookApp
+
+    application = ApplicationBuilder().token("1:bench").update_queue(asyncio.Queue(maxsize=queue_size)).build()
+    webhook_app = WebhookApp(application, secret, "/telegram")
+    server = uvicorn.Server(uvicorn.Config(webhook_app, host="127.0.0.1", port=port, log_level="error"))
+
+    async def consume():
+        while True:
+            await application.update_queue.get()
+            if handler_ms:
+                await asyncio.sleep(handler_ms / 1000)
+
+    consumer = asyncio.create_task(consume())
+    serving = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.01)
+    return f"http://127.0.0.1:{port}/telegram", webhook_app, server, [consumer, serving]
+
+
+async def run_load(url: str, secret: str, requests: int, concurrency: int, users: int) -> None:
+    latencies = []
+    statuses = Counter()
+    counter = itertools.count()
+    commands = ["/list_items", "/add_item", "молоко", "/show_lists"]
+
+    async def worker(client: httpx.AsyncClient):
+        while (n := next(counter)) < requests:
+            update = make_update(n % users + 1, commands[n % len(commands)])
+            started = time.perf_counter()
+            try:
+                response = await client.post(url, json=update, headers={"X-Telegram-Bot-Api-Secret-Token": secret})
+                statuses[response.status_code] += 1
+            except httpx.HTTPError as e:
+                statuses[type(e).__name__] += 1
+            latencies.append(time.perf_counter() - started)
+
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(limits=limits, timeout=30) as client:
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    quantiles = statistics.quantiles(latencies, n=100)
+    print(f"requests:   {requests} in {elapsed:.2f}s ({requests / elapsed:.0f} req/s)")
+    print(f"statuses:   {dict(statuses)}")
+    print(f"latency ms: p50={quantiles[49] * 1000:.2f} p95={quantiles[94] * 1000:.2f} p99={quantiles[98] * 1000:.2f}")
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="webhook URL of a running bot, starts a local server if omitted")
+    parser.add_argument("--secret", default="bench-secret")
+    parser.add_argument("--requests", type=int, default=10000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--port", type=int, default=18443)
+    parser.add_argument("--queue-size", type=int, default=1024)
+    parser.add_argument("--handler-ms", type=float, default=0.0, help="simulated processing time per update")
+    args = parser.parse_args()
+
+    if args.url:
+        await run_load(args.url, args.secret, args.requests, args.concurrency, args.users)
+        return
+
+    url, webhook_app, server, tasks = await start_local_server(
+        args.port, args.secret, args.queue_size, args.handler_ms
+    )
+    try:
+        await run_load(url, args.secret, args.requests, args.concurrency, args.users)
+        print(f"server:     {webhook_app.stats()}")
+    finally:
+        server.should_exit = True
+        await tasks[1]
+        tasks[0].cancel()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
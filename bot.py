@@ -1,8 +1,26 @@
+# Imported first, so the startup report tells the interpreter's start from the imports
+from startup import StartupTimer
+
+import asyncio
+import functools
+import html
 import logging
-import os
 import re
+import signal
+import tempfile
+import time
 from pathlib import Path
-from telegram import Update, BotCommand, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import (
+    Update,
+    BotCommand,
+    InlineKeyboardButton,
+    InlineKeyboardMarkup,
+    InlineQueryResultArticle,
+    InputTextMessageContent,
+)
+from telegram.constants import ParseMode
+from telegram.error import BadRequest
+from telegram.request import HTTPXRequest
 from telegram.ext import (
     Application,  # Added for type hinting in post_init
     ApplicationBuilder,
@@ -10,29 +28,129 @@ from telegram.ext import (
     ContextTypes,
     MessageHandler,
     CallbackQueryHandler,
+    InlineQueryHandler,
     filters,
     ConversationHandler,
 )
 
+from maintenance import Maintenance
+from manifest import ListInfo, Manifest
+from metrics import BotMetrics, InstrumentedRequest
+from persistence import UserStatePersistence
+from profiler import SamplingProfiler
+from ratelimit import GROUP_CHAT_RATE, Priority, PriorityRateLimiter, SendQueueFull
+from scheduler import UserOrderedApplication
+from cache import ListCache, VersionedCache
+from items import Item, build_item_index, item_id, parse_items
+from search import query_words
+from snapshot import new_generation, remove_stale_snapshots, save_generation, take_generation
+from storage import AsyncStorage, create_storage, order_list_names
+from suggest import HistoryTrie, UserHistories, normalize_prefix
+from transfer import export_lists, import_lists, write_backup
+from webhook import serve_webhook
+from workers import ShardRouter, WorkerPool, serve_worker
+
 try:
-    from config import TOKEN as TELEGRAM_BOT_TOKEN
+    import config
 except ImportError:
-    TELEGRAM_BOT_TOKEN = None
+    config = None
+
+TELEGRAM_BOT_TOKEN = getattr(config, "TOKEN", None)
+LIST_CACHE_MAX_BYTES = getattr(config, "LIST_CACHE_MAX_BYTES", 16 * 1024 * 1024)
+STORAGE_BACKEND = getattr(config, "STORAGE_BACKEND", "files")
+CONCURRENT_UPDATES = getattr(config, "CONCURRENT_UPDATES", 32)
+MAX_PENDING_UPDATES = getattr(config, "MAX_PENDING_UPDATES", 1024)
+WORKER_PROCESSES = getattr(config, "WORKER_PROCESSES", 1)
+MANIFEST_CACHE_USERS = getattr(config, "MANIFEST_CACHE_USERS", 10000)
+RENDER_CACHE_ENTRIES = getattr(config, "RENDER_CACHE_ENTRIES", 5000)
+ITEMS_PER_PAGE = getattr(config, "ITEMS_PER_PAGE", 25)
+LISTS_PER_PAGE = getattr(config, "LISTS_PER_PAGE", 20)
+STORAGE_WORKERS = getattr(config, "STORAGE_WORKERS", 8)
+STORAGE_MAX_QUEUED = getattr(config, "STORAGE_MAX_QUEUED", 256)
+PERSISTENCE_INTERVAL = getattr(config, "PERSISTENCE_INTERVAL", 30)
+DELIVERY_MODE = getattr(config, "DELIVERY_MODE", "polling")
+WEBHOOK_URL = getattr(config, "WEBHOOK_URL", "")
+WEBHOOK_PATH = getattr(config, "WEBHOOK_PATH", "/telegram")
+WEBHOOK_LISTEN = getattr(config, "WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = getattr(config, "WEBHOOK_PORT", 8443)
+WEBHOOK_SECRET_TOKEN = getattr(config, "WEBHOOK_SECRET_TOKEN", None)
+WEBHOOK_MAX_QUEUED = getattr(config, "WEBHOOK_MAX_QUEUED", 1024)
+RATE_LIMIT_GLOBAL = getattr(config, "RATE_LIMIT_GLOBAL", 30)
+RATE_LIMIT_PER_CHAT = getattr(config, "RATE_LIMIT_PER_CHAT", 1)
+RATE_LIMIT_BURST = getattr(config, "RATE_LIMIT_BURST", 3)
+SEND_MAX_QUEUED = getattr(config, "SEND_MAX_QUEUED", 1024)
+METRICS_LISTEN = getattr(config, "METRICS_LISTEN", "127.0.0.1")
+METRICS_PORT = getattr(config, "METRICS_PORT", 0)
+ADMIN_USER_IDS = getattr(config, "ADMIN_USER_IDS", [])
+PROFILE_DIR = Path(getattr(config, "PROFILE_DIR", "profiles"))
+PROFILE_SECONDS = getattr(config, "PROFILE_SECONDS", 30)
+HISTORY_MAX_ITEMS = getattr(config, "HISTORY_MAX_ITEMS", 1000)
+MAINTENANCE_INTERVAL = getattr(config, "MAINTENANCE_INTERVAL", 10)
+MAINTENANCE_SLICE_SECONDS = getattr(config, "MAINTENANCE_SLICE_SECONDS", 0.1)
+PURGE_CROSSED_AFTER_DAYS = getattr(config, "PURGE_CROSSED_AFTER_DAYS", 30)
+IDLE_EVICT_SECONDS = getattr(config, "IDLE_EVICT_SECONDS", 3600)
+BACKUP_DIR = Path(getattr(config, "BACKUP_DIR", "backups"))
 
 USER_DATA_BASE_DIR = Path("user_purchase_lists")
+SQLITE_PATH = Path(getattr(config, "SQLITE_PATH", USER_DATA_BASE_DIR / "lists.sqlite3"))
 CURRENT_LIST_KEY = "current_list_name"
 LIST_TO_DELETE_KEY = "list_to_delete_temp_name"
+# chat_data key: (message id, content hash) of the last list message sent or edited in the chat
+LIVE_LIST_KEY = "live_list_message"
 DEFAULT_TIMEOUT = 30
+# Longer items are cut in list messages, so a full page stays below Telegram's 4096 characters
+MAX_ITEM_DISPLAY_LENGTH = 150
+# How many of the items added at once are named in the confirmation
+ADDED_ITEMS_SHOWN = 10
+# How many lists, and items of each, /find shows
+FOUND_LISTS_SHOWN = 10
+FOUND_ITEMS_SHOWN = 5
+# Suggestions per inline query, and how long Telegram may reuse them (history changes with every addition)
+INLINE_RESULTS = 10
+INLINE_CACHE_TIME = 5
+# Profiling by number of updates stops after this long anyway
+MAX_PROFILE_SECONDS = 600
+# Bots can't download larger files
+MAX_IMPORT_BYTES = 20 * 1024 * 1024
+# Finding the file to import may take longer than answering a question
+IMPORT_TIMEOUT = 300
 
 (
     AWAITING_ITEM_FOR_ADD,
     AWAITING_LISTNAME_FOR_CREATE,
     AWAITING_LISTNAME_FOR_DELETE,
     AWAITING_CONFIRM_DELETE,
-) = range(4)
+    AWAITING_FILE_FOR_IMPORT,
+) = range(5)
+# Conversation states as shown in metrics and profiles
+STATE_NAMES = {
+    AWAITING_ITEM_FOR_ADD: "item",
+    AWAITING_LISTNAME_FOR_CREATE: "name",
+    AWAITING_LISTNAME_FOR_DELETE: "name",
+    AWAITING_CONFIRM_DELETE: "confirm",
+    AWAITING_FILE_FOR_IMPORT: "file",
+}
 
 
 logger = logging.getLogger("bot")
+startup_timer = StartupTimer()
+startup_timer.mark("imports")
+
+storage = AsyncStorage(
+    create_storage(STORAGE_BACKEND, USER_DATA_BASE_DIR, SQLITE_PATH),
+    ListCache(LIST_CACHE_MAX_BYTES) if LIST_CACHE_MAX_BYTES else None,
+    max_workers=STORAGE_WORKERS,
+    max_queued=STORAGE_MAX_QUEUED,
+    max_manifests=MANIFEST_CACHE_USERS,
+)
+render_cache = VersionedCache(RENDER_CACHE_ENTRIES)
+item_indexes = VersionedCache(RENDER_CACHE_ENTRIES)
+histories = UserHistories(MANIFEST_CACHE_USERS, storage)
+metrics = BotMetrics() if METRICS_PORT else None
+if metrics is not None:
+    metrics.track_storage(storage)
+profiler = SamplingProfiler(PROFILE_DIR)
+startup_timer.mark("setup")
 
 
 class Commands:
@@ -43,6 +161,9 @@ class Commands:
     ADD_ITEM = "/add_item"
     SHOW_ITEMS = "/list_items"
     REMOVE_ITEM = "/remove_item"
+    FIND = "/find"
+    EXPORT = "/export"
+    IMPORT = "/import"
     HELP = "/help"
     CANCEL = "/cancel"
 
@@ -57,47 +178,126 @@ def sanitize_filename(name: str) -> str:
     return name
 
 
-def get_user_dir(user_id: int) -> Path:
-    user_dir_path = USER_DATA_BASE_DIR / str(user_id)
-    user_dir_path.mkdir(parents=True, exist_ok=True)
-    return user_dir_path
+async def read_list(user_id: int, list_name: str) -> list[Item]:
+    try:
+        return await storage.read(user_id, sanitize_filename(list_name))
+    except Exception:
+        return []
 
 
-def get_user_list_path(user_id: int, list_name: str) -> Path:
-    sanitized_list_name = sanitize_filename(list_name)
-    return get_user_dir(user_id) / f"{sanitized_list_name}.txt"
+async def read_list_page(user_id: int, list_name: str, page: int) -> list[Item]:
+    start = page * ITEMS_PER_PAGE
+    return await storage.read_slice(user_id, sanitize_filename(list_name), start, start + ITEMS_PER_PAGE)
 
 
-def get_all_list_names(user_id: int) -> list[str]:
-    user_dir = get_user_dir(user_id)
-    all_lists = sorted([p.stem for p in user_dir.glob("*.txt") if p.is_file()])
-    # Ensure 'default' is always first if it exists
-    if "default" in all_lists:
-        all_lists.remove("default")
-        all_lists.insert(0, "default")
-    return all_lists
+async def write_list(user_id: int, list_name: str, items: list[Item]):
+    try:
+        await storage.write(user_id, sanitize_filename(list_name), items)
+    except Exception:
+        logger.exception("Failed to write list '%s' of user %s", list_name, user_id)
 
 
-def read_list(user_id: int, list_name: str) -> list[str]:
-    list_path = get_user_list_path(user_id, list_name)
-    if not list_path.exists():
-        return []
+async def add_items(user_id: int, list_name: str, texts: list[str]) -> list[str]:
+    """Add items, merging repeated ones into quantities; texts of the new or changed items"""
     try:
-        with open(list_path, "r", encoding="utf-8") as f:
-            return [line.strip() for line in f if line.strip()]
+        items = await storage.add_items(user_id, sanitize_filename(list_name), [Item(text) for text in texts])
     except Exception:
+        logger.exception("Failed to add to list '%s' of user %s", list_name, user_id)
         return []
+    try:
+        history = await item_history(user_id)
+    except Exception:
+        logger.exception("Failed to load the item history of user %s", user_id)
+    else:
+        for text in texts:
+            history.record(text)
+        histories.changed(user_id, history)
+    return [item.text for item in items]
+
+
+async def item_history(user_id: int) -> HistoryTrie:
+    """The user's added items for suggestions, as stored or started from the items of all their lists"""
+    history = histories.get(user_id)
+    if history is not None:
+        return history
+    data = await storage.load_history(user_id)
+    if data:
+        try:
+            return histories.setdefault(user_id, HistoryTrie.from_json(data, HISTORY_MAX_ITEMS))
+        except (ValueError, TypeError):
+            logger.warning("Rebuilding corrupted item history of user %s", user_id)
+    search_index = await storage.search_index(user_id)
+    manifest = await get_lists_manifest(user_id)
+    history = HistoryTrie(HISTORY_MAX_ITEMS)
+    for list_name, text, count in search_index.items():
+        info = manifest.get(list_name)
+        history.record(text, info.mtime if info is not None else 0, count)
+    history = histories.setdefault(user_id, history)
+    histories.changed(user_id, history)
+    return history
+
+
+async def keep_in_history(user_id: int, items: list[Item]) -> None:
+    """Items leave the lists: keep them in the history, so they are still suggested"""
+    try:
+        history = await item_history(user_id)
+    except Exception:
+        logger.exception("Failed to load the item history of user %s", user_id)
+        return
+    for item in items:
+        history.keep(item.text, item.ts)
+    histories.changed(user_id, history)
+
 
+async def read_item(user_id: int, list_name: str, item_number: int) -> Item | None:
+    """The item with the 1-based number, None if the list is shorter"""
+    items = await storage.read_slice(user_id, sanitize_filename(list_name), item_number - 1, item_number)
+    return items[0] if items else None
 
-def write_list(user_id: int, list_name: str, items: list[str]):
-    list_path = get_user_list_path(user_id, list_name)
+
+async def toggle_item(user_id: int, list_name: str, item_number: int):
+    list_name = sanitize_filename(list_name)
     try:
-        list_path.parent.mkdir(parents=True, exist_ok=True)
-        with open(list_path, "w", encoding="utf-8") as f:
-            for item in items:
-                f.write(f"{item}\n")
+        item = await read_item(user_id, list_name, item_number)
+        await storage.toggle(user_id, list_name, item_number - 1)
     except Exception:
-        pass
+        logger.exception("Failed to update list '%s' of user %s", list_name, user_id)
+        return
+    if item is not None and item.crossed:
+        # Toggling a crossed item removes it
+        await keep_in_history(user_id, [item])
+
+
+async def find_item(user_id: int, list_name: str, item_id: str) -> int | None:
+    """1-based number of the item with the short id, None if the list has no such item anymore"""
+    list_name = sanitize_filename(list_name)
+    version = await storage.version(user_id, list_name)
+    index = item_indexes.get(user_id, list_name, version)
+    if index is None:
+        index = build_item_index(await read_list(user_id, list_name))
+        item_indexes.put(user_id, list_name, version, index)
+    position = index.get(item_id)
+    return None if position is None else position + 1
+
+
+async def get_all_list_names(user_id: int) -> list[str]:
+    return await storage.list_names(user_id)
+
+
+async def get_lists_manifest(user_id: int) -> Manifest:
+    return await storage.manifest(user_id)
+
+
+async def list_exists(user_id: int, list_name: str) -> bool:
+    return await storage.exists(user_id, sanitize_filename(list_name))
+
+
+async def delete_list(user_id: int, list_name: str) -> None:
+    list_name = sanitize_filename(list_name)
+    render_cache.discard(user_id, list_name)
+    items = await read_list(user_id, list_name)
+    await storage.delete(user_id, list_name)
+    await keep_in_history(user_id, items)
 
 
 def get_standard_keyboard() -> InlineKeyboardMarkup:
@@ -111,6 +311,213 @@ def get_standard_keyboard() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(keyboard)
 
 
+def page_count(total: int, per_page: int) -> int:
+    return max(1, -(-total // per_page))
+
+
+def page_navigation(view: str, page: int, pages: int) -> list[InlineKeyboardButton]:
+    """Previous/next page buttons of a paginated view, empty if it has a single page"""
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton("◀️", callback_data=f"{view}_page_{page - 1}"))
+    if page < pages - 1:
+        buttons.append(InlineKeyboardButton("▶️", callback_data=f"{view}_page_{page + 1}"))
+    return buttons
+
+
+def render_list(
+    list_name: str, items: list[Item], info: ListInfo, page: int = 0
+) -> tuple[str, InlineKeyboardMarkup, int]:
+    """Build the text, keyboard and content hash showing one page of a non-empty list"""
+    pages = page_count(info.items, ITEMS_PER_PAGE)
+    if pages > 1:
+        message_text_parts = [f"Список '<b>{list_name}</b>' (стр. {page + 1}/{pages}):"]
+    else:
+        message_text_parts = [f"Список '<b>{list_name}</b>':"]
+
+    for i, item in enumerate(items, page * ITEMS_PER_PAGE + 1):
+        text = item.text
+        if len(text) > MAX_ITEM_DISPLAY_LENGTH:
+            text = text[: MAX_ITEM_DISPLAY_LENGTH - 1] + "…"
+        text = html.escape(text)
+        if item.crossed:
+            text = f"<s>{text}</s>"
+        message_text_parts.append(f"{i}. {text}")
+
+    keyboard = list(get_standard_keyboard().inline_keyboard)
+    navigation = page_navigation("items", page, pages)
+    if navigation:
+        keyboard.insert(0, navigation)
+
+    # If all items are crossed out and it's not the default list, show delete button
+    all_crossed = info.crossed >= info.items and list_name != "default"
+    if all_crossed:
+        keyboard.insert(
+            0, [InlineKeyboardButton("🗑️ Удалить список и вернуться к default", callback_data="delete_completed_list")]
+        )
+        text = "\n".join(message_text_parts) + "\n\n✅ Все элементы вычеркнуты!"
+    else:
+        text = "\n".join(message_text_parts) + f"\n\n{Commands.ADD_ITEM}  {Commands.REMOVE_ITEM}"
+    return text, InlineKeyboardMarkup(keyboard), hash((text, all_crossed, page, pages))
+
+
+async def get_rendered_list(
+    user_id: int, list_name: str, page: int = 0
+) -> tuple[str, InlineKeyboardMarkup, int] | None:
+    """Rendered page of a list from the cache or freshly built, None if the list is empty.
+
+    Out of range pages are clamped, only the items of the shown page are read.
+    """
+    list_name = sanitize_filename(list_name)
+    info = (await get_lists_manifest(user_id)).get(list_name)
+    if info is None or info.items <= 0:
+        return None
+    page = min(max(page, 0), page_count(info.items, ITEMS_PER_PAGE) - 1)
+    version = await storage.version(user_id, list_name)
+    # All rendered pages of a list are cached together and invalidated by its next change
+    pages = render_cache.get(user_id, list_name, version)
+    if pages is None:
+        pages = {}
+        render_cache.put(user_id, list_name, version, pages)
+    rendered = pages.get(page)
+    if rendered is None:
+        items = await read_list_page(user_id, list_name, page)
+        if not items:
+            return None
+        rendered = pages[page] = render_list(list_name, items, info, page)
+    return rendered
+
+
+def render_lists_page(manifest: Manifest, current_list_name: str | None, page: int) -> tuple[str, list]:
+    """Text of one page of the user's lists and the buttons switching pages"""
+    pages = page_count(len(manifest), LISTS_PER_PAGE)
+    page = min(max(page, 0), pages - 1)
+    start = page * LISTS_PER_PAGE
+    message_parts = [f"Ваши списки (стр. {page + 1}/{pages}):" if pages > 1 else "Ваши списки:"]
+    for i, name in enumerate(manifest.names_slice(start, start + LISTS_PER_PAGE), start + 1):
+        prefix = "🟢 " if name == current_list_name else "⚪ "
+        message_parts.append(f"{prefix}{i}. {name} ({manifest.get(name).done})")
+    return "\n".join(message_parts), page_navigation("lists", page, pages)
+
+
+def render_select_keyboard(manifest: Manifest, current_list_name: str | None, page: int) -> InlineKeyboardMarkup:
+    """Buttons selecting one of the lists on a page of the user's lists"""
+    pages = page_count(len(manifest), LISTS_PER_PAGE)
+    page = min(max(page, 0), pages - 1)
+    start = page * LISTS_PER_PAGE
+    keyboard = []
+    row = []
+    for list_name in manifest.names_slice(start, start + LISTS_PER_PAGE):
+        # Add indicator for current list
+        prefix = "🟢 " if list_name == current_list_name else ""
+        display_text = f"{prefix}{list_name}"
+
+        # Truncate long list names for button display
+        if len(display_text) > 25:
+            display_text = display_text[:22] + "..."
+
+        button = InlineKeyboardButton(display_text, callback_data=f"select_{manifest.id_of(list_name)}")
+        row.append(button)
+
+        # Create rows of 2 buttons each for lists
+        if len(row) == 2:
+            keyboard.append(row)
+            row = []
+
+    # Add remaining buttons
+    if row:
+        keyboard.append(row)
+    navigation = page_navigation("select", page, pages)
+    if navigation:
+        keyboard.append(navigation)
+    return InlineKeyboardMarkup(keyboard)
+
+
+async def render_remove_keyboard(
+    user_id: int, list_name: str, info: ListInfo, page: int
+) -> tuple[str, InlineKeyboardMarkup]:
+    """Prompt and buttons removing one of the active items on a page of a list"""
+    pages = page_count(info.items, ITEMS_PER_PAGE)
+    page = min(max(page, 0), pages - 1)
+    items = await read_list_page(user_id, list_name, page)
+    list_id = (await get_lists_manifest(user_id)).id_of(list_name)
+
+    keyboard = []
+    row = []
+    for i, item in enumerate(items, page * ITEMS_PER_PAGE + 1):
+        # Already crossed-out items can't be removed
+        if item.crossed:
+            continue
+
+        # Truncate long items for button display
+        display_text = item.text
+        if len(display_text) > 20:
+            display_text = display_text[:17] + "..."
+
+        button = InlineKeyboardButton(
+            f"{i}. {display_text}", callback_data=f"remove_{list_id}.{item_id(item.text)}"
+        )
+        row.append(button)
+
+        # Create rows of 3 buttons each
+        if len(row) == 3:
+            keyboard.append(row)
+            row = []
+
+    # Add remaining buttons
+    if row:
+        keyboard.append(row)
+    navigation = page_navigation("remove", page, pages)
+    if navigation:
+        keyboard.append(navigation)
+
+    text = f"Выберите элемент для удаления из списка '{list_name}'"
+    if pages > 1:
+        text += f" (стр. {page + 1}/{pages})"
+    return text + ":", InlineKeyboardMarkup(keyboard)
+
+
+def background_priority(bot) -> dict:
+    """Arguments of a send that may wait behind the replies to other users, see Priority.BACKGROUND"""
+    # Passing rate_limit_args to a bot without a rate limiter is an error
+    return {"rate_limit_args": {"priority": Priority.BACKGROUND}} if bot.rate_limiter else {}
+
+
+async def send_list_message(
+    update: Update, context: ContextTypes.DEFAULT_TYPE, rendered: tuple, notice: str = ""
+) -> None:
+    """Send the list as a new message, which becomes the live list message of the chat"""
+    text, reply_markup, content_hash = rendered
+    if notice:
+        text = f"{notice}\n\n{text}"
+    message = await update.effective_message.reply_html(text, reply_markup=reply_markup)
+    context.chat_data[LIVE_LIST_KEY] = (message.message_id, hash((notice, content_hash)))
+
+
+async def edit_list_message(
+    update: Update, context: ContextTypes.DEFAULT_TYPE, rendered: tuple, notice: str = ""
+) -> None:
+    """Show the list in place of the message whose button was pressed.
+
+    Nothing is sent if that message is the live list message and already shows
+    the same content. Falls back to a new message if it can't be edited.
+    """
+    query = update.callback_query
+    text, reply_markup, content_hash = rendered
+    live = (query.message.message_id, hash((notice, content_hash)))
+    if context.chat_data.get(LIVE_LIST_KEY) == live:
+        return
+    if notice:
+        text = f"{notice}\n\n{text}"
+    try:
+        await query.edit_message_text(text, parse_mode=ParseMode.HTML, reply_markup=reply_markup)
+    except BadRequest as e:
+        if "not modified" not in e.message:
+            await send_list_message(update, context, rendered, notice)
+            return
+    context.chat_data[LIVE_LIST_KEY] = live
+
+
 async def ensure_list_selected(update: Update, context: ContextTypes.DEFAULT_TYPE) -> str | None:
     current_list_name = context.user_data.get(CURRENT_LIST_KEY)
     user = update.effective_user
@@ -125,7 +532,7 @@ async def ensure_list_selected(update: Update, context: ContextTypes.DEFAULT_TYP
             f"{Commands.SHOW_LISTS} - Показать списки пользователя"
         )
         return None
-    if not get_user_list_path(user.id, current_list_name).exists():
+    if not await list_exists(user.id, current_list_name):
         await update.message.reply_text(
             f"Выбранный список '{current_list_name}' больше не существует.\n"
             f"Выберите {Commands.SET_ACTIVE_LIST} другой список или {Commands.CREATE_LIST} создайте новый."
@@ -148,11 +555,9 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     if not user or not update.message:
         return
 
-    get_user_dir(user.id)
-
-    write_list(user.id, "default", [])
+    await write_list(user.id, "default", [])
 
-    all_lists = get_all_list_names(user.id)
+    all_lists = await get_all_list_names(user.id)
     # Auto-select default list if no list is selected
     if not context.user_data.get(CURRENT_LIST_KEY):
         if "default" in all_lists:
@@ -173,10 +578,16 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         f"{Commands.DELETE_LIST} - Удалить список",
         "",
         "<b>Управление выбранным списком:</b>",
-        f"{Commands.ADD_ITEM} - Добавить элемент",
+        f"{Commands.ADD_ITEM} - Добавить элементы (через запятую или с новой строки)",
         f"{Commands.SHOW_ITEMS} - Показать элементы",
         f"{Commands.REMOVE_ITEM} - Удалить элемент",
         "",
+        f"{Commands.FIND} текст - Найти элемент во всех списках",
+        f"@{context.bot.username} текст - Подсказать элемент из прошлых покупок",
+        "",
+        f"{Commands.EXPORT} - Сохранить все списки в файл ({Commands.EXPORT} zip - в архив)",
+        f"{Commands.IMPORT} - Загрузить списки из файла",
+        "",
         f"{Commands.HELP} - Вывести это сообщение",
     ]
 
@@ -201,14 +612,14 @@ async def createlist_receive_name(update: Update, context: ContextTypes.DEFAULT_
     if not new_list_name:
         await update.message.reply_text(f"Такое имя не подходит.\nПопробуй ещё раз {Commands.CREATE_LIST}")
         return ConversationHandler.END
-    if get_user_list_path(user.id, new_list_name).exists():
+    if await list_exists(user.id, new_list_name):
         await update.message.reply_text(
             f"Список '{new_list_name}' уже есть.\n"
             f"Выбрать {Commands.SET_ACTIVE_LIST} или создать {Commands.CREATE_LIST} с другим названием"
         )
         return ConversationHandler.END
 
-    write_list(user.id, new_list_name, [])
+    await write_list(user.id, new_list_name, [])
 
     context.user_data[CURRENT_LIST_KEY] = new_list_name
 
@@ -225,21 +636,17 @@ async def lists_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     if not user or not update.message:
         return
 
-    all_lists = get_all_list_names(user.id)
+    manifest = await get_lists_manifest(user.id)
     current_list_name = context.user_data.get(CURRENT_LIST_KEY)
 
-    message_parts = ["Ваши списки:"]
-    for i, name in enumerate(all_lists, 1):
-        prefix = "🟢 " if name == current_list_name else "⚪ "
-        message_parts.append(f"{prefix}{i}. {name}")
-    if current_list_name and current_list_name not in all_lists:
-        message_parts.append(
-            f"\nWarn: Список '{current_list_name}' не существует. {Commands.SET_ACTIVE_LIST} выбрать другой."
-        )
+    text, navigation = render_lists_page(manifest, current_list_name, 0)
+    if current_list_name and current_list_name not in manifest:
+        text += f"\n\nWarn: Список '{current_list_name}' не существует. {Commands.SET_ACTIVE_LIST} выбрать другой."
         if CURRENT_LIST_KEY in context.user_data:
             del context.user_data[CURRENT_LIST_KEY]
     await update.message.reply_text(
-        "\n".join(message_parts) + f"\n\n{Commands.SET_ACTIVE_LIST}  {Commands.CREATE_LIST}  {Commands.DELETE_LIST}  "
+        text + f"\n\n{Commands.SET_ACTIVE_LIST}  {Commands.CREATE_LIST}  {Commands.DELETE_LIST}  ",
+        reply_markup=InlineKeyboardMarkup([navigation]) if navigation else None,
     )
 
 
@@ -248,39 +655,13 @@ async def selectlist_entry(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     if not user or not update.message:
         return ConversationHandler.END
 
-    all_lists = get_all_list_names(user.id)
+    manifest = await get_lists_manifest(user.id)
 
-    if not all_lists:
+    if not len(manifest):
         await update.message.reply_text(f"Списков нет. Создать {Commands.CREATE_LIST}")
         return ConversationHandler.END
 
-    current_list_name = context.user_data.get(CURRENT_LIST_KEY)
-
-    # Create inline keyboard with buttons for each list
-    keyboard = []
-    row = []
-    for i, list_name in enumerate(all_lists, 1):
-        # Add indicator for current list
-        prefix = "🟢 " if list_name == current_list_name else ""
-        display_text = f"{prefix}{list_name}"
-
-        # Truncate long list names for button display
-        if len(display_text) > 25:
-            display_text = display_text[:22] + "..."
-
-        button = InlineKeyboardButton(display_text, callback_data=f"select_{i}")
-        row.append(button)
-
-        # Create rows of 2 buttons each for lists
-        if len(row) == 2:
-            keyboard.append(row)
-            row = []
-
-    # Add remaining buttons
-    if row:
-        keyboard.append(row)
-
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = render_select_keyboard(manifest, context.user_data.get(CURRENT_LIST_KEY), 0)
 
     await update.message.reply_text("Выберите список:", reply_markup=reply_markup)
 
@@ -297,53 +678,38 @@ async def selectlist_callback(update: Update, context: ContextTypes.DEFAULT_TYPE
 
     await query.answer()
 
-    # Extract list number from callback data (format: "select_N")
+    # Extract list id from callback data (format: "select_<list id>")
     callback_data = query.data
     if not callback_data or not callback_data.startswith("select_"):
         await query.edit_message_text("Ошибка: неверные данные кнопки")
         return
 
-    try:
-        list_number = int(callback_data.split("_")[1])
-    except (IndexError, ValueError):
-        await query.edit_message_text("Ошибка: неверный номер списка")
-        return
-
-    all_lists = get_all_list_names(user.id)
+    manifest = await get_lists_manifest(user.id)
+    selected_name = manifest.name_of(callback_data[len("select_") :])
 
-    if not (1 <= list_number <= len(all_lists)):
-        await query.edit_message_text(f"Неверный номер списка (1-{len(all_lists)})")
+    if selected_name is None:
+        # The keyboard is older than the deletion of the list
+        await query.edit_message_text(f"Этого списка больше нет. Выбрать другой - {Commands.SET_ACTIVE_LIST}")
         return
 
-    selected_name = all_lists[list_number - 1]
     context.user_data[CURRENT_LIST_KEY] = selected_name
 
-    await query.edit_message_text(f"✓ Выбран список '{selected_name}'")
-
-    # Show items in the selected list
-    items = read_list(user.id, selected_name)
-    if not items:
-        await query.message.reply_text(f"Список '{selected_name}' пуст!\nДобавить элемент - {Commands.ADD_ITEM}")
+    # Show items of the selected list in place of the selection keyboard
+    rendered = await get_rendered_list(user.id, selected_name)
+    if not rendered:
+        await query.edit_message_text(
+            f"✓ Выбран список '{selected_name}'\n\nСписок пуст!\nДобавить элемент - {Commands.ADD_ITEM}"
+        )
         return
 
-    message_text_parts = [f"Список '<b>{selected_name}</b>':"]
-
-    for i, item in enumerate(items, 1):
-        if "~" in item:
-            item = f"<s>{item[1:-1]}</s>"
-        message_text_parts.append(f"{i}. {item}")
-
-    await query.message.reply_html(
-        "\n".join(message_text_parts) + f"\n\n{Commands.ADD_ITEM}  {Commands.REMOVE_ITEM}",
-        reply_markup=get_standard_keyboard(),
-    )
+    await edit_list_message(update, context, rendered, notice=f"✓ Выбран список '{selected_name}'")
 
 
 async def deletelist_entry(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user = update.effective_user
     if not user or not update.message:
         return ConversationHandler.END
-    all_lists = get_all_list_names(user.id)
+    all_lists = await get_all_list_names(user.id)
 
     if not all_lists:
         await update.message.reply_text(f"Нет доступных списков. Создать - {Commands.CREATE_LIST}")
@@ -368,20 +734,15 @@ async def deletelist_receive_choice(update: Update, context: ContextTypes.DEFAUL
     if not user or not update.message or not update.message.text:
         return ConversationHandler.END
     choice = update.message.text.strip()
-    all_lists = get_all_list_names(user.id)
+    manifest = await get_lists_manifest(user.id)
     list_to_delete_name = None
     if choice.isdigit():
-        try:
-            idx = int(choice) - 1
-            if 0 <= idx < len(all_lists):
-                list_to_delete_name = all_lists[idx]
-        except ValueError:
-            pass
+        list_to_delete_name = manifest.name_at(int(choice) - 1)
     if not list_to_delete_name:
         potential_sanitized_name = sanitize_filename(choice)
-        if potential_sanitized_name in all_lists:
+        if potential_sanitized_name in manifest:
             list_to_delete_name = potential_sanitized_name
-        elif choice in all_lists:
+        elif choice in manifest:
             list_to_delete_name = choice
     if not list_to_delete_name:
         await update.message.reply_text(f"Список '{choice}' не найден. Попробуй {Commands.DELETE_LIST} ещё раз")
@@ -408,10 +769,9 @@ async def deletelist_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return ConversationHandler.END
     confirmation = update.message.text.strip().lower()
     if confirmation == "да":
-        list_path = get_user_list_path(user.id, list_to_delete_name)
-        if list_path.exists():
+        if await list_exists(user.id, list_to_delete_name):
             try:
-                os.remove(list_path)
+                await delete_list(user.id, list_to_delete_name)
                 await update.message.reply_text(f"Список '{list_to_delete_name}' удалён")
                 # If deleted list was active, switch to 'default'
                 if context.user_data.get(CURRENT_LIST_KEY) == list_to_delete_name:
@@ -437,7 +797,15 @@ async def add_item_entry(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     if not current_list_name:
         return ConversationHandler.END
 
-    await update.message.reply_text(f"Какой элемент добавим в '{current_list_name}':")
+    # "/add_item молоко, хлеб" adds right away
+    command_and_text = (update.message.text or "").split(None, 1)
+    if len(command_and_text) > 1:
+        await add_items_from_text(update, context, user.id, current_list_name, command_and_text[1])
+        return ConversationHandler.END
+
+    await update.message.reply_text(
+        f"Какой элемент добавим в '{current_list_name}'?\nМожно несколько: через запятую или каждый с новой строки"
+    )
 
     return AWAITING_ITEM_FOR_ADD
 
@@ -451,22 +819,32 @@ async def add_item_receive_name(update: Update, context: ContextTypes.DEFAULT_TY
         await update.message.reply_text(f"Ошибка: Нет выбранного списка. Используй {Commands.SET_ACTIVE_LIST}")
         return ConversationHandler.END
 
-    item_to_add: list = [el.lower() for el in update.message.text.strip().split("  ") if el]
+    await add_items_from_text(update, context, user.id, current_list_name, update.message.text)
 
-    if not item_to_add:
-        await update.message.reply_text(f"Нельзя добавить пустое значение.\nПопробуй ещё раз {Commands.ADD_ITEM}")
-        return ConversationHandler.END
+    return ConversationHandler.END
 
-    current_items = read_list(user.id, current_list_name)
-    current_items.extend(item_to_add)
 
-    write_list(user.id, current_list_name, current_items)
+async def add_items_from_text(
+    update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, list_name: str, text: str
+) -> None:
+    """Add all items of a pasted text with one storage write and answer with one list message"""
+    items_to_add = parse_items(text)
 
-    await update.message.reply_text(f"Элемент '{item_to_add}' дбавлен в список '{current_list_name}'")
+    if not items_to_add:
+        await update.message.reply_text(f"Нельзя добавить пустое значение.\nПопробуй ещё раз {Commands.ADD_ITEM}")
+        return
 
-    await list_items_command(update, context)
+    added = await add_items(user_id, list_name, items_to_add)
+    if not added:
+        await update.message.reply_text(f"Ошибка добавления в список '{list_name}'")
+        return
 
-    return ConversationHandler.END
+    shown = ", ".join(added[:ADDED_ITEMS_SHOWN])
+    if len(added) > ADDED_ITEMS_SHOWN:
+        shown += f" и ещё {len(added) - ADDED_ITEMS_SHOWN}"
+    rendered = await get_rendered_list(user_id, list_name)
+    if rendered:
+        await send_list_message(update, context, rendered, notice=f"✓ Добавлено: {html.escape(shown)}")
 
 
 async def list_items_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -479,39 +857,154 @@ async def list_items_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
     if not current_list_name:
         return
 
-    items = read_list(user.id, current_list_name)
-    if not items:
+    rendered = await get_rendered_list(user.id, current_list_name)
+    if not rendered:
         await update.message.reply_text(f"Список '{current_list_name}' пуст!\nДобавить элемент - {Commands.ADD_ITEM}")
         return
 
-    message_text_parts = [f"Список '<b>{current_list_name}</b>':"]
+    await send_list_message(update, context, rendered)
 
-    # Check if all items are crossed out
-    all_crossed = all("~" in item for item in items)
 
-    for i, item in enumerate(items, 1):
-        if "~" in item:
-            item = f"<s>{item[1:-1]}</s>"
-        message_text_parts.append(f"{i}. {item}")
+async def find_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Items of all lists of the user that contain the words of the query, grouped by list"""
+    user = update.effective_user
+    if not user or not update.message:
+        return
 
-    # If all items are crossed out and it's not the default list, show delete button
-    if all_crossed and current_list_name != "default":
-        keyboard = [
-            [InlineKeyboardButton("🗑️ Удалить список и вернуться к default", callback_data="delete_completed_list")],
-            [
-                InlineKeyboardButton("📋 Показать списки", callback_data="show_lists"),
-                InlineKeyboardButton("📝 Показать элементы", callback_data="show_items"),
-            ],
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await update.message.reply_html(
-            "\n".join(message_text_parts) + f"\n\n✅ Все элементы вычеркнуты!", reply_markup=reply_markup
-        )
-    else:
-        await update.message.reply_html(
-            "\n".join(message_text_parts) + f"\n\n{Commands.ADD_ITEM}  {Commands.REMOVE_ITEM}",
-            reply_markup=get_standard_keyboard(),
+    query = " ".join(context.args or [])
+    if not query_words(query):
+        await update.message.reply_text(f"Что найти? Например: {Commands.FIND} батарейки")
+        return
+
+    try:
+        matches = (await storage.search_index(user.id)).search(query)
+    except Exception:
+        logger.exception("Search of user %s failed", user.id)
+        await update.message.reply_text("Ошибка поиска, попробуй позже")
+        return
+    if not matches:
+        await update.message.reply_text(f"Ничего не найдено по запросу '{query}'")
+        return
+
+    found: dict[str, list[str]] = {}
+    for list_name, text in matches:
+        found.setdefault(list_name, []).append(text)
+    list_names = order_list_names(found)
+    message_parts = [f"Найдено по запросу '<b>{html.escape(query)}</b>':"]
+    for list_name in list_names[:FOUND_LISTS_SHOWN]:
+        message_parts.append(f"\n<b>{list_name}</b>:")
+        for text in found[list_name][:FOUND_ITEMS_SHOWN]:
+            if len(text) > MAX_ITEM_DISPLAY_LENGTH:
+                text = text[: MAX_ITEM_DISPLAY_LENGTH - 1] + "…"
+            message_parts.append(f"• {html.escape(text)}")
+        if len(found[list_name]) > FOUND_ITEMS_SHOWN:
+            message_parts.append(f"... и ещё {len(found[list_name]) - FOUND_ITEMS_SHOWN}")
+    if len(list_names) > FOUND_LISTS_SHOWN:
+        message_parts.append(f"\n... и ещё в {len(list_names) - FOUND_LISTS_SHOWN} списках")
+
+    # Opening a list selects it, as in /select_list
+    manifest = await get_lists_manifest(user.id)
+    keyboard = [
+        [InlineKeyboardButton(f"📝 {list_name}", callback_data=f"select_{manifest.id_of(list_name)}")]
+        for list_name in list_names[:FOUND_LISTS_SHOWN]
+    ]
+    await update.message.reply_html("\n".join(message_parts), reply_markup=InlineKeyboardMarkup(keyboard))
+
+
+async def inline_query_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Suggest items the user added before that start with the typed text; choosing one adds it"""
+    inline_query = update.inline_query
+    user = update.effective_user
+    if not inline_query or not user:
+        return
+
+    try:
+        suggestions = (await item_history(user.id)).suggest(inline_query.query, INLINE_RESULTS)
+    except Exception:
+        logger.exception("Suggestions for user %s failed", user.id)
+        suggestions = []
+    typed = " ".join(parse_items(inline_query.query)[:1])
+    if typed and all(normalize_prefix(text) != normalize_prefix(typed) for text in suggestions):
+        # Something new may be typed, offer it as is after the known items
+        suggestions = [*suggestions[: INLINE_RESULTS - 1], typed]
+
+    list_name = context.user_data.get(CURRENT_LIST_KEY)
+    description = f"Добавить в список '{list_name}'" if list_name else "Добавить в выбранный список"
+    results = [
+        InlineQueryResultArticle(
+            id=str(number),
+            title=text,
+            description=description,
+            # Handled like any other "/add_item <text>" message
+            input_message_content=InputTextMessageContent(f"{Commands.ADD_ITEM} {text}"),
         )
+        for number, text in enumerate(suggestions)
+    ]
+    await inline_query.answer(results, cache_time=INLINE_CACHE_TIME, is_personal=True)
+
+
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Send all lists of the user as a file, "/export zip" as a ZIP"""
+    user = update.effective_user
+    if not user or not update.message:
+        return
+    if not await get_all_list_names(user.id):
+        await update.message.reply_text(f"Нет списков для сохранения.\nСоздать - {Commands.CREATE_LIST}")
+        return
+
+    compress = bool(context.args) and context.args[0].lower() == "zip"
+    filename = f"lists-{time.strftime('%Y-%m-%d')}.{'zip' if compress else 'jsonl'}"
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = Path(tmp_dir) / filename
+        lists, items = await export_lists(storage, user.id, path, compress)
+        # A large file shouldn't hold up the replies to other users
+        try:
+            with open(path, "rb") as f:
+                await context.bot.send_document(
+                    update.message.chat_id,
+                    f,
+                    filename=filename,
+                    caption=f"Списков: {lists}, элементов: {items}\nЗагрузить обратно - {Commands.IMPORT}",
+                    **background_priority(context.bot),
+                )
+        except SendQueueFull:
+            await update.message.reply_text("Бот сейчас перегружен, попробуй позже")
+
+
+async def import_entry(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    await update.message.reply_text(
+        f"Пришли файл, сохранённый через {Commands.EXPORT}.\n"
+        "Списки из файла заменят одноимённые, остальные списки не изменятся.\n"
+        f"Отмена - {Commands.CANCEL}"
+    )
+    return AWAITING_FILE_FOR_IMPORT
+
+
+async def import_receive_file(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    user = update.effective_user
+    if not user or not update.message or not update.message.document:
+        return ConversationHandler.END
+    document = update.message.document
+    if document.file_size and document.file_size > MAX_IMPORT_BYTES:
+        await update.message.reply_text(f"Файл слишком большой, можно до {MAX_IMPORT_BYTES // (1024 * 1024)} МБ")
+        return ConversationHandler.END
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = Path(tmp_dir) / "import"
+        await (await document.get_file()).download_to_drive(path)
+        try:
+            lists, items = await import_lists(storage, user.id, path, sanitize_filename)
+        except ValueError as error:
+            logger.info("Import of user %s failed: %s", user.id, error)
+            await update.message.reply_text(
+                f"Это не файл из {Commands.EXPORT} или он повреждён.\nСписки до повреждённого места загружены"
+            )
+            return ConversationHandler.END
+
+    await update.message.reply_text(
+        f"Загружено списков: {lists}, элементов: {items}\n\n{Commands.SHOW_LISTS}  {Commands.SET_ACTIVE_LIST}"
+    )
+    return ConversationHandler.END
 
 
 async def remove_item_entry(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -525,45 +1018,18 @@ async def remove_item_entry(update: Update, context: ContextTypes.DEFAULT_TYPE)
     if not current_list_name:
         return ConversationHandler.END
 
-    current_items = read_list(user.id, current_list_name)
+    info = (await get_lists_manifest(user.id)).get(sanitize_filename(current_list_name))
 
-    if not current_items:
+    if not info or info.items <= 0:
         await update.message.reply_text(f"Список '{current_list_name}' пуст. Удалять нечего.")
         return ConversationHandler.END
 
-    # Filter out already crossed-out items (those with ~)
-    active_items = [(i, item) for i, item in enumerate(current_items, 1) if "~" not in item]
-
-    if not active_items:
+    if info.crossed >= info.items:
         await update.message.reply_text(f"Все элементы в списке '{current_list_name}' уже вычеркнуты. Удалять нечего.")
         return ConversationHandler.END
 
-    # Create inline keyboard with buttons for each active item
-    keyboard = []
-    row = []
-    for i, item in active_items:
-        # Truncate long items for button display
-        display_text = item
-        if len(display_text) > 20:
-            display_text = display_text[:17] + "..."
-
-        button = InlineKeyboardButton(f"{i}. {display_text}", callback_data=f"remove_{i}")
-        row.append(button)
-
-        # Create rows of 3 buttons each
-        if len(row) == 3:
-            keyboard.append(row)
-            row = []
-
-    # Add remaining buttons
-    if row:
-        keyboard.append(row)
-
-    reply_markup = InlineKeyboardMarkup(keyboard)
-
-    await update.message.reply_text(
-        f"Выберите элемент для удаления из списка '{current_list_name}':", reply_markup=reply_markup
-    )
+    text, reply_markup = await render_remove_keyboard(user.id, current_list_name, info, 0)
+    await update.message.reply_text(text, reply_markup=reply_markup)
 
     return ConversationHandler.END
 
@@ -578,86 +1044,47 @@ async def remove_item_callback(update: Update, context: ContextTypes.DEFAULT_TYP
 
     await query.answer()
 
-    current_list_name = context.user_data.get(CURRENT_LIST_KEY)
-
-    if not current_list_name:
-        await query.edit_message_text(f"Error: Не выбран список. Выбрать - {Commands.SET_ACTIVE_LIST}")
-        return
-
-    # Extract item number from callback data (format: "remove_N")
+    # Extract list and item ids from callback data (format: "remove_<list id>.<item id>")
     callback_data = query.data
     if not callback_data or not callback_data.startswith("remove_"):
         await query.edit_message_text("Ошибка: неверные данные кнопки")
         return
 
-    try:
-        item_number = int(callback_data.split("_")[1])
-    except (IndexError, ValueError):
-        await query.edit_message_text("Ошибка: неверный номер элемента")
-        return
-
-    current_items = read_list(user.id, current_list_name)
+    list_id, _, item_id = callback_data[len("remove_") :].partition(".")
+    manifest = await get_lists_manifest(user.id)
+    current_list_name = manifest.name_of(list_id)
 
-    if not current_items:
-        await query.edit_message_text(f"Список '{current_list_name}' пуст")
+    if current_list_name is None:
+        await query.edit_message_text(f"Этого списка больше нет. Выбрать другой - {Commands.SET_ACTIVE_LIST}")
         return
 
-    if not (1 <= item_number <= len(current_items)):
-        await query.edit_message_text(
-            f"Неверный номер элемента (1-{len(current_items)}). Попробуй ещё раз - {Commands.REMOVE_ITEM}"
-        )
+    item_number = await find_item(user.id, current_list_name, item_id)
+    item = None if item_number is None else await read_item(user.id, current_list_name, item_number)
+
+    # The buttons are for active items: tapping one again would remove the item, not cross it out
+    if item is None or item.crossed:
+        # The item was removed or crossed out since the keyboard was shown, offer the current one instead
+        changed = "Элемент уже удалён" if item is None else "Список изменился, элемент уже вычеркнут"
+        info = manifest.get(current_list_name)
+        if not info or info.crossed >= info.items:
+            await query.edit_message_text(f"{changed}, в списке '{current_list_name}' удалять нечего.")
+            return
+        text, reply_markup = await render_remove_keyboard(user.id, current_list_name, info, 0)
+        await query.edit_message_text(f"{changed}.\n{text}", reply_markup=reply_markup)
         return
 
     # Toggle strikethrough or remove item
-    new_items = list(current_items)
-    if "~" not in new_items[item_number - 1]:
-        new_items[item_number - 1] = f"~{new_items[item_number - 1]}~"
-    else:
-        new_items[item_number - 1] = ""
-
-    new_items = [el for el in new_items if el]
+    await toggle_item(user.id, current_list_name, item_number)
 
-    write_list(user.id, current_list_name, new_items)
-
-    # Edit the message to show success
-    await query.edit_message_text(f"✓ Элемент удалён из списка '{current_list_name}'")
-
-    # Show updated list
-    items = read_list(user.id, current_list_name)
-    if not items:
-        await query.message.reply_text(
+    # Show the page of the updated list with the item in place of the removal keyboard
+    rendered = await get_rendered_list(user.id, current_list_name, (item_number - 1) // ITEMS_PER_PAGE)
+    if not rendered:
+        await query.edit_message_text(
             f"Список '{current_list_name}' теперь пуст!\nДобавить элемент - {Commands.ADD_ITEM}"
         )
         return
 
-    message_text_parts = [f"Список '<b>{current_list_name}</b>':"]
-
-    # Check if all items are crossed out
-    all_crossed = all("~" in item for item in items)
-
-    for i, item in enumerate(items, 1):
-        if "~" in item:
-            item = f"<s>{item[1:-1]}</s>"
-        message_text_parts.append(f"{i}. {item}")
-
-    # If all items are crossed out and it's not the default list, show delete button
-    if all_crossed and current_list_name != "default":
-        keyboard = [
-            [InlineKeyboardButton("🗑️ Удалить список и вернуться к default", callback_data="delete_completed_list")],
-            [
-                InlineKeyboardButton("📋 Показать списки", callback_data="show_lists"),
-                InlineKeyboardButton("📝 Показать элементы", callback_data="show_items"),
-            ],
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.message.reply_html(
-            "\n".join(message_text_parts) + f"\n\n✅ Все элементы вычеркнуты!", reply_markup=reply_markup
-        )
-    else:
-        await query.message.reply_html(
-            "\n".join(message_text_parts) + f"\n\n{Commands.ADD_ITEM}  {Commands.REMOVE_ITEM}",
-            reply_markup=get_standard_keyboard(),
-        )
+    await edit_list_message(update, context, rendered)
 
 
 async def standard_keyboard_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -674,17 +1101,13 @@ async def standard_keyboard_callback(update: Update, context: ContextTypes.DEFAU
 
     if callback_data == "show_lists":
         # Show lists
-        all_lists = get_all_list_names(user.id)
+        manifest = await get_lists_manifest(user.id)
         current_list_name = context.user_data.get(CURRENT_LIST_KEY)
 
-        message_parts = ["Ваши списки:"]
-        for i, name in enumerate(all_lists, 1):
-            prefix = "🟢 " if name == current_list_name else "⚪ "
-            message_parts.append(f"{prefix}{i}. {name}")
-
+        text, navigation = render_lists_page(manifest, current_list_name, 0)
         await query.message.reply_text(
-            "\n".join(message_parts) + f"\n\n{Commands.SET_ACTIVE_LIST}  {Commands.DELETE_LIST}  {Commands.HELP}",
-            reply_markup=get_standard_keyboard(),
+            text + f"\n\n{Commands.SET_ACTIVE_LIST}  {Commands.DELETE_LIST}  {Commands.HELP}",
+            reply_markup=lists_keyboard(navigation),
         )
 
     elif callback_data == "show_items":
@@ -698,37 +1121,64 @@ async def standard_keyboard_callback(update: Update, context: ContextTypes.DEFAU
             )
             return
 
-        items = read_list(user.id, current_list_name)
-        if not items:
+        rendered = await get_rendered_list(user.id, current_list_name)
+        if not rendered:
             await query.message.reply_text(f"Список '{current_list_name}' пуст!", reply_markup=get_standard_keyboard())
             return
 
-        message_text_parts = [f"Список '<b>{current_list_name}</b>':"]
-        all_crossed = all("~" in item for item in items)
-
-        for i, item in enumerate(items, 1):
-            if "~" in item:
-                item = f"<s>{item[1:-1]}</s>"
-            message_text_parts.append(f"{i}. {item}")
-
-        # If all items are crossed out and it's not the default list, show delete button
-        if all_crossed and current_list_name != "default":
-            keyboard = [
-                [InlineKeyboardButton("🗑️ Удалить список и вернуться к default", callback_data="delete_completed_list")],
-                [
-                    InlineKeyboardButton("📋 Показать списки", callback_data="show_lists"),
-                    InlineKeyboardButton("📝 Показать элементы", callback_data="show_items"),
-                ],
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.message.reply_html(
-                "\n".join(message_text_parts) + f"\n\n✅ Все элементы вычеркнуты!", reply_markup=reply_markup
-            )
-        else:
-            await query.message.reply_html(
-                "\n".join(message_text_parts) + f"\n\n{Commands.ADD_ITEM}  {Commands.REMOVE_ITEM}",
-                reply_markup=get_standard_keyboard(),
-            )
+        await edit_list_message(update, context, rendered)
+
+
+def lists_keyboard(navigation: list) -> InlineKeyboardMarkup:
+    keyboard = list(get_standard_keyboard().inline_keyboard)
+    if navigation:
+        keyboard.insert(0, navigation)
+    return InlineKeyboardMarkup(keyboard)
+
+
+async def page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Handle previous/next page buttons (format: "<view>_page_N")"""
+    query = update.callback_query
+    user = update.effective_user
+
+    if not query or not user:
+        return
+
+    await query.answer()
+
+    view, _, page = query.data.split("_")
+    page = int(page)
+    manifest = await get_lists_manifest(user.id)
+    current_list_name = context.user_data.get(CURRENT_LIST_KEY)
+
+    if view == "lists":
+        text, navigation = render_lists_page(manifest, current_list_name, page)
+        await query.edit_message_text(
+            text + f"\n\n{Commands.SET_ACTIVE_LIST}  {Commands.DELETE_LIST}  {Commands.HELP}",
+            reply_markup=lists_keyboard(navigation),
+        )
+        return
+    if view == "select":
+        await query.edit_message_reply_markup(render_select_keyboard(manifest, current_list_name, page))
+        return
+
+    if not current_list_name:
+        await query.edit_message_text(f"Error: Не выбран список. Выбрать - {Commands.SET_ACTIVE_LIST}")
+        return
+
+    if view == "items":
+        rendered = await get_rendered_list(user.id, current_list_name, page)
+        if not rendered:
+            await query.edit_message_text(f"Список '{current_list_name}' пуст!\nДобавить элемент - {Commands.ADD_ITEM}")
+            return
+        await edit_list_message(update, context, rendered)
+    elif view == "remove":
+        info = manifest.get(sanitize_filename(current_list_name))
+        if not info or info.items <= 0:
+            await query.edit_message_text(f"Список '{current_list_name}' пуст. Удалять нечего.")
+            return
+        text, reply_markup = await render_remove_keyboard(user.id, current_list_name, info, page)
+        await query.edit_message_text(text, reply_markup=reply_markup)
 
 
 async def delete_completed_list_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -748,31 +1198,20 @@ async def delete_completed_list_callback(update: Update, context: ContextTypes.D
         return
 
     # Delete the list file
-    list_path = get_user_list_path(user.id, current_list_name)
-    if list_path.exists():
+    if await list_exists(user.id, current_list_name):
         try:
-            os.remove(list_path)
+            await delete_list(user.id, current_list_name)
             # Switch to default list
             context.user_data[CURRENT_LIST_KEY] = "default"
-            await query.edit_message_text(f"✓ Список '{current_list_name}' удалён. Выбран список 'default'")
+            notice = f"✓ Список '{current_list_name}' удалён. Выбран список 'default'"
 
-            # Show default list items
-            items = read_list(user.id, "default")
-            if not items:
-                await query.message.reply_text(f"Список 'default' пуст!\nДобавить элемент - {Commands.ADD_ITEM}")
+            # Show default list items in place of the deleted list
+            rendered = await get_rendered_list(user.id, "default")
+            if not rendered:
+                await query.edit_message_text(f"{notice}\n\nСписок 'default' пуст!\nДобавить элемент - {Commands.ADD_ITEM}")
                 return
 
-            message_text_parts = [f"Список '<b>default</b>':"]
-
-            for i, item in enumerate(items, 1):
-                if "~" in item:
-                    item = f"<s>{item[1:-1]}</s>"
-                message_text_parts.append(f"{i}. {item}")
-
-            await query.message.reply_html(
-                "\n".join(message_text_parts) + f"\n\n{Commands.ADD_ITEM}  {Commands.REMOVE_ITEM}",
-                reply_markup=get_standard_keyboard(),
-            )
+            await edit_list_message(update, context, rendered, notice=notice)
         except OSError:
             await query.edit_message_text(f"Ошибка удаления списка '{current_list_name}'")
     else:
@@ -786,8 +1225,100 @@ async def unknown_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         )
 
 
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Admins only: /profile [N] [updates] samples the bot for N seconds or the next N updates"""
+    message = update.message
+    if not message:
+        return
+
+    args = context.args or []
+    by_updates = len(args) > 1 and args[1].lower().startswith("upd")
+    try:
+        amount = int(args[0]) if args else PROFILE_SECONDS
+    except ValueError:
+        amount = 0
+    if amount <= 0 or (not by_updates and amount > MAX_PROFILE_SECONDS):
+        await message.reply_text(f"Использование: /profile [секунд, до {MAX_PROFILE_SECONDS}] или /profile N updates")
+        return
+
+    if by_updates:
+        result = profiler.start(seconds=MAX_PROFILE_SECONDS, updates=amount)
+    else:
+        result = profiler.start(seconds=amount)
+    if result is None:
+        await message.reply_text("Профилирование уже запущено")
+        return
+    await message.reply_text(f"Профилирование запущено: {amount} {'обновлений' if by_updates else 'с'}")
+
+    async def report() -> None:
+        path, samples = await result
+        if path is None:
+            await message.reply_text("Ошибка записи профиля, подробности в логе")
+        else:
+            await message.reply_text(f"Профиль готов: {path} ({samples} сэмплов)")
+
+    context.application.create_task(report())
+
+
+async def backup_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Admins only: write a tarball of all lists to BACKUP_DIR in the background.
+
+    With worker processes every worker gets the command (see ``is_backup_command``) and copies its own users into
+    a part of the backup, unless the storage copies everything at once.
+    """
+    message = update.message
+    if not message:
+        return
+    shard, shards = context.bot_data.get("shard", (0, 1))
+    if storage.backend.backs_up_at_once:
+        if shard:
+            return
+        shards = 1
+    running = context.bot_data.get("backup_task")
+    if running is not None and not running.done():
+        await message.reply_text("Резервная копия уже создаётся")
+        return
+
+    # The time the command was sent, so all parts of a backup get the same one
+    stamp = message.date.astimezone().strftime("%Y%m%d-%H%M%S")
+    part = f"-{shard + 1}-of-{shards}" if shards > 1 else ""
+    path = BACKUP_DIR / f"backup-{stamp}{part}.tar.gz"
+    await message.reply_text(f"Создаю резервную копию: {path}")
+
+    async def report() -> None:
+        started = time.monotonic()
+        try:
+            await write_backup(storage, path, context.application.run_for, shard, shards)
+        except Exception:
+            logger.exception("Backup to %s failed", path)
+            text = "Ошибка резервного копирования, подробности в логе"
+        else:
+            text = f"Резервная копия готова: {path} ({path.stat().st_size} байт, {time.monotonic() - started:.1f} с)"
+        # Not a reply to anything the admin is waiting on right now
+        try:
+            await context.bot.send_message(message.chat_id, text, **background_priority(context.bot))
+        except SendQueueFull:
+            logger.warning("Dropped the report of the backup to %s, the send queue is full", path)
+
+    context.bot_data["backup_task"] = context.application.create_task(report())
+
+
+def is_backup_command(update: Update) -> bool:
+    """/backup of an admin, which the ingress passes on to every worker"""
+    message = update.message
+    if not message or not message.text or not message.from_user or message.from_user.id not in ADMIN_USER_IDS:
+        return False
+    return message.text.split()[0].split("@")[0] == "/backup"
+
+
+def profile_on_signal() -> None:
+    if profiler.start(seconds=PROFILE_SECONDS) is None:
+        logger.warning("Profiling is already running")
+
+
 async def post_init_tasks(application: Application) -> None:
     """Tasks to run after the bot is initialized but before polling starts."""
+    startup_timer.mark("initialize")
     bot_commands = [
         BotCommand("start", "Start the bot & see help"),
         BotCommand(Commands.HELP, "Show help message"),
@@ -798,25 +1329,127 @@ async def post_init_tasks(application: Application) -> None:
         BotCommand(Commands.ADD_ITEM, "Add an item to the current list"),
         BotCommand(Commands.SHOW_ITEMS, "Show items in the current list"),
         BotCommand(Commands.REMOVE_ITEM, "Remove item from current list"),
+        BotCommand(Commands.FIND, "Find an item in all your lists"),
+        BotCommand(Commands.EXPORT, "Save all your lists to a file"),
+        BotCommand(Commands.IMPORT, "Load lists from an exported file"),
         BotCommand(Commands.CANCEL, "Cancel operation"),
     ]
     await application.bot.set_my_commands(bot_commands)
     logger.info("Bot commands have been set")
+    await start_diagnostics(application, METRICS_PORT)
+    if DELIVERY_MODE == "webhook":
+        startup_timer.finish("post_init")
+    else:
+        startup_timer.mark("post_init")
 
 
-def main() -> None:
-    if not TELEGRAM_BOT_TOKEN or TELEGRAM_BOT_TOKEN == "YOUR_TELEGRAM_BOT_TOKEN":
-        logger.error("ERROR: TELEGRAM_BOT_TOKEN not set")
-        return
+async def start_diagnostics(application: Application, metrics_port: int) -> None:
+    """Metrics endpoint and the profiling signal of this process"""
+    if metrics is not None and metrics_port:
+        application.bot_data["metrics_server"] = await metrics.serve(METRICS_LISTEN, metrics_port)
+    try:
+        # kill -USR1 <pid> profiles for PROFILE_SECONDS
+        asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, profile_on_signal)
+    except (AttributeError, NotImplementedError):
+        # No SIGUSR1 on Windows
+        pass
+
+
+async def post_shutdown_tasks(application: Application) -> None:
+    await histories.flush()
+    await storage.flush()
+    server = application.bot_data.pop("metrics_server", None)
+    if server is not None:
+        server.close()
+        await server.wait_closed()
+
+
+def forget_user_caches(user_id: int, list_names: list[str]) -> None:
+    """Drop what the handlers keep in memory for a user that went idle, see Maintenance"""
+    for list_name in list_names:
+        render_cache.discard(user_id, list_name)
+        item_indexes.discard(user_id, list_name)
+    histories.discard(user_id)
+
+
+def build_requests(http_version: str) -> tuple[HTTPXRequest, HTTPXRequest]:
+    """Requests for Bot API calls and for getUpdates, sending the first getUpdates ends the startup report"""
+    if metrics is not None:
+        # Same settings as the requests ApplicationBuilder would create, but timed per API method
+        request = InstrumentedRequest(metrics, connection_pool_size=256, http_version=http_version)
+        get_updates_request = InstrumentedRequest(metrics, http_version=http_version)
+    else:
+        request = HTTPXRequest(connection_pool_size=256, http_version=http_version)
+        get_updates_request = HTTPXRequest(http_version=http_version)
+    return request, startup_timer.finish_on_first_request(get_updates_request, "first getUpdates")
+
+
+def snapshot_path(index: int = 0, count: int = 1) -> Path:
+    """Snapshot of the process serving the given shard of users, see AsyncStorage.open_snapshot"""
+    return USER_DATA_BASE_DIR / (".snapshot" if count == 1 else f".snapshot-{index}-of-{count}")
 
-    USER_DATA_BASE_DIR.mkdir(parents=True, exist_ok=True)
 
-    application = (
+def build_application(token: str, base_url: str | None = None, shard: int = 0, shards: int = 1) -> Application:
+    """Application with all handlers; base_url points the bot to another Bot API server.
+
+    The maintenance job of the application only goes over the users of the given shard, and its
+    sends are limited to its share of the rate limits.
+    """
+    builder = (
         ApplicationBuilder()
-        .token(TELEGRAM_BOT_TOKEN)
+        .token(token)
         .post_init(post_init_tasks)  # Add post_init hook
-        .build()
+        .post_shutdown(post_shutdown_tasks)
+        .persistence(UserStatePersistence(storage, (CURRENT_LIST_KEY, LIST_TO_DELETE_KEY), PERSISTENCE_INTERVAL))
+    )
+    # Self-hosted Bot API servers speak HTTP/1.1 only
+    http_version = "1.1" if base_url else "2"
+    if base_url:
+        builder = builder.base_url(base_url)
+    request, get_updates_request = build_requests(http_version)
+    builder = builder.request(request).get_updates_request(get_updates_request)
+    if RATE_LIMIT_GLOBAL:
+        # Worker processes send on their own, so each gets its share of the bot's limit and of the limit of
+        # group chats, whose members may be served by different workers; a private chat has one worker
+        builder = builder.rate_limiter(
+            PriorityRateLimiter(
+                global_rate=RATE_LIMIT_GLOBAL / shards,
+                chat_rate=RATE_LIMIT_PER_CHAT,
+                group_rate=GROUP_CHAT_RATE / shards,
+                burst=RATE_LIMIT_BURST,
+                max_queued=SEND_MAX_QUEUED,
+            )
+        )
+    # Different users are served in parallel, updates of one user and maintenance of their lists stay in order
+    builder = builder.application_class(
+        UserOrderedApplication,
+        {"max_concurrency": max(1, CONCURRENT_UPDATES), "max_pending": MAX_PENDING_UPDATES},
     )
+    if DELIVERY_MODE == "webhook":
+        # Bounded, so a burst of webhook requests pushes back on Telegram instead of piling up here
+        builder = builder.update_queue(asyncio.Queue(maxsize=WEBHOOK_MAX_QUEUED))
+    elif WORKER_PROCESSES > 1:
+        # A worker takes updates from the ingress only as fast as it handles them
+        builder = builder.update_queue(asyncio.Queue(maxsize=MAX_PENDING_UPDATES))
+    application = builder.build()
+    application.bot_data["shard"] = (shard, shards)
+    if MAINTENANCE_INTERVAL:
+        if application.job_queue is None:
+            logger.warning("Maintenance is off, it needs python-telegram-bot[job-queue]")
+        else:
+            maintenance = Maintenance(
+                storage,
+                purge_after=PURGE_CROSSED_AFTER_DAYS * 24 * 3600,
+                idle_after=IDLE_EVICT_SECONDS,
+                slice_seconds=MAINTENANCE_SLICE_SECONDS,
+                shard=shard,
+                shards=shards,
+                on_evict=forget_user_caches,
+                on_purge=keep_in_history,
+            )
+            application.job_queue.run_repeating(
+                maintenance.job, interval=MAINTENANCE_INTERVAL, first=MAINTENANCE_INTERVAL, name="maintenance"
+            )
 
     cancel_handler = CommandHandler(Commands.CANCEL[1:], cancel_conversation)
 
@@ -830,7 +1463,7 @@ def main() -> None:
     )
     # Select list now uses inline keyboard buttons with callback handler
     selectlist_handler = CommandHandler(Commands.SET_ACTIVE_LIST[1:], selectlist_entry)
-    selectlist_callback_handler = CallbackQueryHandler(selectlist_callback, pattern="^select_")
+    selectlist_callback_handler = CallbackQueryHandler(selectlist_callback, pattern=r"^select_[0-9a-z-]+$")
     deletelist_conv = ConversationHandler(
         entry_points=[CommandHandler(Commands.DELETE_LIST[1:], deletelist_entry)],
         states={
@@ -846,15 +1479,24 @@ def main() -> None:
         fallbacks=[cancel_handler],
         conversation_timeout=DEFAULT_TIMEOUT,
     )
+    import_conv = ConversationHandler(
+        entry_points=[CommandHandler(Commands.IMPORT[1:], import_entry)],
+        states={AWAITING_FILE_FOR_IMPORT: [MessageHandler(filters.Document.ALL, import_receive_file)]},
+        fallbacks=[cancel_handler],
+        conversation_timeout=IMPORT_TIMEOUT,
+    )
     # Remove item now uses inline keyboard buttons with callback handler
     remove_item_handler = CommandHandler(Commands.REMOVE_ITEM[1:], remove_item_entry)
-    remove_item_callback_handler = CallbackQueryHandler(remove_item_callback, pattern="^remove_")
+    remove_item_callback_handler = CallbackQueryHandler(remove_item_callback, pattern=r"^remove_[0-9a-z-]+\.[0-9a-z]+$")
 
     # Delete completed list callback handler
     delete_completed_callback_handler = CallbackQueryHandler(
         delete_completed_list_callback, pattern="^delete_completed_list$"
     )
 
+    # Previous/next page buttons of paginated views
+    page_handler = CallbackQueryHandler(page_callback, pattern=r"^(items|remove|select|lists)_page_\d+$")
+
     # Standard keyboard callback handler
     standard_keyboard_handler = CallbackQueryHandler(standard_keyboard_callback, pattern="^(show_lists|show_items)$")
 
@@ -862,22 +1504,126 @@ def main() -> None:
     application.add_handler(CommandHandler(Commands.HELP[1:], help_command))
     application.add_handler(CommandHandler(Commands.SHOW_LISTS[1:], lists_command))
     application.add_handler(CommandHandler(Commands.SHOW_ITEMS[1:], list_items_command))
+    application.add_handler(CommandHandler(Commands.FIND[1:], find_command))
+    application.add_handler(CommandHandler(Commands.EXPORT[1:], export_command))
+    # Needs inline mode switched on with @BotFather (/setinline)
+    application.add_handler(InlineQueryHandler(inline_query_callback))
 
     application.add_handler(createlist_conv)
     application.add_handler(selectlist_handler)
     application.add_handler(selectlist_callback_handler)
     application.add_handler(deletelist_conv)
     application.add_handler(add_item_conv)
+    application.add_handler(import_conv)
     application.add_handler(remove_item_handler)
     application.add_handler(remove_item_callback_handler)
     application.add_handler(delete_completed_callback_handler)
     application.add_handler(standard_keyboard_handler)
+    application.add_handler(page_handler)
+
+    application.add_handler(CommandHandler("profile", profile_command, filters=filters.User(user_id=ADMIN_USER_IDS)))
+    application.add_handler(CommandHandler("backup", backup_command, filters=filters.User(user_id=ADMIN_USER_IDS)))
 
     application.add_handler(MessageHandler(filters.COMMAND, unknown_command))
+    if metrics is not None:
+        metrics.instrument(application, STATE_NAMES)
+    profiler.register(application, STATE_NAMES)
+    startup_timer.mark("application")
+    return application
+
+
+def build_router(token: str, pool: WorkerPool) -> Application:
+    """Application of the ingress process, it receives updates and hands them to the worker pool"""
+    builder = (
+        ApplicationBuilder()
+        .token(token)
+        .post_init(post_init_tasks)
+        .post_shutdown(post_shutdown_tasks)
+        .application_class(ShardRouter, {"pool": pool, "broadcast": is_backup_command})
+    )
+    request, get_updates_request = build_requests("2")
+    builder = builder.request(request).get_updates_request(get_updates_request)
+    if DELIVERY_MODE == "webhook":
+        builder = builder.update_queue(asyncio.Queue(maxsize=WEBHOOK_MAX_QUEUED))
+    application = builder.build()
+    startup_timer.mark("application")
+    return application
+
+
+def run_worker(index: int, count: int, updates, generation: bytes | None, next_generation: bytes) -> None:
+    """Entry point of a worker process, handles the users with user_id % count == index.
+
+    The snapshot is opened if it is of ``generation`` and written as ``next_generation``.
+    """
+    # Ctrl+C reaches the whole process group, workers stop when the ingress tells them to
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    storage.open_snapshot(snapshot_path(index, count), generation)
+    startup_timer.mark("snapshot")
+    application = build_application(TELEGRAM_BOT_TOKEN, shard=index, shards=count)
+    metrics_port = METRICS_PORT + 1 + index if METRICS_PORT else 0
+
+    async def post_init(application: Application) -> None:
+        await start_diagnostics(application, metrics_port)
+        startup_timer.finish("post_init")
+
+    asyncio.run(serve_worker(application, updates, post_init))
+    logger.info("Worker %s storage stats: %s", index, storage.stats())
+    storage.write_snapshot(snapshot_path(index, count), next_generation)
+    storage.close()
+
+
+def main() -> None:
+    if not TELEGRAM_BOT_TOKEN or TELEGRAM_BOT_TOKEN == "YOUR_TELEGRAM_BOT_TOKEN":
+        logger.error("ERROR: TELEGRAM_BOT_TOKEN not set")
+        return
+    if DELIVERY_MODE == "webhook" and not WEBHOOK_URL:
+        logger.error("ERROR: WEBHOOK_URL not set")
+        return
+
+    USER_DATA_BASE_DIR.mkdir(parents=True, exist_ok=True)
+    # Snapshots of another number of worker processes would be trusted again when it changes back
+    shards = max(1, WORKER_PROCESSES)
+    remove_stale_snapshots(USER_DATA_BASE_DIR, (snapshot_path(index, shards) for index in range(shards)))
+    generation = take_generation(USER_DATA_BASE_DIR)
+    next_generation = new_generation()
+    pool = None
+    if WORKER_PROCESSES > 1:
+        # Users are sharded over the workers by id, each user's lists are only touched by one process
+        target = functools.partial(run_worker, generation=generation, next_generation=next_generation)
+        pool = WorkerPool(target, WORKER_PROCESSES, MAX_PENDING_UPDATES)
+        pool.start()
+        application = build_router(TELEGRAM_BOT_TOKEN, pool)
+    else:
+        storage.open_snapshot(snapshot_path(), generation)
+        startup_timer.mark("snapshot")
+        application = build_application(TELEGRAM_BOT_TOKEN)
 
     print("Bot starting...")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    if DELIVERY_MODE == "webhook":
+        asyncio.run(
+            serve_webhook(
+                application,
+                WEBHOOK_URL,
+                WEBHOOK_LISTEN,
+                WEBHOOK_PORT,
+                WEBHOOK_PATH,
+                WEBHOOK_SECRET_TOKEN,
+            )
+        )
+    else:
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
+    if pool is not None:
+        pool.stop()
+        logger.info("Worker pool stats: %s", pool.stats())
     print("Bot stopped.")
+    logger.info("Storage stats: %s", storage.stats())
+    logger.info("Render cache stats: %s", render_cache.stats())
+    if application.bot.rate_limiter:
+        logger.info("Send queue stats: %s", application.bot.rate_limiter.stats())
+    if pool is None:
+        storage.write_snapshot(snapshot_path(), next_generation)
+    storage.close()
+    save_generation(USER_DATA_BASE_DIR, next_generation)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,112 @@
+import sys
+from collections import OrderedDict
+
+from items import Item
+
+
+def estimate_size(items: list[Item]) -> int:
+    """Rough memory footprint of a cached list in bytes"""
+    return sys.getsizeof(items) + sum(sys.getsizeof(item) for item in items)
+
+
+class ListCache:
+    """LRU cache of parsed purchase lists keyed by (user_id, list_name).
+
+    The cache is bounded by the approximate memory used by the cached lists,
+    least recently used entries are evicted first. Only lists that exist on
+    disk are cached, so a cache hit also means the list file exists.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict[tuple[int, str], tuple[list[Item], int]] = OrderedDict()
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, key: tuple[int, str]) -> bool:
+        return key in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, user_id: int, list_name: str) -> list[Item] | None:
+        key = (user_id, list_name)
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        # Callers are free to mutate the returned list
+        return list(entry[0])
+
+    def put(self, user_id: int, list_name: str, items: list[Item]) -> None:
+        key = (user_id, list_name)
+        self.discard(user_id, list_name)
+        items = list(items)
+        size = estimate_size(items)
+        if size > self.max_bytes:
+            return
+        self._entries[key] = (items, size)
+        self._size += size
+        while self._size > self.max_bytes:
+            _, (_, evicted_size) = self._entries.popitem(last=False)
+            self._size -= evicted_size
+            self.evictions += 1
+
+    def discard(self, user_id: int, list_name: str) -> None:
+        entry = self._entries.pop((user_id, list_name), None)
+        if entry is not None:
+            self._size -= entry[1]
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._size = 0
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "bytes": self._size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+class VersionedCache:
+    """LRU of values derived from a list, valid only for the list version they were built from"""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries: OrderedDict[tuple[int, str], tuple[int, object]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, user_id: int, list_name: str, version: int):
+        key = (user_id, list_name)
+        entry = self._entries.get(key)
+        if entry is None or entry[0] != version:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, user_id: int, list_name: str, version: int, value) -> None:
+        key = (user_id, list_name)
+        self._entries[key] = (version, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def discard(self, user_id: int, list_name: str) -> None:
+        self._entries.pop((user_id, list_name), None)
+
+    def stats(self) -> dict:
+        return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
@@ -1,5 +1,78 @@
 TOKEN = open("TOKEN").read().strip()
 
+# Upper bound for the in-memory cache of parsed purchase lists
+LIST_CACHE_MAX_BYTES = 16 * 1024 * 1024
+# How many users' list manifests (names and counters) are kept in memory
+MANIFEST_CACHE_USERS = 10000
+# How many rendered list messages are kept for repeated views
+RENDER_CACHE_ENTRIES = 5000
+# Long lists are shown in pages; only the shown page is read and rendered
+ITEMS_PER_PAGE = 25
+LISTS_PER_PAGE = 20
+
+# Where purchase lists are kept: "files" (one .txt per list) or "sqlite"
+STORAGE_BACKEND = "files"
+SQLITE_PATH = "user_purchase_lists/lists.sqlite3"
+
+# Storage calls run in a thread pool off the event loop
+STORAGE_WORKERS = 8
+STORAGE_MAX_QUEUED = 256
+
+# Seconds between saves of changed user state (active list), also saved on shutdown
+PERSISTENCE_INTERVAL = 30
+
+# How updates are received: "polling" or "webhook" (embedded HTTP server, needs WEBHOOK_URL)
+DELIVERY_MODE = "polling"
+WEBHOOK_URL = ""
+WEBHOOK_PATH = "/telegram"
+WEBHOOK_LISTEN = "0.0.0.0"
+WEBHOOK_PORT = 8443
+# Random token per start if not set
+WEBHOOK_SECRET_TOKEN = None
+WEBHOOK_MAX_QUEUED = 1024
+
+# How many updates of different users may be handled at the same time (1 handles them one by one)
+CONCURRENT_UPDATES = 32
+MAX_PENDING_UPDATES = 1024
+# Worker processes handling updates, users are assigned to them by user_id % WORKER_PROCESSES
+# and this process only receives and routes updates (1 handles everything in this process)
+WORKER_PROCESSES = 1
+
+# Outgoing messages per second overall and per private chat (group chats: 20 per minute),
+# a chat may send RATE_LIMIT_BURST messages at once before being throttled (RATE_LIMIT_GLOBAL = 0 disables)
+# With WORKER_PROCESSES > 1 each worker sends at most its share of RATE_LIMIT_GLOBAL and of the group chat limit
+RATE_LIMIT_GLOBAL = 30
+RATE_LIMIT_PER_CHAT = 1
+RATE_LIMIT_BURST = 3
+# Background messages are dropped once this many messages wait to be sent
+SEND_MAX_QUEUED = 1024
+
+# Prometheus metrics (handler, storage and Bot API latencies) on http://METRICS_LISTEN:METRICS_PORT/metrics (0 disables)
+METRICS_LISTEN = "127.0.0.1"
+METRICS_PORT = 9090
+
+# How many distinct added items per user are remembered for inline suggestions (@bot <text>)
+HISTORY_MAX_ITEMS = 1000
+
+# Every MAINTENANCE_INTERVAL seconds a background job spends up to MAINTENANCE_SLICE_SECONDS on
+# removing items crossed out more than PURGE_CROSSED_AFTER_DAYS ago (0 keeps them), compacting list
+# files and dropping what is kept in memory for users idle for IDLE_EVICT_SECONDS (0 keeps it);
+# each user is visited once a day (MAINTENANCE_INTERVAL = 0 disables the job)
+MAINTENANCE_INTERVAL = 10
+MAINTENANCE_SLICE_SECONDS = 0.1
+PURGE_CROSSED_AFTER_DAYS = 30
+IDLE_EVICT_SECONDS = 3600
+
+# Telegram user ids allowed to use admin commands (/profile, /backup)
+ADMIN_USER_IDS = []
+# /profile and SIGUSR1 write collapsed stacks for flamegraphs here, SIGUSR1 profiles for PROFILE_SECONDS
+PROFILE_DIR = "profiles"
+PROFILE_SECONDS = 30
+# /backup writes backup-<time>.tar.gz here; extract it into user_purchase_lists to restore. With
+# WORKER_PROCESSES > 1 and file storage every worker writes the part with its own users,
+# backup-<time>-<n>-of-<count>.tar.gz; extract all parts of a backup
+BACKUP_DIR = "backups"
+
 locales = {
     "ru": {},
     "en": {}
@@ -0,0 +1 @@
+# Lets the tests import the bot's modules, which live at the top level of the repository
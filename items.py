@@ -0,0 +1,216 @@
+import bisect
+import hashlib
+import json
+import re
+import sys
+import time
+import zlib
+
+
+class Item:
+    """One entry of a purchase list: its text, whether it is crossed out and when it last changed.
+
+    Items are treated as immutable, changes create a new Item, so lists can
+    be shallow-copied between the cache and the handlers.
+    """
+
+    __slots__ = ("text", "crossed", "ts")
+
+    def __init__(self, text: str, crossed: bool = False, ts: int | None = None):
+        self.text = text
+        self.crossed = crossed
+        self.ts = int(time.time()) if ts is None else ts
+
+    def __repr__(self) -> str:
+        return f"Item({self.text!r}, crossed={self.crossed})"
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, Item):
+            return NotImplemented
+        return (self.text, self.crossed, self.ts) == (other.text, other.crossed, other.ts)
+
+    def __sizeof__(self) -> int:
+        return object.__sizeof__(self) + sys.getsizeof(self.text)
+
+    def to_json(self) -> str:
+        return json.dumps([self.text, int(self.crossed), self.ts], ensure_ascii=False, separators=(",", ":"))
+
+    @classmethod
+    def from_json(cls, line: str) -> "Item":
+        text, crossed, ts = json.loads(line)
+        return cls(text, bool(crossed), ts)
+
+    @classmethod
+    def from_legacy(cls, line: str, ts: int = 0) -> "Item":
+        """Parse a line of the old plain text format, where crossed items were wrapped in '~'"""
+        if len(line) >= 2 and line.startswith("~") and line.endswith("~"):
+            return cls(line[1:-1], True, ts)
+        return cls(line, False, ts)
+
+    def crossed_out(self, ts: int | None = None) -> "Item":
+        return Item(self.text, True, ts)
+
+
+# Items are separated by line breaks, semicolons, two or more spaces, or commas
+# other than decimal ones ("молоко 3,2%")
+ITEM_SEPARATOR = re.compile(r"[\n;]|\s{2,}|,(?!\d)|(?<!\d),")
+# List markers pasted along with notes: "- ", "• ", "1. ", "2) ", checkboxes
+LIST_MARKER = re.compile(r"^(?:[-*•·▪–—☐☑✓✔]+|\d+[.)])\s+")
+WHITESPACE = re.compile(r"\s+")
+# "молоко x2", "молоко х 2", "молоко ×2", "яйца 10 шт" and "2x молоко"; "плитка 5х5" has no quantity
+QUANTITY_SUFFIX = re.compile(r"^(.+?)(?:\s+[xх×*]\s*(\d{1,4})|\s*(\d{1,4})\s*(?:шт|pcs)\.?)$", re.IGNORECASE)
+QUANTITY_PREFIX = re.compile(r"^(\d{1,4})\s*[xх×*]\s+(.+)$", re.IGNORECASE)
+
+
+def parse_items(text: str) -> list[str]:
+    """Split pasted text into item texts: lowercased, without list markers and extra spaces"""
+    items = []
+    for part in ITEM_SEPARATOR.split(text):
+        part = WHITESPACE.sub(" ", LIST_MARKER.sub("", part.strip())).strip().lower()
+        if part:
+            items.append(part)
+    return items
+
+
+def split_quantity(text: str) -> tuple[str, int]:
+    """Item text without its quantity, and the quantity (1 if none is given)"""
+    match = QUANTITY_SUFFIX.match(text)
+    if match:
+        name, quantity = match.group(1), int(match.group(2) or match.group(3))
+    else:
+        match = QUANTITY_PREFIX.match(text)
+        if not match:
+            return text, 1
+        quantity, name = int(match.group(1)), match.group(2)
+    return (name, quantity) if quantity > 0 else (text, 1)
+
+
+def with_quantity(name: str, quantity: int) -> str:
+    return f"{name} x{quantity}" if quantity > 1 else name
+
+
+def normalize_item(text: str) -> tuple[str, int]:
+    """Key under which equal items match regardless of case, spacing, 'ё' and quantity; and the quantity"""
+    name, quantity = split_quantity(text.strip())
+    return WHITESPACE.sub(" ", name).strip().casefold().replace("ё", "е"), quantity
+
+
+def merge_quantity(text: str, added_text: str) -> str:
+    """Text of an item after an equal item was added to it: 'молоко x2' + 'молоко' -> 'молоко x3'"""
+    name, quantity = split_quantity(text)
+    return with_quantity(name, quantity + normalize_item(added_text)[1])
+
+
+class DedupeIndex:
+    """Positions and texts of the active items of a list by normalized text (see ``normalize_item``).
+
+    Answers "is this item already on the list" in O(1). The index is kept in
+    step with the list by the ``appended``/``replaced``/``toggled`` calls
+    made along with the list's changes. Equal active items can be on a list
+    (added before it was indexed, or imported), so every one of them is
+    kept: crossing out the first leaves the next one to be found.
+    """
+
+    __slots__ = ("_entries",)
+
+    def __init__(self, items: list[Item] = ()):
+        # Sorted by position
+        self._entries: dict[str, list[tuple[int, str]]] = {}
+        self.appended(0, items)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: str) -> tuple[int, str] | None:
+        """Position and text of the first active item with the key"""
+        entries = self._entries.get(key)
+        return entries[0] if entries else None
+
+    def appended(self, start: int, items: list[Item]) -> None:
+        for position, item in enumerate(items, start):
+            if not item.crossed:
+                self._entries.setdefault(normalize_item(item.text)[0], []).append((position, item.text))
+
+    def replaced(self, position: int, item: Item) -> None:
+        entries = self._entries.setdefault(normalize_item(item.text)[0], [])
+        at = bisect.bisect_left(entries, (position,))
+        if at < len(entries) and entries[at][0] == position:
+            entries[at] = (position, item.text)
+        else:
+            entries.insert(at, (position, item.text))
+
+    def toggled(self, position: int, item: Item) -> None:
+        """The item at the position was crossed out, or removed if ``item`` (its previous state) was crossed"""
+        if not item.crossed:
+            key = normalize_item(item.text)[0]
+            entries = self._entries.get(key, [])
+            at = bisect.bisect_left(entries, (position,))
+            if at < len(entries) and entries[at][0] == position:
+                del entries[at]
+                if not entries:
+                    del self._entries[key]
+            return
+        for entries in self._entries.values():
+            if entries[-1][0] > position:
+                entries[:] = [(other - 1 if other > position else other, text) for other, text in entries]
+
+
+def toggle_items(items: list[Item], index: int, ts: int | None = None) -> list[Item]:
+    """Cross out an active item or drop an already crossed one"""
+    new_items = list(items)
+    if not new_items[index].crossed:
+        new_items[index] = new_items[index].crossed_out(ts)
+    else:
+        del new_items[index]
+    return new_items
+
+
+def short_id(text: str) -> str:
+    """Compact id derived from a string (base36 CRC32, at most 7 characters) for callback data"""
+    return _base36(zlib.crc32(text.encode("utf-8")))
+
+
+def _base36(value: int) -> str:
+    digits = ""
+    while True:
+        value, digit = divmod(value, 36)
+        digits = "0123456789abcdefghijklmnopqrstuvwxyz"[digit] + digits
+        if not value:
+            return digits
+
+
+def item_id(text: str) -> str:
+    """Id of an item for callback data, equal items (see ``normalize_item``) share it.
+
+    A 64-bit hash (at most 13 characters): a list can hold far more items
+    than a user has lists, and CRC32 ids of different items would collide.
+    """
+    return _key_id(normalize_item(text)[0])
+
+
+def _key_id(key: str) -> str:
+    digest = hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest()
+    return _base36(int.from_bytes(digest, "big"))
+
+
+def build_item_index(items: list[Item]) -> dict[str, int]:
+    """Map the ids of items to their positions.
+
+    The id doesn't change when an item is crossed out, its quantity changes
+    or other items move. Of several equal items the first active one is chosen.
+    Ids shared by different items are left out, so a button never acts on
+    an item other than the one it was shown for.
+    """
+    index: dict[str, int] = {}
+    keys: dict[str, str] = {}
+    collisions = set()
+    for position, item in enumerate(items):
+        key = normalize_item(item.text)[0]
+        text_id = _key_id(key)
+        if keys.setdefault(text_id, key) != key:
+            collisions.add(text_id)
+        if text_id not in index or (items[index[text_id]].crossed and not item.crossed):
+            index[text_id] = position
+    for text_id in collisions:
+        del index[text_id]
+    return index
@@ -0,0 +1,349 @@
+import bisect
+import json
+import os
+from itertools import chain, islice
+from pathlib import Path
+from typing import BinaryIO, Iterable, Iterator
+
+from items import Item, toggle_items
+
+# First line of a list snapshot, bumped when the item line layout changes
+FORMAT_HEADER = json.dumps({"format": 2})
+
+
+def fsync_dir(path: Path) -> None:
+    """Make a rename inside the directory durable (no-op where unsupported)"""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def atomic_write_lines(path: Path, lines) -> None:
+    """Write lines to a temp file and rename it over the target"""
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        for line in lines:
+            f.write(f"{line}\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    fsync_dir(path.parent)
+
+
+def apply_record(items: list[Item], record: list) -> list[Item]:
+    """Replay one journal record, records written before items had timestamps lack the last field"""
+    op, arg, *rest = record
+    if op == "s":
+        text, ts = rest
+        if 0 <= arg < len(items):
+            items[arg] = Item(text, items[arg].crossed, ts)
+        return items
+    ts = rest[0] if rest else 0
+    if op == "+":
+        items.append(Item(arg, len(rest) > 1 and bool(rest[1]), ts))
+    elif op == "t" and 0 <= arg < len(items):
+        items = toggle_items(items, arg, ts)
+    return items
+
+
+def read_legacy_list(path: Path) -> list[Item]:
+    """Items of a list in the format used before item records: one text per line, crossed ones wrapped in '~'"""
+    ts = int(os.stat(path).st_mtime)
+    with open(path, "r", encoding="utf-8") as f:
+        items = [Item.from_legacy(line.strip(), ts) for line in f if line.strip()]
+    # The legacy journal uses the same record layout and snapshot header
+    for record in ListJournal(path)._read_records():
+        items = apply_record(items, record)
+    return items
+
+
+class ListJournal:
+    """Snapshot file plus an append-only journal of changes made since it was taken.
+
+    The snapshot starts with a format header followed by one JSON item per
+    line (``[text, crossed, timestamp]``) and is only ever replaced
+    atomically. Every change is appended to the journal as one JSON record:
+    ``["+", text, ts]`` adds an item (``["+", text, ts, 1]`` a crossed out
+    one), ``["t", index, ts]`` crosses out an
+    active item or removes a crossed one, ``["s", index, text, ts]``
+    changes the text of an item (merged quantities). The first journal line identifies
+    the snapshot it applies to, so a journal left behind by a crash in the
+    middle of compaction is recognized as stale and dropped instead of being
+    replayed twice. Once the journal outgrows the snapshot it is folded into
+    a new snapshot, which keeps compaction cost amortized O(1) per change.
+
+    Next to the snapshot an index holds the number of items and the byte
+    offset of every ``index_stride``-th item, so a slice of a list is read by
+    seeking to it instead of parsing the whole file; pending journal records
+    are replayed over it, reading only the items they touch (see
+    ``_Replay``). Whole lists are read page by page and compacted the same
+    way, holding only the replayed records in memory.
+    """
+
+    compact_min_bytes = 4096
+    index_stride = 64
+
+    def __init__(self, snapshot_path: Path):
+        self.snapshot_path = snapshot_path
+        self.journal_path = snapshot_path.with_suffix(".log")
+        self.index_path = snapshot_path.with_suffix(".idx")
+
+    def _header(self) -> str | None:
+        try:
+            st = os.stat(self.snapshot_path)
+        except FileNotFoundError:
+            return None
+        return json.dumps({"snapshot": [st.st_ino, st.st_mtime_ns]})
+
+    def _read_index(self) -> tuple[list[int], int] | None:
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                header, offsets, count = f.read().split("\n")[:3]
+        except (FileNotFoundError, ValueError):
+            return None
+        if header != self._header():
+            return None
+        try:
+            return json.loads(offsets), int(count)
+        except ValueError:
+            return None
+
+    def _build_index(self) -> tuple[list[int], int]:
+        """Offsets of every index_stride-th item line of the snapshot and the number of items, saved for later reads"""
+        offsets = []
+        count = 0
+        with open(self.snapshot_path, "rb") as f:
+            position = len(f.readline())
+            for line in f:
+                if line.strip():
+                    if count % self.index_stride == 0:
+                        offsets.append(position)
+                    count += 1
+                position += len(line)
+        atomic_write_lines(self.index_path, [self._header(), json.dumps(offsets), count])
+        return offsets, count
+
+    def _lines_from(self, f: BinaryIO, offsets: list[int], position: int) -> Iterator[bytes]:
+        """Item lines of the snapshot from the one at the position on"""
+        f.seek(offsets[position // self.index_stride])
+        skip = position % self.index_stride
+        for line in f:
+            if not line.strip():
+                continue
+            if skip:
+                skip -= 1
+                continue
+            yield line
+
+    def _read_snapshot(self) -> list[Item]:
+        if not self.snapshot_path.exists():
+            return []
+        with open(self.snapshot_path, "r", encoding="utf-8") as f:
+            header = f.readline().strip()
+            if header != FORMAT_HEADER:
+                raise ValueError(f"Unsupported list file format in {self.snapshot_path}: {header[:40]!r}")
+            return [Item.from_json(line) for line in f if line.strip()]
+
+    def _read_records(self) -> list:
+        try:
+            with open(self.journal_path, "r", encoding="utf-8") as f:
+                lines = f.read().split("\n")
+        except FileNotFoundError:
+            return []
+        if lines[0] != self._header():
+            return []
+        records = []
+        for line in lines[1:]:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                # A record torn by a crash, later records start on a new line
+                continue
+        return records
+
+    def exists(self) -> bool:
+        return self.snapshot_path.exists()
+
+    def read(self) -> list[Item]:
+        items = self._read_snapshot()
+        for record in self._read_records():
+            items = apply_record(items, record)
+        return items
+
+    def _replay(self, f: BinaryIO) -> "_Replay":
+        """The journal replayed over the open snapshot"""
+        replay = _Replay(self, f, *(self._read_index() or self._build_index()))
+        for record in self._read_records():
+            replay.apply(record)
+        return replay
+
+    def read_slice(self, start: int, stop: int) -> list[Item]:
+        """Items start..stop-1, read from the snapshot through the index with the journal replayed over them"""
+        if not self.snapshot_path.exists():
+            return []
+        with open(self.snapshot_path, "rb") as f:
+            return self._replay(f).slice(start, stop)
+
+    def read_pages(self, size: int) -> Iterator[list[Item]]:
+        """All items, ``size`` at a time, as the list was when the first page was read"""
+        if not self.snapshot_path.exists():
+            return
+        with open(self.snapshot_path, "rb") as f:
+            items = self._replay(f).items()
+            while page := list(islice(items, size)):
+                yield page
+
+    def write(self, items: Iterable[Item]) -> None:
+        atomic_write_lines(self.snapshot_path, chain([FORMAT_HEADER], (item.to_json() for item in items)))
+        # The new snapshot invalidates the old journal and index; the index is rebuilt on the next slice read
+        self.journal_path.unlink(missing_ok=True)
+        self.index_path.unlink(missing_ok=True)
+
+    def delete(self) -> None:
+        self.journal_path.unlink(missing_ok=True)
+        self.index_path.unlink(missing_ok=True)
+        os.remove(self.snapshot_path)
+
+    def append(self, *records) -> None:
+        header = self._header()
+        if header is None:
+            self.write([])
+            header = self._header()
+        header = f"{header}\n".encode()
+        with open(self.journal_path, "ab+") as f:
+            f.seek(0)
+            if f.readline() != header:
+                f.truncate(0)
+                f.write(header)
+            else:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    f.write(b"\n")
+            f.write(b"".join(f"{json.dumps(record, ensure_ascii=False)}\n".encode() for record in records))
+            f.flush()
+            os.fsync(f.fileno())
+            journal_size = f.tell()
+        if journal_size > max(self.compact_min_bytes, os.path.getsize(self.snapshot_path)):
+            self.compact()
+
+    def compact(self) -> None:
+        # The new snapshot is written while the old one is read, it replaces the old one only once complete
+        with open(self.snapshot_path, "rb") as f:
+            self.write(self._replay(f).items())
+
+
+class _Replay:
+    """Journal records applied to a snapshot without reading all of it.
+
+    The list is the snapshot's items minus the ones removed by the records,
+    with the changed ones replaced, followed by the items the records added.
+    Only the snapshot items that records change are read, each by seeking
+    to it through the index.
+    """
+
+    def __init__(self, journal: ListJournal, f: BinaryIO, offsets: list[int], count: int):
+        self.journal = journal
+        self.f = f
+        self.offsets = offsets
+        self.count = count
+        # Positions in the snapshot, sorted
+        self.removed: list[int] = []
+        self.changed: dict[int, Item] = {}
+        self.appended: list[Item] = []
+
+    def __len__(self) -> int:
+        return self.count - len(self.removed) + len(self.appended)
+
+    def _position(self, index: int) -> int | None:
+        """Position in the snapshot of the item at the index, None if it was added by a record"""
+        if index >= self.count - len(self.removed):
+            return None
+        position = index
+        while True:
+            shifted = index + bisect.bisect_right(self.removed, position)
+            if shifted == position:
+                return position
+            position = shifted
+
+    def _get(self, index: int) -> Item:
+        position = self._position(index)
+        if position is None:
+            return self.appended[index - self.count + len(self.removed)]
+        item = self.changed.get(position)
+        if item is None:
+            line = next(self.journal._lines_from(self.f, self.offsets, position))
+            item = Item.from_json(line.decode("utf-8"))
+        return item
+
+    def _set(self, index: int, item: Item) -> None:
+        position = self._position(index)
+        if position is None:
+            self.appended[index - self.count + len(self.removed)] = item
+        else:
+            self.changed[position] = item
+
+    def _remove(self, index: int) -> None:
+        position = self._position(index)
+        if position is None:
+            del self.appended[index - self.count + len(self.removed)]
+        else:
+            bisect.insort(self.removed, position)
+            self.changed.pop(position, None)
+
+    def apply(self, record: list) -> None:
+        """Same as apply_record"""
+        op, arg, *rest = record
+        if op == "s":
+            text, ts = rest
+            if 0 <= arg < len(self):
+                self._set(arg, Item(text, self._get(arg).crossed, ts))
+            return
+        ts = rest[0] if rest else 0
+        if op == "+":
+            self.appended.append(Item(arg, len(rest) > 1 and bool(rest[1]), ts))
+        elif op == "t" and 0 <= arg < len(self):
+            item = self._get(arg)
+            if item.crossed:
+                self._remove(arg)
+            else:
+                self._set(arg, item.crossed_out(ts))
+
+    def slice(self, start: int, stop: int) -> list[Item]:
+        items = []
+        position = self._position(start) if start < len(self) else None
+        if position is not None:
+            removed = set(self.removed)
+            for line in self.journal._lines_from(self.f, self.offsets, position):
+                if len(items) >= stop - start:
+                    break
+                if position not in removed:
+                    item = self.changed.get(position)
+                    items.append(item if item is not None else Item.from_json(line.decode("utf-8")))
+                position += 1
+        first_appended = max(0, start - self.count + len(self.removed))
+        items.extend(self.appended[first_appended : first_appended + stop - start - len(items)])
+        return items
+
+    def items(self) -> Iterator[Item]:
+        """All items in order, reading the snapshot through once"""
+        self.f.seek(0)
+        header = self.f.readline().decode("utf-8").strip()
+        if header != FORMAT_HEADER:
+            raise ValueError(f"Unsupported list file format in {self.journal.snapshot_path}: {header[:40]!r}")
+        removed = set(self.removed)
+        position = 0
+        for line in self.f:
+            if not line.strip():
+                continue
+            if position not in removed:
+                item = self.changed.get(position)
+                yield item if item is not None else Item.from_json(line.decode("utf-8"))
+            position += 1
+        yield from self.appended
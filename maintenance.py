@@ -0,0 +1,149 @@
+import logging
+import time
+from typing import Awaitable, Callable
+
+from telegram.ext import ContextTypes
+
+from items import Item
+from persistence import UserStatePersistence
+from scheduler import UserOrderedApplication
+from storage import AsyncStorage
+from workers import shard_of
+
+logger = logging.getLogger("bot.maintenance")
+
+
+class Maintenance:
+    """Background upkeep of the lists, run by the JobQueue in short time-boxed slices.
+
+    A pass goes over the users of this process' shard one at a time: items
+    crossed out more than ``purge_after`` seconds ago are removed, list
+    journals are compacted and the bytes this frees on disk are counted and
+    logged when the pass is done. A new pass starts ``pass_interval``
+    seconds after the previous one started. ``on_purge`` is awaited with the
+    user id and the items purged from their lists.
+
+    Every slice first drops the in-memory state (manifest, cached lists,
+    indexes, user data) of users without updates for ``idle_after`` seconds;
+    ``on_evict`` is called with the user id and their list names to drop
+    what the handlers keep. State that a pass loads for a user it found
+    inactive is dropped right after.
+
+    Work on a user runs through ``UserOrderedApplication.run_for``, so it
+    never interleaves with their updates, and a slice takes no more users
+    once ``slice_seconds`` have passed. 0 for ``purge_after`` or
+    ``idle_after`` turns that part off.
+    """
+
+    def __init__(
+        self,
+        storage: AsyncStorage,
+        purge_after: float,
+        idle_after: float,
+        slice_seconds: float,
+        pass_interval: float = 24 * 3600,
+        shard: int = 0,
+        shards: int = 1,
+        on_evict: Callable[[int, list[str]], None] | None = None,
+        on_purge: Callable[[int, list[Item]], Awaitable[None]] | None = None,
+    ):
+        self.storage = storage
+        self.purge_after = purge_after
+        self.idle_after = idle_after
+        self.slice_seconds = slice_seconds
+        self.pass_interval = pass_interval
+        self.shard = shard
+        self.shards = shards
+        self.on_evict = on_evict
+        self.on_purge = on_purge
+        # Users of the running pass and the position of the next one, None between passes
+        self._users: list[int] | None = None
+        self._position = 0
+        self._pass_started = 0.0
+        self._pass_counts = (0, 0, 0)
+        self.passes = 0
+        self.purged = 0
+        self.reclaimed = 0
+        self.evicted = 0
+
+    async def job(self, context: ContextTypes.DEFAULT_TYPE) -> None:
+        await self.run_slice(context.application)
+
+    async def run_slice(self, application: UserOrderedApplication) -> None:
+        deadline = time.monotonic() + self.slice_seconds
+        if self.idle_after:
+            for key in application.idle_keys(self.idle_after):
+                if time.monotonic() >= deadline:
+                    return
+                await application.run_for(key, self._evict_idle(application, key))
+        if self._users is None:
+            if self.passes and time.monotonic() < self._pass_started + self.pass_interval:
+                return
+            await self._start_pass()
+        while self._position < len(self._users):
+            if time.monotonic() >= deadline:
+                return
+            user_id = self._users[self._position]
+            self._position += 1
+            try:
+                await application.run_for(user_id, self._maintain(application, user_id))
+            except Exception:
+                logger.exception("Maintenance of user %s failed", user_id)
+        await self._finish_pass()
+
+    async def _start_pass(self) -> None:
+        user_ids = await self.storage.user_ids()
+        self._users = sorted(user_id for user_id in user_ids if shard_of(user_id, self.shards) == self.shard)
+        self._position = 0
+        self._pass_started = time.monotonic()
+        self._pass_counts = (self.purged, self.reclaimed, self.evicted)
+
+    async def _finish_pass(self) -> None:
+        try:
+            self.reclaimed += await self.storage.reclaim()
+        except Exception:
+            logger.exception("Reclaiming free space failed")
+        purged, reclaimed, evicted = self._pass_counts
+        logger.info(
+            "Maintenance pass over %s users took %.1fs: purged %s crossed items, reclaimed %s bytes, "
+            "evicted %s idle users",
+            len(self._users),
+            time.monotonic() - self._pass_started,
+            self.purged - purged,
+            self.reclaimed - reclaimed,
+            self.evicted - evicted,
+        )
+        self.passes += 1
+        self._users = None
+
+    async def _maintain(self, application: UserOrderedApplication, user_id: int) -> None:
+        loaded = self.storage.is_loaded(user_id)
+        before = await self.storage.usage(user_id)
+        if self.purge_after:
+            purged = await self.storage.purge_crossed(user_id, int(time.time() - self.purge_after))
+            self.purged += len(purged)
+            if purged and self.on_purge is not None:
+                await self.on_purge(user_id, purged)
+        await self.storage.compact(user_id)
+        self.reclaimed += before - await self.storage.usage(user_id)
+        if not loaded and user_id not in application.last_active:
+            await self._release(user_id)
+
+    async def _evict_idle(self, application: UserOrderedApplication, user_id: int) -> None:
+        last_active = application.last_active.get(user_id)
+        if last_active is None or last_active > time.monotonic() - self.idle_after:
+            # Came back while this waited for its turn
+            return
+        # The persistence first: user data dropped while it still counts the user as loaded would not be read again
+        persistence = application.persistence
+        if isinstance(persistence, UserStatePersistence) and not persistence.forget(user_id):
+            return
+        if not application.forget(user_id):
+            return
+        await self._release(user_id)
+        self.evicted += 1
+
+    async def _release(self, user_id: int) -> None:
+        list_names = await self.storage.evict(user_id)
+        if self.on_evict is not None:
+            self.on_evict(user_id, list_names)
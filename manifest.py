@@ -0,0 +1,152 @@
+import bisect
+import json
+import time
+
+from items import Item, short_id
+
+
+class ListInfo:
+    __slots__ = ("items", "crossed", "mtime", "version")
+
+    def __init__(self, items: int = 0, crossed: int = 0, mtime: int = 0):
+        self.items = items
+        self.crossed = crossed
+        self.mtime = mtime
+        # Changes whenever the list does, only meaningful within one process (not persisted)
+        self.version = 0
+
+    @classmethod
+    def of(cls, items: list[Item], mtime: float | None = None) -> "ListInfo":
+        crossed = sum(1 for item in items if item.crossed)
+        return cls(len(items), crossed, int(time.time() if mtime is None else mtime))
+
+    @property
+    def done(self) -> str:
+        return f"{self.crossed}/{self.items}"
+
+
+class Manifest:
+    """Names of a user's lists in display order with per-list counters.
+
+    'default' comes first, the rest is sorted by name. Lookups by name and by
+    position are O(1), as is resolving the short id of a list (see
+    ``id_of``) back to its name; the manifest is updated in place on
+    every change instead of being recomputed from the lists.
+    """
+
+    def __init__(self, lists: dict[str, ListInfo] | None = None):
+        self._infos: dict[str, ListInfo] = dict(lists or {})
+        # Short id -> name and back
+        self._ids: dict[str, str] = {}
+        self._list_ids: dict[str, str] = {}
+        # Sorted names of the lists whose short_id collides, by short_id
+        self._shared_ids: dict[str, list[str]] = {}
+        for name in self._infos:
+            self._add_id(name)
+        self._names = sorted(name for name in self._infos if name != "default")
+        if "default" in self._infos:
+            self._names.insert(0, "default")
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._infos
+
+    def __len__(self) -> int:
+        return len(self._names)
+
+    @property
+    def names(self) -> list[str]:
+        return list(self._names)
+
+    def names_slice(self, start: int, stop: int) -> list[str]:
+        return self._names[start:stop]
+
+    def name_at(self, index: int) -> str | None:
+        """Name of the list at 0-based display position"""
+        if 0 <= index < len(self._names):
+            return self._names[index]
+        return None
+
+    def name_of(self, list_id: str) -> str | None:
+        """Name of the list with the short id, None if there is no such list anymore"""
+        return self._ids.get(list_id)
+
+    def id_of(self, name: str) -> str:
+        """Short id of the list for callback data.
+
+        It is the ``short_id`` of the name. If lists share it, the first of
+        them by name keeps it and the others get a "-<n>" suffix in name
+        order, so ids never collide and don't depend on the order the lists
+        were created or loaded in.
+        """
+        return self._list_ids.get(name) or short_id(name)
+
+    def _add_id(self, name: str) -> None:
+        base = short_id(name)
+        other = self._ids.get(base)
+        if other is None:
+            self._ids[base] = name
+            self._list_ids[name] = base
+            return
+        names = self._shared_ids.setdefault(base, [other])
+        bisect.insort(names, name)
+        self._number_ids(base, names)
+
+    def _remove_id(self, name: str) -> None:
+        del self._ids[self._list_ids.pop(name)]
+        base = short_id(name)
+        names = self._shared_ids.get(base)
+        if names is not None:
+            names.remove(name)
+            if len(names) == 1:
+                del self._shared_ids[base]
+            self._number_ids(base, names)
+
+    def _number_ids(self, base: str, names: list[str]) -> None:
+        for name in names:
+            self._ids.pop(self._list_ids.pop(name, None), None)
+        for number, name in enumerate(names):
+            list_id = f"{base}-{number}" if number else base
+            self._ids[list_id] = name
+            self._list_ids[name] = list_id
+
+    def get(self, name: str) -> ListInfo | None:
+        return self._infos.get(name)
+
+    def set(self, name: str, info: ListInfo) -> None:
+        if name not in self._infos:
+            if name == "default":
+                self._names.insert(0, name)
+            else:
+                start = 1 if self._names and self._names[0] == "default" else 0
+                bisect.insort(self._names, name, lo=start)
+            self._add_id(name)
+        self._infos[name] = info
+
+    def remove(self, name: str) -> None:
+        if self._infos.pop(name, None) is not None:
+            self._names.remove(name)
+            self._remove_id(name)
+
+    def touch(self, name: str, added: int = 0, crossed: int = 0, removed: int = 0) -> None:
+        """Apply a change of the item counters of one list"""
+        info = self._infos.get(name)
+        if info is None:
+            info = ListInfo()
+            self.set(name, info)
+        info.items += added - removed
+        info.crossed += crossed
+        info.mtime = int(time.time())
+
+    def copy(self) -> "Manifest":
+        return Manifest({name: ListInfo(info.items, info.crossed, info.mtime) for name, info in self._infos.items()})
+
+    def to_json(self) -> str:
+        return json.dumps(
+            {name: [info.items, info.crossed, info.mtime] for name, info in self._infos.items()},
+            ensure_ascii=False,
+            separators=(",", ":"),
+        )
+
+    @classmethod
+    def from_json(cls, data: str) -> "Manifest":
+        return cls({name: ListInfo(*values) for name, values in json.loads(data).items()})
@@ -0,0 +1,288 @@
+import asyncio
+import bisect
+import functools
+import logging
+import time
+from typing import Callable, Iterable, Iterator
+
+from telegram.ext import ApplicationHandlerStop, BaseHandler, CallbackQueryHandler, CommandHandler, ConversationHandler
+from telegram.request import HTTPXRequest
+
+logger = logging.getLogger("bot.metrics")
+
+# Seconds, from a cache hit to a slow disk or a long poll
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: tuple[str, ...], values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric:
+    """A named family of samples, one per combination of label values.
+
+    Label values are passed positionally in the order of ``labelnames``.
+    Instead of being updated, a metric may be given a ``function`` that
+    returns the current ``{label values: value}`` when it is scraped.
+    """
+
+    kind = "untyped"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Iterable[str] = (),
+        function: Callable[[], dict[tuple, float]] | None = None,
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.function = function
+        self._values: dict[tuple, float] = {}
+
+    def values(self) -> dict[tuple, float]:
+        return self.function() if self.function is not None else dict(self._values)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for labels, value in sorted(self.values().items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {value:g}")
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount: float = 1) -> None:
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value: float, *labels) -> None:
+        self._values[labels] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> [count per bucket (non-cumulative, last one is +Inf), sum]
+        self._series: dict[tuple, list] = {}
+
+    def observe(self, value: float, *labels) -> None:
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for labels, (counts, total) in sorted(self._series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                bucket_labels = _format_labels(self.labelnames, labels, f'le="{le}"')
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            label_text = _format_labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{label_text} {total:g}")
+            lines.append(f"{self.name}_count{label_text} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: list[Metric] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text exposition format"""
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+def handler_name(handler: BaseHandler) -> str:
+    """Label of a handler: its commands, its callback data pattern or else its callback's name"""
+    if isinstance(handler, CommandHandler):
+        return ",".join("/" + command for command in sorted(handler.commands))
+    if isinstance(handler, CallbackQueryHandler) and getattr(handler.pattern, "pattern", None):
+        return handler.pattern.pattern
+    return handler.callback.__name__
+
+
+def conversation_name(conversation: ConversationHandler) -> str:
+    """Name of a conversation, its first entry point command unless it was given one"""
+    return conversation.name or handler_name(conversation.entry_points[0]).lstrip("/")
+
+
+def iter_handlers(application, state_names: dict[object, str] | None = None) -> Iterator[tuple[str, BaseHandler]]:
+    """Label and handler of every handler of the Application, including those within conversations.
+
+    Handlers of a conversation state are labelled ``<conversation>:<state>:<handler>``.
+    A handler shared by several conversations is yielded once per conversation.
+    """
+    state_names = state_names or {}
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            if not isinstance(handler, ConversationHandler):
+                yield handler_name(handler), handler
+                continue
+            conversation = conversation_name(handler)
+            for entry_point in handler.entry_points:
+                yield handler_name(entry_point), entry_point
+            for state, state_handlers in handler.states.items():
+                for state_handler in state_handlers:
+                    yield f"{conversation}:{state_names.get(state, state)}:{handler_name(state_handler)}", state_handler
+            for fallback in handler.fallbacks:
+                yield handler_name(fallback), fallback
+
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest that reports the duration and failures of every Bot API call by method"""
+
+    def __init__(self, metrics: "BotMetrics", **kwargs):
+        super().__init__(**kwargs)
+        self.metrics = metrics
+
+    async def do_request(self, url: str, method: str, *args, **kwargs) -> tuple[int, bytes]:
+        api_method = url.rsplit("/", 1)[-1]
+        started = time.perf_counter()
+        try:
+            status, payload = await super().do_request(url, method, *args, **kwargs)
+        except Exception:
+            self.metrics.api_errors.inc(api_method)
+            raise
+        finally:
+            self.metrics.api_latency.observe(time.perf_counter() - started, api_method)
+        if status >= 400:
+            self.metrics.api_errors.inc(api_method)
+        return status, payload
+
+
+class BotMetrics:
+    """Metrics of the bot: handlers, storage, Bot API calls and open conversations.
+
+    ``instrument`` wraps the callbacks of all handlers registered with an
+    Application, including entry points, states and fallbacks of
+    conversations. Storage and API calls are measured by ``track_storage``
+    and by using ``InstrumentedRequest`` for the bot's requests. Values are
+    only aggregated in memory; ``serve`` exposes them on ``/metrics``.
+    """
+
+    def __init__(self):
+        self.registry = Registry()
+        self.handler_latency = self.registry.register(
+            Histogram("bot_handler_duration_seconds", "Time spent in update handlers", ["handler"])
+        )
+        self.handler_errors = self.registry.register(
+            Counter("bot_handler_errors_total", "Update handlers that raised an exception", ["handler"])
+        )
+        self.storage_latency = self.registry.register(
+            Histogram("bot_storage_duration_seconds", "Duration of storage backend calls", ["operation"])
+        )
+        self.api_latency = self.registry.register(
+            Histogram("bot_api_request_duration_seconds", "Duration of Bot API requests", ["method"])
+        )
+        self.api_errors = self.registry.register(
+            Counter("bot_api_request_errors_total", "Bot API requests that failed or were refused", ["method"])
+        )
+        self._conversations: dict[str, ConversationHandler] = {}
+        self.registry.register(
+            Gauge(
+                "bot_active_conversations",
+                "Conversations waiting for the user's next message",
+                ["conversation"],
+                function=lambda: {(name,): len(conv._conversations) for name, conv in self._conversations.items()},
+            )
+        )
+
+    def track_storage(self, storage) -> None:
+        """Time the calls of an AsyncStorage and export the bytes it read and wrote"""
+        storage.observer = self.storage_latency.observe
+        self.registry.register(
+            Counter(
+                "bot_storage_read_bytes_total",
+                "Item text read from the storage backend (cache misses)",
+                function=lambda: {(): storage.bytes_read},
+            )
+        )
+        self.registry.register(
+            Counter(
+                "bot_storage_written_bytes_total",
+                "Item text written to the storage backend",
+                function=lambda: {(): storage.bytes_written},
+            )
+        )
+
+    def wrap(self, callback: Callable, name: str) -> Callable:
+        @functools.wraps(callback)
+        async def instrumented(update, context):
+            started = time.perf_counter()
+            try:
+                return await callback(update, context)
+            except ApplicationHandlerStop:
+                raise
+            except Exception:
+                self.handler_errors.inc(name)
+                raise
+            finally:
+                self.handler_latency.observe(time.perf_counter() - started, name)
+
+        instrumented.metrics_name = name
+        return instrumented
+
+    def instrument(self, application, state_names: dict[object, str] | None = None) -> None:
+        """Wrap the callbacks of every handler of the Application, call after all handlers are added"""
+        for handlers in application.handlers.values():
+            for handler in handlers:
+                if isinstance(handler, ConversationHandler):
+                    self._conversations[conversation_name(handler)] = handler
+        for name, handler in iter_handlers(application, state_names):
+            # Handlers may be shared, e.g. one /cancel fallback of several conversations
+            if not hasattr(handler.callback, "metrics_name"):
+                handler.callback = self.wrap(handler.callback, name)
+
+    async def serve(self, host: str, port: int) -> asyncio.AbstractServer:
+        """Answer ``GET /metrics`` on the running event loop until the returned server is closed"""
+
+        async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+            try:
+                request_line = await asyncio.wait_for(reader.readline(), 10)
+                while await asyncio.wait_for(reader.readline(), 10) not in (b"\r\n", b"\n", b""):
+                    pass
+                parts = request_line.split()
+                if len(parts) >= 2 and parts[0] == b"GET" and parts[1].split(b"?")[0] == b"/metrics":
+                    status, body = "200 OK", self.registry.render().encode()
+                else:
+                    status, body = "404 Not Found", b""
+                writer.write(
+                    f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                    f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+                )
+                await writer.drain()
+            except (asyncio.TimeoutError, ConnectionError):
+                pass
+            finally:
+                writer.close()
+
+        server = await asyncio.start_server(handle, host, port)
+        logger.info("Metrics served on %s:%s/metrics", host, port)
+        return server
@@ -0,0 +1,134 @@
+import asyncio
+import json
+import logging
+from typing import Iterable
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+from storage import AsyncStorage
+
+logger = logging.getLogger("bot.persistence")
+
+
+class UserStatePersistence(BasePersistence):
+    """Persists selected keys of ``user_data`` through the list storage.
+
+    Only ``keys`` are stored, as one compact JSON object per user. Nothing is
+    loaded on startup: a user's state is read the first time one of their
+    updates is handled. The Application reports changed users every
+    ``update_interval`` seconds and on shutdown; all of them are then written
+    with a single storage call, and users whose state did not change are
+    skipped.
+    """
+
+    def __init__(self, storage: AsyncStorage, keys: Iterable[str], update_interval: float = 60):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.storage = storage
+        self.keys = tuple(keys)
+        # Last state read or written per user, doubles as the set of loaded users
+        self._saved: dict[int, str] = {}
+        self._dirty: dict[int, str] = {}
+        self._pending_write: asyncio.Future | None = None
+
+    def _serialize(self, data: dict) -> str:
+        return json.dumps({key: data[key] for key in self.keys if key in data}, separators=(",", ":"))
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        if user_id in self._saved:
+            return
+        state = await self.storage.load_user_state(user_id)
+        if user_id in self._saved:
+            return
+        self._saved[user_id] = state or "{}"
+        if state:
+            for key, value in json.loads(state).items():
+                user_data.setdefault(key, value)
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        state = self._serialize(data)
+        if self._saved.get(user_id, "{}") == state:
+            self._dirty.pop(user_id, None)
+            return
+        self._dirty[user_id] = state
+        if self._pending_write is None:
+            self._pending_write = asyncio.ensure_future(self._write_dirty())
+        await asyncio.shield(self._pending_write)
+
+    async def drop_user_data(self, user_id: int) -> None:
+        await self.update_user_data(user_id, {})
+
+    def forget(self, user_id: int) -> bool:
+        """Stop treating the user as loaded, their state is read again with their next update.
+
+        Returns False, keeping the user, while their state waits to be written.
+        """
+        if user_id in self._dirty:
+            return False
+        self._saved.pop(user_id, None)
+        return True
+
+    async def _write_dirty(self) -> None:
+        # Let the other update_user_data calls of this persistence run join the batch
+        await asyncio.sleep(0)
+        self._pending_write = None
+        batch, self._dirty = self._dirty, {}
+        if not batch:
+            return
+        try:
+            await self.storage.save_user_states(batch)
+        except Exception:
+            logger.exception("Failed to save state of %s users", len(batch))
+            for user_id, state in batch.items():
+                self._dirty.setdefault(user_id, state)
+            return
+        for user_id, state in batch.items():
+            # Users forgotten meanwhile are read again when they come back
+            if user_id in self._saved:
+                self._saved[user_id] = state
+
+    async def flush(self) -> None:
+        if self._pending_write is not None:
+            await self._pending_write
+        if self._dirty:
+            self._pending_write = asyncio.ensure_future(self._write_dirty())
+            await self._pending_write
+
+    async def get_user_data(self) -> dict:
+        # Loaded lazily in refresh_user_data
+        return {}
+
+    async def get_chat_data(self) -> dict:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self) -> None:
+        return None
+
+    async def get_conversations(self, name: str) -> dict:
+        return {}
+
+    async def update_conversation(self, name: str, key, new_state) -> None:
+        pass
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        pass
+
+    async def update_bot_data(self, data: dict) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
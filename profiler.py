@@ -0,0 +1,179 @@
+import asyncio
+import inspect
+import logging
+import sys
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+from types import CodeType, FrameType
+
+from telegram.ext import Application, BaseHandler
+
+from metrics import iter_handlers
+
+logger = logging.getLogger("bot.profiler")
+
+# Group of the handler counting updates while profiling, checked before all others
+COUNTING_GROUP = -100
+
+
+class UpdateCounter(BaseHandler):
+    """Never handles an update, only lets a running profiler count them.
+
+    Handlers can't be added or removed safely while updates are processed,
+    so this one stays registered and costs one attribute check per update.
+    """
+
+    def __init__(self, profiler: "SamplingProfiler"):
+        super().__init__(self._callback)
+        self.profiler = profiler
+
+    def check_update(self, update: object) -> bool:
+        if self.profiler.updates_left:
+            self.profiler.count_update()
+        return False
+
+    @staticmethod
+    async def _callback(update, context) -> None:
+        pass
+
+
+class SamplingProfiler:
+    """Samples the stacks of the event loop and storage threads on demand.
+
+    While running, a background thread records the Python stack of the bot's
+    threads every ``interval`` seconds. Samples taken while a handler runs
+    start with the handler's label (see ``iter_handlers``), other samples of
+    the event loop start with ``event_loop`` and those of storage worker
+    threads with ``storage``. Handlers suspended in an ``await`` (on the
+    storage thread pool, a Bot API request, ...) are sampled too, their
+    stacks end in ``(waiting)``, so a handler's time is split between
+    running and waiting and the innermost frame tells what for. The result is written to ``output_dir`` as
+    collapsed stacks ("frame;frame;frame count" lines) that flamegraph.pl,
+    speedscope and similar tools read. Nothing runs while it is switched off.
+    """
+
+    def __init__(self, output_dir: Path, interval: float = 0.005):
+        self.output_dir = Path(output_dir)
+        self.interval = interval
+        self._handler_codes: dict[CodeType, str] = {}
+        self._thread: threading.Thread | None = None
+        self._stop = threading.Event()
+        self._result: asyncio.Future | None = None
+        # Updates still to be seen before stopping, 0 if not limited by updates
+        self.updates_left = 0
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None
+
+    def register(self, application: Application, state_names: dict[object, str] | None = None) -> None:
+        """Learn the handlers of the Application, call after all handlers are added"""
+        for name, handler in iter_handlers(application, state_names):
+            code = inspect.unwrap(handler.callback).__code__
+            self._handler_codes.setdefault(code, name)
+        application.add_handler(UpdateCounter(self), group=COUNTING_GROUP)
+
+    def start(self, seconds: float | None = None, updates: int | None = None) -> asyncio.Future | None:
+        """Profile for ``seconds`` or until ``updates`` more updates arrived, whatever comes first.
+
+        Returns a future with the path of the written file (None if writing
+        failed) and the number of samples, or None if the profiler is already
+        running.
+        """
+        if self.running:
+            return None
+        loop = asyncio.get_running_loop()
+        self._result = loop.create_future()
+        self.updates_left = updates or 0
+        self._stop.clear()
+        deadline = time.monotonic() + seconds if seconds else None
+        self._thread = threading.Thread(
+            target=self._sample, args=(threading.get_ident(), loop, deadline), name="profiler", daemon=True
+        )
+        self._thread.start()
+        logger.info("Profiling started (%s seconds, %s updates)", seconds, updates)
+        return self._result
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def count_update(self) -> None:
+        self.updates_left -= 1
+        if self.updates_left <= 0:
+            self.stop()
+
+    def _sample(self, loop_thread_id: int, loop: asyncio.AbstractEventLoop, deadline: float | None) -> None:
+        own_id = threading.get_ident()
+        samples: Counter[str] = Counter()
+        while not self._stop.wait(self.interval):
+            if deadline is not None and time.monotonic() >= deadline:
+                break
+            storage_threads = {t.ident for t in threading.enumerate() if t.name.startswith("storage")}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == loop_thread_id:
+                    samples[self._collapse(frame, "event_loop")] += 1
+                elif thread_id in storage_threads and thread_id != own_id:
+                    samples[self._collapse(frame, "storage")] += 1
+            for task in asyncio.all_tasks(loop):
+                stack = self._collapse_waiting(task.get_coro())
+                if stack is not None:
+                    samples[stack] += 1
+        try:
+            path = self._write(samples)
+        except OSError:
+            logger.exception("Writing the profile failed")
+            path = None
+        loop.call_soon_threadsafe(self._finish, path, sum(samples.values()))
+
+    def _collapse(self, frame: FrameType | None, root: str) -> str:
+        """One sample as 'root;outermost frame;...;innermost frame', starting at the handler if any"""
+        frames = []
+        while frame is not None:
+            code = frame.f_code
+            handler = self._handler_codes.get(code)
+            frames.append(f"{code.co_name} ({Path(code.co_filename).name}:{code.co_firstlineno})")
+            if handler is not None:
+                root = handler
+                break
+            frame = frame.f_back
+        frames.append(root)
+        return ";".join(reversed(frames))
+
+    def _collapse_waiting(self, coro) -> str | None:
+        """Where a suspended handler waits, as 'handler;frame;...;awaiting frame;(waiting)'"""
+        frames = []
+        handler = None
+        while coro is not None:
+            if getattr(coro, "cr_running", False):
+                # Sampled with the stack of the event loop thread
+                return None
+            frame = getattr(coro, "cr_frame", None) or getattr(coro, "gi_frame", None)
+            if frame is None:
+                # A future, or a finished coroutine
+                break
+            code = frame.f_code
+            if code in self._handler_codes:
+                handler = self._handler_codes[code]
+                frames = []
+            frames.append(f"{code.co_name} ({Path(code.co_filename).name}:{code.co_firstlineno})")
+            coro = getattr(coro, "cr_await", None) or getattr(coro, "gi_yieldfrom", None)
+        if handler is None:
+            return None
+        return ";".join([handler, *frames, "(waiting)"])
+
+    def _write(self, samples: Counter) -> Path:
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        path = self.output_dir / f"profile-{time.strftime('%Y%m%d-%H%M%S')}.collapsed"
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in samples.most_common():
+                f.write(f"{stack} {count}\n")
+        return path
+
+    def _finish(self, path: Path | None, samples: int) -> None:
+        self._thread = None
+        self.updates_left = 0
+        if path is not None:
+            logger.info("Profile with %s samples written to %s", samples, path)
+        self._result.set_result((path, samples))
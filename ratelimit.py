@@ -0,0 +1,268 @@
+import asyncio
+import heapq
+import itertools
+import logging
+from collections import deque
+from enum import IntEnum
+
+from telegram.error import RetryAfter, TelegramError
+from telegram.ext import BaseRateLimiter
+
+logger = logging.getLogger("bot.ratelimit")
+
+# Edits of one message where only the latest queued one needs to be sent
+COALESCED_ENDPOINTS = frozenset({"editMessageText", "editMessageReplyMarkup"})
+# Telegram's limit for a group chat, messages per second
+GROUP_CHAT_RATE = 20 / 60
+
+
+class Priority(IntEnum):
+    """Pass as ``rate_limit_args={"priority": ...}`` to a bot method, lower goes first"""
+
+    INTERACTIVE = 0
+    BACKGROUND = 1
+
+
+class SendQueueFull(TelegramError):
+    """A background request was dropped because too many requests are waiting"""
+
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float, now: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def ready_at(self, now: float) -> float:
+        """Time at which a token is available"""
+        self._refill(now)
+        if self.tokens >= 1:
+            return now
+        return now + (1 - self.tokens) / self.rate
+
+    def is_full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+    def take(self, now: float) -> None:
+        self._refill(now)
+        self.tokens -= 1
+
+
+class PriorityRateLimiter(BaseRateLimiter):
+    """Schedules outgoing requests within Telegram's global and per-chat limits.
+
+    Requests addressed to a chat wait for a token of the global bucket and of
+    the chat's bucket (group chats have a lower rate). Among the chats that
+    may send, the one whose oldest waiting request has the best priority goes
+    first; requests to one chat keep their order. A queued edit of a message
+    is answered with ``True`` without being sent when a newer edit of the same
+    message is queued. Background requests are rejected with ``SendQueueFull``
+    once ``max_queued`` requests wait. On a 429 all sending pauses for the
+    requested time and the request is retried up to ``max_retries`` times.
+    Requests without a chat (polling, answering callback queries) are not
+    delayed.
+    """
+
+    def __init__(
+        self,
+        global_rate: float = 30,
+        chat_rate: float = 1,
+        group_rate: float = GROUP_CHAT_RATE,
+        burst: int = 3,
+        max_queued: int = 1024,
+        max_retries: int = 3,
+        max_idle_buckets: int = 10000,
+    ):
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.burst = burst
+        self.max_queued = max_queued
+        self.max_retries = max_retries
+        self.max_idle_buckets = max_idle_buckets
+        self._global: TokenBucket | None = None
+        self._buckets: dict[int | str, TokenBucket] = {}
+        # Waiting requests per chat as (priority, seq, future); a chat with waiting requests
+        # is either in _ready (may send now) or in _delayed (until its bucket refills)
+        self._chats: dict[int | str, deque] = {}
+        self._ready: list[tuple[int, int, int | str]] = []
+        self._delayed: list[tuple[float, int | str]] = []
+        self._coalescable: dict[tuple, asyncio.Future] = {}
+        self._seq = itertools.count()
+        self._paused_until = 0.0
+        self._wakeup: asyncio.Event | None = None
+        self._dispatcher: asyncio.Task | None = None
+        self.queued = 0
+        self.max_queue_depth = 0
+        self.sent = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.retries = 0
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            self._dispatcher = None
+        for queue in self._chats.values():
+            for _, _, future in queue:
+                if not future.done():
+                    future.cancel()
+        self._chats.clear()
+        self._ready.clear()
+        self._delayed.clear()
+        self.queued = 0
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get("chat_id")
+        if chat_id is None:
+            return await callback(*args, **kwargs)
+
+        priority = (rate_limit_args or {}).get("priority", Priority.INTERACTIVE)
+        coalesce_key = None
+        if endpoint in COALESCED_ENDPOINTS and data.get("message_id") is not None:
+            coalesce_key = (chat_id, data["message_id"], endpoint)
+        for attempt in itertools.count():
+            if not await self._acquire(chat_id, priority, coalesce_key, retry=attempt > 0):
+                # Superseded by a newer edit of the same message
+                return True
+            try:
+                result = await callback(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt >= self.max_retries:
+                    raise
+                self.retries += 1
+                logger.warning("Flood control on %s to %s, pausing for %ss", endpoint, chat_id, e.retry_after)
+                self._pause(e.retry_after)
+                continue
+            self.sent += 1
+            return result
+
+    def _pause(self, seconds: float) -> None:
+        loop = asyncio.get_running_loop()
+        self._paused_until = max(self._paused_until, loop.time() + seconds)
+        self._wakeup.set()
+
+    def _bucket(self, chat_id: int | str, now: float) -> TokenBucket:
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            rate = self.group_rate if is_group else self.chat_rate
+            bucket = self._buckets[chat_id] = TokenBucket(rate, self.burst, now)
+        return bucket
+
+    async def _acquire(self, chat_id: int | str, priority: int, coalesce_key: tuple | None, retry: bool) -> bool:
+        """Wait for the turn of a request, False if it was superseded by a newer one"""
+        if self.queued >= self.max_queued and priority > Priority.INTERACTIVE:
+            self.dropped += 1
+            raise SendQueueFull(f"Send queue is full ({self.queued} requests waiting)")
+
+        loop = asyncio.get_running_loop()
+        if self._dispatcher is None:
+            self._global = TokenBucket(self.global_rate, self.global_rate, loop.time())
+            self._wakeup = asyncio.Event()
+            self._dispatcher = asyncio.create_task(self._dispatch())
+
+        future = loop.create_future()
+        if coalesce_key is not None:
+            previous = self._coalescable.get(coalesce_key)
+            if previous is not None and not previous.done():
+                previous.set_result(False)
+                self.coalesced += 1
+            self._coalescable[coalesce_key] = future
+
+        entry = (priority, next(self._seq), future)
+        queue = self._chats.get(chat_id)
+        if queue is None:
+            queue = self._chats[chat_id] = deque()
+            queue.append(entry)
+            self._schedule(chat_id, loop.time())
+        elif retry:
+            # A retried request goes before the ones queued after it
+            queue.appendleft(entry)
+        else:
+            queue.append(entry)
+        self.queued += 1
+        self.max_queue_depth = max(self.max_queue_depth, self.queued)
+        self._wakeup.set()
+        try:
+            return await future
+        finally:
+            if coalesce_key is not None and self._coalescable.get(coalesce_key) is future:
+                del self._coalescable[coalesce_key]
+
+    def _schedule(self, chat_id: int | str, now: float) -> None:
+        ready_at = self._bucket(chat_id, now).ready_at(now)
+        if ready_at <= now:
+            priority, seq, _ = self._chats[chat_id][0]
+            heapq.heappush(self._ready, (priority, seq, chat_id))
+        else:
+            heapq.heappush(self._delayed, (ready_at, chat_id))
+
+    def _grant(self, chat_id: int | str, now: float) -> None:
+        """Let the oldest live request of a chat go, if any"""
+        queue = self._chats[chat_id]
+        while queue:
+            _, _, future = queue.popleft()
+            self.queued -= 1
+            if not future.done():
+                future.set_result(True)
+                self._global.take(now)
+                self._bucket(chat_id, now).take(now)
+                break
+        if queue:
+            self._schedule(chat_id, now)
+        else:
+            del self._chats[chat_id]
+            if len(self._buckets) > self.max_idle_buckets:
+                self._prune_buckets(now)
+
+    def _prune_buckets(self, now: float) -> None:
+        for chat_id in [c for c, b in self._buckets.items() if c not in self._chats and b.is_full(now)]:
+            del self._buckets[chat_id]
+
+    async def _dispatch(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            now = loop.time()
+            while self._delayed and self._delayed[0][0] <= now:
+                _, chat_id = heapq.heappop(self._delayed)
+                self._schedule(chat_id, now)
+
+            timeout = self._delayed[0][0] - now if self._delayed else None
+            if now < self._paused_until:
+                timeout = self._paused_until - now
+            elif self._ready:
+                global_ready_at = self._global.ready_at(now)
+                if global_ready_at <= now:
+                    _, _, chat_id = heapq.heappop(self._ready)
+                    self._grant(chat_id, now)
+                    continue
+                timeout = global_ready_at - now if timeout is None else min(timeout, global_ready_at - now)
+
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self.queued,
+            "max_queue_depth": self.max_queue_depth,
+            "waiting_chats": len(self._chats),
+            "sent": self.sent,
+            "coalesced": self.coalesced,
+            "dropped": self.dropped,
+            "retries": self.retries,
+        }
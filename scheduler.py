@@ -0,0 +1,187 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+from typing import Any, Coroutine, Hashable
+
+from telegram import Update
+from telegram.ext import Application
+
+logger = logging.getLogger("bot.scheduler")
+
+
+class UserScheduler:
+    """Runs coroutines of different keys concurrently and of the same key strictly in order.
+
+    Every key with pending work gets one worker task that drains its queue, so
+    two coroutines of the same key never overlap. At most ``max_concurrency``
+    coroutines run at once and at most ``max_pending`` may wait, after that
+    ``submit`` blocks until there is room again.
+    """
+
+    def __init__(self, max_concurrency: int, max_pending: int):
+        self.max_concurrency = max_concurrency
+        self.max_pending = max_pending
+        self._queues: dict[Hashable, deque[Coroutine]] = {}
+        self._running = asyncio.Semaphore(max_concurrency)
+        self._room = asyncio.Semaphore(max_pending)
+        self._workers: set[asyncio.Task] = set()
+        # Futures of the coroutines submitted by run, settled even if the coroutine never gets to run
+        self._waiters: dict[Coroutine, tuple[asyncio.Future, Coroutine]] = {}
+        self.pending = 0
+        self.processed = 0
+
+    @property
+    def active_keys(self) -> int:
+        return len(self._queues)
+
+    async def submit(self, key: Hashable, coroutine: Coroutine[Any, Any, Any]) -> None:
+        await self._room.acquire()
+        self.pending += 1
+        queue = self._queues.get(key)
+        if queue is not None:
+            queue.append(coroutine)
+            return
+        self._queues[key] = deque([coroutine])
+        worker = asyncio.create_task(self._drain(key))
+        self._workers.add(worker)
+        worker.add_done_callback(self._workers.discard)
+
+    async def run(self, key: Hashable, coroutine: Coroutine[Any, Any, Any]) -> Any:
+        """Submit the coroutine and wait for its result, it runs after the work already submitted for the key"""
+        done = asyncio.get_running_loop().create_future()
+
+        async def work():
+            try:
+                result = await coroutine
+            except BaseException as error:
+                # The caller may have stopped waiting already
+                if not done.done():
+                    if isinstance(error, (asyncio.CancelledError, GeneratorExit)):
+                        done.cancel()
+                    else:
+                        done.set_exception(error)
+                if not isinstance(error, Exception):
+                    raise
+            else:
+                if not done.done():
+                    done.set_result(result)
+            finally:
+                self._waiters.pop(wrapper, None)
+
+        wrapper = work()
+        self._waiters[wrapper] = (done, coroutine)
+        try:
+            await self.submit(key, wrapper)
+        except BaseException:
+            self._waiters.pop(wrapper, None)
+            wrapper.close()
+            coroutine.close()
+            raise
+        return await done
+
+    async def _drain(self, key: Hashable) -> None:
+        queue = self._queues[key]
+        try:
+            while queue:
+                try:
+                    async with self._running:
+                        await queue[0]
+                except Exception:
+                    logger.exception("Unhandled error while processing work of %s", key)
+                queue.popleft()
+                self.pending -= 1
+                self.processed += 1
+                self._room.release()
+        finally:
+            # Only reached with leftovers if the worker was cancelled or work raised a BaseException,
+            # they give back their room like finished work
+            for coroutine in queue:
+                self.pending -= 1
+                self._room.release()
+                coroutine.close()
+                waiter = self._waiters.pop(coroutine, None)
+                if waiter is not None:
+                    done, wrapped = waiter
+                    wrapped.close()
+                    done.cancel()
+            del self._queues[key]
+
+    async def join(self) -> None:
+        """Wait until all submitted work is done"""
+        while self._workers:
+            await asyncio.gather(*self._workers, return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {
+            "pending": self.pending,
+            "active_keys": self.active_keys,
+            "processed": self.processed,
+            "max_concurrency": self.max_concurrency,
+        }
+
+
+def update_key(update: object) -> Hashable:
+    if isinstance(update, Update):
+        if update.effective_user:
+            return update.effective_user.id
+        if update.effective_chat:
+            return update.effective_chat.id
+    return None
+
+
+class UserOrderedApplication(Application):
+    """Application processing updates of different users concurrently.
+
+    Updates of one user (or chat, if there is no user) are still handled one
+    after another, so the read-modify-write sequences in handlers and the
+    conversation states never see interleaved updates of the same user.
+    Background work on a user's data goes through ``run_for`` and is ordered
+    with their updates the same way.
+    """
+
+    def __init__(self, max_concurrency: int, max_pending: int, **kwargs):
+        super().__init__(**kwargs)
+        self.scheduler = UserScheduler(max_concurrency, max_pending)
+        # Monotonic time of the last update per key, least recently active first
+        self.last_active: OrderedDict[Hashable, float] = OrderedDict()
+
+    async def process_update(self, update: object) -> None:
+        key = update_key(update)
+        if key is not None:
+            self.last_active[key] = time.monotonic()
+            self.last_active.move_to_end(key)
+        await self.scheduler.submit(key, Application.process_update(self, update))
+
+    async def run_for(self, key: Hashable, coroutine: Coroutine[Any, Any, Any]) -> Any:
+        """Run the coroutine between the updates of the key, see ``UserScheduler.run``"""
+        return await self.scheduler.run(key, coroutine)
+
+    def idle_keys(self, seconds: float) -> list[Hashable]:
+        """Keys without updates for at least that long, least recently active first"""
+        idle_since = time.monotonic() - seconds
+        keys = []
+        for key, last_active in self.last_active.items():
+            if last_active > idle_since:
+                break
+            keys.append(key)
+        return keys
+
+    def forget(self, key: Hashable) -> bool:
+        """Drop the user data and private chat data of an idle key from memory.
+
+        Unlike ``drop_user_data`` nothing is deleted from the persistence, the
+        data is read again with the next update. Returns False, keeping
+        everything, while changes of the user data wait to be persisted.
+        """
+        if key in self._user_ids_to_be_updated_in_persistence:
+            return False
+        self._user_data.pop(key, None)
+        self._chat_data.pop(key, None)
+        self.last_active.pop(key, None)
+        return True
+
+    async def _update_fetcher(self) -> None:
+        await super()._update_fetcher()
+        # stop() flushes persistence once the fetcher is done, make sure handlers finished by then
+        await self.scheduler.join()
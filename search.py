@@ -0,0 +1,148 @@
+import bisect
+import json
+import re
+from typing import Iterable, Iterator
+
+from items import normalize_item
+from manifest import ListInfo
+
+WORD = re.compile(r"\w+")
+
+
+def item_words(text: str) -> set[str]:
+    """Words an item is found by: those of its normalized text (see ``normalize_item``), without the quantity"""
+    return set(WORD.findall(normalize_item(text)[0]))
+
+
+def query_words(query: str) -> list[str]:
+    return WORD.findall(query.casefold().replace("ё", "е"))
+
+
+def stamp_of(info: ListInfo) -> tuple[int, int, int]:
+    return info.items, info.crossed, info.mtime
+
+
+class SearchIndex:
+    """Inverted index from words to the items containing them, over all lists of one user.
+
+    Every list is indexed with the ``ListInfo`` counters it had at the time
+    (its stamp), so an index that was stored before the last changes of some
+    lists tells which of them have to be indexed again. Only item texts and
+    their counts are stored, the postings are rebuilt when the index is
+    loaded. A query word matches the words it is a prefix of, so "батар"
+    finds "батарейки".
+    """
+
+    __slots__ = ("_lists", "_stamps", "_postings", "_words")
+
+    def __init__(self):
+        # list name -> item text -> number of items with that text
+        self._lists: dict[str, dict[str, int]] = {}
+        self._stamps: dict[str, tuple[int, int, int]] = {}
+        self._postings: dict[str, set[tuple[str, str]]] = {}
+        # Sorted words for prefix lookups, None when words were added or removed since
+        self._words: list[str] | None = None
+
+    def __len__(self) -> int:
+        return len(self._lists)
+
+    def is_current(self, list_name: str, info: ListInfo) -> bool:
+        return self._stamps.get(list_name) == stamp_of(info)
+
+    def stale_lists(self, infos: dict[str, ListInfo]) -> tuple[list[str], list[str]]:
+        """Lists to index again and indexed lists that no longer exist"""
+        stale = [name for name, info in infos.items() if not self.is_current(name, info)]
+        return stale, [name for name in self._lists if name not in infos]
+
+    def items(self) -> Iterator[tuple[str, str, int]]:
+        """List name, item text and number of such items, for every distinct item of every list"""
+        for list_name, counts in self._lists.items():
+            for text, count in counts.items():
+                yield list_name, text, count
+
+    def stamp(self, list_name: str, info: ListInfo) -> None:
+        self._stamps[list_name] = stamp_of(info)
+
+    def add(self, list_name: str, texts: Iterable[str]) -> None:
+        counts = self._lists.setdefault(list_name, {})
+        for text in texts:
+            if text in counts:
+                counts[text] += 1
+                continue
+            counts[text] = 1
+            for word in item_words(text):
+                postings = self._postings.get(word)
+                if postings is None:
+                    postings = self._postings[word] = set()
+                    self._words = None
+                postings.add((list_name, text))
+
+    def discard(self, list_name: str, texts: Iterable[str]) -> None:
+        counts = self._lists.get(list_name)
+        if counts is None:
+            return
+        for text in texts:
+            count = counts.get(text, 0)
+            if count > 1:
+                counts[text] = count - 1
+            elif count:
+                del counts[text]
+                self._unpost(list_name, text)
+
+    def replace_list(self, list_name: str, texts: Iterable[str]) -> None:
+        self.remove_list(list_name)
+        self.add(list_name, texts)
+
+    def remove_list(self, list_name: str) -> None:
+        self._stamps.pop(list_name, None)
+        for text in self._lists.pop(list_name, {}):
+            self._unpost(list_name, text)
+
+    def _unpost(self, list_name: str, text: str) -> None:
+        for word in item_words(text):
+            postings = self._postings.get(word)
+            if postings is not None:
+                postings.discard((list_name, text))
+                if not postings:
+                    del self._postings[word]
+                    self._words = None
+
+    def _matching(self, prefix: str) -> set[tuple[str, str]]:
+        if self._words is None:
+            self._words = sorted(self._postings)
+        found: set[tuple[str, str]] = set()
+        for position in range(bisect.bisect_left(self._words, prefix), len(self._words)):
+            word = self._words[position]
+            if not word.startswith(prefix):
+                break
+            found |= self._postings[word]
+        return found
+
+    def search(self, query: str) -> list[tuple[str, str]]:
+        """(list name, item text) of the items containing all words of the query, sorted"""
+        words = query_words(query)
+        if not words:
+            return []
+        matches: set[tuple[str, str]] | None = None
+        # Longer words tend to match fewer items, start with them
+        for word in sorted(set(words), key=len, reverse=True):
+            found = self._matching(word)
+            matches = found if matches is None else matches & found
+            if not matches:
+                return []
+        return sorted(matches)
+
+    def to_json(self) -> str:
+        return json.dumps(
+            {name: [list(self._stamps.get(name, (0, 0, 0))), counts] for name, counts in self._lists.items()},
+            ensure_ascii=False,
+            separators=(",", ":"),
+        )
+
+    @classmethod
+    def from_json(cls, data: str) -> "SearchIndex":
+        index = cls()
+        for name, (stamp, counts) in json.loads(data).items():
+            index.add(name, (text for text, count in counts.items() for _ in range(count)))
+            index._stamps[name] = tuple(stamp)
+        return index
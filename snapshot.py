@@ -0,0 +1,199 @@
+import logging
+import mmap
+import os
+import struct
+from pathlib import Path
+from typing import Iterable, Iterator
+
+from journal import fsync_dir
+
+logger = logging.getLogger("bot.snapshot")
+
+MAGIC = b"LSNAP002"
+# Magic, number of users, generation
+HEADER = struct.Struct("<8sI16s")
+# User id, flags, offset and length of the manifest, offset and length of the search index (0 if none)
+ENTRY = struct.Struct("<qIQIQI")
+# The user's storage needed no more setup, see Storage.known_users
+KNOWN = 1
+# Holds the generation of the snapshots written when the bot last stopped cleanly
+GENERATION_NAME = ".generation"
+GENERATION_SIZE = 16
+
+
+class Snapshot:
+    """Per-user manifests and search indexes as they were when the previous run stopped.
+
+    The file is memory-mapped and a user's record is found by binary search
+    in the sorted table of users, so opening a snapshot costs the same for
+    ten users as for a million and only the records that are used are ever
+    parsed. Every part of a record can be taken once: after that the live
+    data may have moved on. The file is unlinked when opened, so a run that
+    does not stop cleanly leaves no snapshot behind to be trusted.
+
+    A snapshot is only used if it carries the generation of the data
+    directory, see take_generation: one left over from another run, or from
+    before the data was restored from a backup, is ignored.
+    """
+
+    def __init__(self, data: mmap.mmap | bytes):
+        self._data = data
+        magic, self.users, self.generation = HEADER.unpack_from(data, 0)
+        if magic != MAGIC or len(data) < HEADER.size + self.users * ENTRY.size:
+            raise ValueError("Not a snapshot")
+        self._taken_manifests: set[int] = set()
+        self._taken_search_indexes: set[int] = set()
+
+    @classmethod
+    def open(cls, path: Path, generation: bytes | None) -> "Snapshot | None":
+        try:
+            with open(path, "rb") as f:
+                try:
+                    data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                except ValueError:
+                    # Empty file
+                    data = b""
+        except FileNotFoundError:
+            return None
+        finally:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+        try:
+            snapshot = cls(data)
+        except (ValueError, struct.error):
+            logger.warning("Ignoring invalid snapshot %s", path)
+            return None
+        if snapshot.generation != generation:
+            logger.warning("Ignoring snapshot %s, the data changed after it was written", path)
+            snapshot.close()
+            return None
+        return snapshot
+
+    def _entry(self, user_id: int) -> tuple | None:
+        low, high = 0, self.users
+        while low < high:
+            middle = (low + high) // 2
+            entry = ENTRY.unpack_from(self._data, HEADER.size + middle * ENTRY.size)
+            if entry[0] < user_id:
+                low = middle + 1
+            elif entry[0] > user_id:
+                high = middle
+            else:
+                return entry
+        return None
+
+    def _part(self, offset: int, length: int) -> str:
+        return self._data[offset : offset + length].decode("utf-8")
+
+    def take_manifest(self, user_id: int) -> tuple[str, bool] | None:
+        """The user's manifest JSON and whether their storage needed no more setup"""
+        if user_id in self._taken_manifests:
+            return None
+        self._taken_manifests.add(user_id)
+        entry = self._entry(user_id)
+        if entry is None:
+            return None
+        _, flags, offset, length, _, _ = entry
+        return self._part(offset, length), bool(flags & KNOWN)
+
+    def take_search_index(self, user_id: int) -> str | None:
+        if user_id in self._taken_search_indexes:
+            return None
+        self._taken_search_indexes.add(user_id)
+        entry = self._entry(user_id)
+        if entry is None or not entry[5]:
+            return None
+        return self._part(entry[4], entry[5])
+
+    def untaken(self) -> Iterator[tuple[int, int, bytes, bytes | None]]:
+        """Records of the users whose manifest was not taken, for the next snapshot"""
+        for position in range(self.users):
+            user_id, flags, offset, length, search_offset, search_length = ENTRY.unpack_from(
+                self._data, HEADER.size + position * ENTRY.size
+            )
+            if user_id in self._taken_manifests:
+                continue
+            search = self._data[search_offset : search_offset + search_length] if search_length else None
+            yield user_id, flags, self._data[offset : offset + length], search
+
+    def untaken_search_index(self, user_id: int) -> bytes | None:
+        """The user's search index JSON for the next snapshot, unless it was taken"""
+        if user_id in self._taken_search_indexes:
+            return None
+        entry = self._entry(user_id)
+        if entry is None or not entry[5]:
+            return None
+        return self._data[entry[4] : entry[4] + entry[5]]
+
+    def close(self) -> None:
+        if isinstance(self._data, mmap.mmap):
+            self._data.close()
+
+
+def write_snapshot(path: Path, records: Iterable[tuple[int, int, bytes, bytes | None]], generation: bytes) -> int:
+    """Write (user id, flags, manifest JSON, search index JSON or None) records, returns the number of users"""
+    records = sorted(records, key=lambda record: record[0])
+    offset = HEADER.size + len(records) * ENTRY.size
+    table = []
+    for user_id, flags, manifest, search in records:
+        search = search or b""
+        table.append(ENTRY.pack(user_id, flags, offset, len(manifest), offset + len(manifest), len(search)))
+        offset += len(manifest) + len(search)
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, len(records), generation))
+        f.writelines(table)
+        for _, _, manifest, search in records:
+            f.write(manifest)
+            if search:
+                f.write(search)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    fsync_dir(path.parent)
+    return len(records)
+
+
+def new_generation() -> bytes:
+    return os.urandom(GENERATION_SIZE)
+
+
+def take_generation(directory: Path) -> bytes | None:
+    """Generation of the snapshots that match the data in directory, None if there are none.
+
+    The marker is removed, so from here on the data may change: if this run
+    does not stop cleanly and call save_generation, no snapshot is trusted
+    next time. Backups carry an empty marker, so restoring one into the
+    directory also invalidates the snapshots already there.
+    """
+    path = directory / GENERATION_NAME
+    try:
+        generation = path.read_bytes()
+    except FileNotFoundError:
+        return None
+    path.unlink()
+    fsync_dir(directory)
+    return generation if len(generation) == GENERATION_SIZE else None
+
+
+def save_generation(directory: Path, generation: bytes) -> None:
+    """Mark the snapshots of this generation as matching the data, call once they are all written"""
+    path = directory / GENERATION_NAME
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, "wb") as f:
+        f.write(generation)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    fsync_dir(directory)
+
+
+def remove_stale_snapshots(directory: Path, keep: Iterable[Path]) -> None:
+    """Delete the snapshots in directory other than keep, e.g. of a different number of worker processes"""
+    keep = set(keep)
+    for path in directory.glob(".snapshot*"):
+        if path not in keep:
+            logger.info("Removing stale snapshot %s", path)
+            path.unlink(missing_ok=True)
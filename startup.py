@@ -0,0 +1,71 @@
+import logging
+import os
+import time
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from telegram.request import BaseRequest
+
+logger = logging.getLogger("bot.startup")
+
+# When this module was imported, i.e. when the bot's own code started running
+IMPORTED = time.time()
+
+
+def process_start_time() -> float:
+    """Wall clock time the process was started, the time of import where /proc is unavailable"""
+    try:
+        with open("/proc/self/stat", "rb") as f:
+            # The command name may contain spaces, the fields after it don't
+            fields = f.read().rsplit(b")", 1)[1].split()
+        with open("/proc/stat", "rb") as f:
+            boot_time = next(int(line.split()[1]) for line in f if line.startswith(b"btime"))
+    except (OSError, StopIteration, IndexError, ValueError):
+        return IMPORTED
+    # starttime is the 22nd field of stat, the 20th after the command name
+    return boot_time + int(fields[19]) / os.sysconf("SC_CLK_TCK")
+
+
+class StartupTimer:
+    """Durations of the steps from process start until the bot is ready for updates.
+
+    ``mark`` ends a step; ``finish`` ends the last one and logs all of them
+    on one line, once. The first step, "interpreter", lasts until this module
+    was imported.
+    """
+
+    def __init__(self):
+        self.started = process_start_time()
+        self.steps: list[tuple[str, float]] = []
+        self._last = self.started
+        self.finished = False
+        self.mark("interpreter", IMPORTED)
+
+    def mark(self, step: str, now: float | None = None) -> None:
+        now = time.time() if now is None else now
+        self.steps.append((step, now - self._last))
+        self._last = now
+
+    def finish(self, step: str) -> None:
+        if self.finished:
+            return
+        self.mark(step)
+        self.finished = True
+        logger.info(
+            "Started in %.2fs: %s",
+            self._last - self.started,
+            ", ".join(f"{name} {seconds:.3f}s" for name, seconds in self.steps),
+        )
+
+    def finish_on_first_request(self, request: "BaseRequest", step: str) -> "BaseRequest":
+        """Finish with ``step`` as soon as the request object sends its first request"""
+        do_request = request.do_request
+
+        async def first_request(*args, **kwargs):
+            # Later requests go straight to the original method
+            del request.do_request
+            self.finish(step)
+            return await do_request(*args, **kwargs)
+
+        request.do_request = first_request
+        return request
@@ -0,0 +1,1261 @@
+import asyncio
+import io
+import itertools
+import logging
+import os
+import sqlite3
+import tarfile
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import AsyncIterator, Callable, Iterator
+
+from cache import ListCache, VersionedCache
+from items import DedupeIndex, Item, merge_quantity, normalize_item, toggle_items
+from journal import FORMAT_HEADER, ListJournal, atomic_write_lines, read_legacy_list
+from manifest import ListInfo, Manifest
+from search import SearchIndex
+from snapshot import KNOWN, Snapshot, write_snapshot
+
+logger = logging.getLogger("bot.storage")
+
+
+def add_to_tar(tar: tarfile.TarFile, name: str, data: bytes) -> None:
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = int(time.time())
+    tar.addfile(info, io.BytesIO(data))
+
+
+def order_list_names(names) -> list[str]:
+    all_lists = sorted(names)
+    # Ensure 'default' is always first if it exists
+    if "default" in all_lists:
+        all_lists.remove("default")
+        all_lists.insert(0, "default")
+    return all_lists
+
+
+class Storage:
+    """Interface of a purchase lists backend.
+
+    List names are expected to be already sanitized by the caller. Items are
+    addressed by their 0-based position in the list.
+    """
+
+    # Whether save_search_indexes keeps anything, the indexes are built from the lists otherwise
+    stores_search_indexes = False
+    # Whether backup copies all data at once, or it is copied user by user with backup_user
+    backs_up_at_once = False
+
+    def list_names(self, user_id: int) -> list[str]:
+        raise NotImplementedError
+
+    def exists(self, user_id: int, list_name: str) -> bool:
+        raise NotImplementedError
+
+    def read(self, user_id: int, list_name: str) -> list[Item]:
+        raise NotImplementedError
+
+    def read_slice(self, user_id: int, list_name: str, start: int, stop: int) -> list[Item]:
+        """Items at positions start..stop-1, backends override it to avoid reading the whole list"""
+        return self.read(user_id, list_name)[start:stop]
+
+    def read_pages(self, user_id: int, list_name: str, size: int) -> Iterator[list[Item]]:
+        """All items of a list, ``size`` at a time; backends override it to avoid holding the whole list"""
+        start = 0
+        while page := self.read_slice(user_id, list_name, start, start + size):
+            yield page
+            start += len(page)
+
+    def write(self, user_id: int, list_name: str, items: list[Item]) -> None:
+        raise NotImplementedError
+
+    def delete(self, user_id: int, list_name: str) -> None:
+        raise NotImplementedError
+
+    def append(self, user_id: int, list_name: str, items: list[Item]) -> None:
+        self.write(user_id, list_name, self.read(user_id, list_name) + list(items))
+
+    def toggle(self, user_id: int, list_name: str, index: int) -> None:
+        self.write(user_id, list_name, toggle_items(self.read(user_id, list_name), index))
+
+    def merge(self, user_id: int, list_name: str, changed: dict[int, Item], appended: list[Item]) -> None:
+        """Replace the items at the positions in ``changed`` and append ``appended``, as one write"""
+        items = self.read(user_id, list_name)
+        for index, item in changed.items():
+            items[index] = item
+        self.write(user_id, list_name, items + list(appended))
+
+    def load_manifest(self, user_id: int) -> Manifest:
+        """Names and counters of all lists of the user, rebuilt from the lists by default"""
+        return Manifest({name: ListInfo.of(self.read(user_id, name)) for name in self.list_names(user_id)})
+
+    def save_manifest(self, user_id: int, manifest: Manifest) -> None:
+        """Store the manifest after a change, unless the backend keeps it up to date by itself"""
+
+    def load_search_index(self, user_id: int) -> SearchIndex | None:
+        """Stored search index of the user's lists, None if there is none (it is then built from the lists)"""
+        return None
+
+    def save_search_indexes(self, indexes: dict[int, str]) -> None:
+        """Store serialized search indexes by user, unless the backend builds them from its own data"""
+
+    def known_users(self) -> set[int]:
+        """Users whose storage needs no more setup (directories, format conversion) in this process"""
+        return set()
+
+    def user_ids(self) -> list[int]:
+        """All users that have lists"""
+        raise NotImplementedError
+
+    def usage(self, user_id: int) -> int:
+        """Bytes the user's data takes up on disk, 0 if it isn't stored separately per user (see ``reclaim``)"""
+        return 0
+
+    def compact(self, user_id: int) -> None:
+        """Fold changes recorded since the user's lists were last written into them"""
+
+    def reclaim(self) -> int:
+        """Give space freed by removed data back to the file system, returns the number of bytes"""
+        return 0
+
+    def backup(self, tar: tarfile.TarFile) -> bool:
+        """Add a consistent copy of all data to the archive, False if it is copied user by user instead"""
+        return False
+
+    def backup_user(self, tar: tarfile.TarFile, user_id: int) -> None:
+        """Add the user's data to the archive, laid out the way this backend stores it"""
+        raise NotImplementedError
+
+    def assume_known(self, user_id: int) -> None:
+        """Skip the setup of a user's storage, it was done by a previous run (see ``known_users``)"""
+
+    def load_user_state(self, user_id: int) -> str | None:
+        """Serialized per-user bot state (active list etc.), None if never saved"""
+        raise NotImplementedError
+
+    def save_user_states(self, states: dict[int, str]) -> None:
+        raise NotImplementedError
+
+    def load_history(self, user_id: int) -> str | None:
+        """Serialized history of the items the user added (see suggest.HistoryTrie), None if never saved"""
+        raise NotImplementedError
+
+    def save_histories(self, histories: dict[int, str]) -> None:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+class FileStorage(Storage):
+    """One directory per user with one text file per list.
+
+    Changes to a list are appended to a journal next to its file and
+    periodically compacted, see ListJournal. The manifest is kept in
+    .manifest.json and rebuilt from the list files if it is missing.
+    List files of the old plain text format (.txt) are converted to item
+    records the first time the user's lists are accessed. The search index
+    of a user's lists is kept in .search.json, the history of their items
+    in .history.json.
+    """
+
+    stores_search_indexes = True
+
+    def __init__(self, base_dir: Path):
+        self.base_dir = Path(base_dir)
+        self._created_dirs: set[int] = set()
+        self._migrated_users: set[int] = set()
+        self._migration_lock = threading.Lock()
+
+    def user_dir(self, user_id: int) -> Path:
+        return self.base_dir / str(user_id)
+
+    def list_path(self, user_id: int, list_name: str) -> Path:
+        return self.user_dir(user_id) / f"{list_name}.jsonl"
+
+    def list_names(self, user_id: int) -> list[str]:
+        self._migrate_legacy_lists(user_id)
+        return order_list_names(p.stem for p in self.user_dir(user_id).glob("*.jsonl") if p.is_file())
+
+    def _migrate_legacy_lists(self, user_id: int) -> None:
+        if user_id in self._migrated_users:
+            return
+        with self._migration_lock:
+            if user_id in self._migrated_users:
+                return
+            for legacy_path in self.user_dir(user_id).glob("*.txt"):
+                journal = ListJournal(legacy_path.with_suffix(".jsonl"))
+                # Already converted if a crash interrupted the migration after writing the new file
+                if not journal.exists():
+                    # Also drops the legacy journal and page index, they share their names with the new ones
+                    journal.write(read_legacy_list(legacy_path))
+                legacy_path.unlink()
+                logger.info("Converted list '%s' of user %s to item records", legacy_path.stem, user_id)
+            self._migrated_users.add(user_id)
+
+    def known_users(self) -> set[int]:
+        return self._migrated_users & self._created_dirs
+
+    def assume_known(self, user_id: int) -> None:
+        self._migrated_users.add(user_id)
+        self._created_dirs.add(user_id)
+
+    def user_ids(self) -> list[int]:
+        try:
+            with os.scandir(self.base_dir) as entries:
+                return [int(entry.name) for entry in entries if entry.name.isdigit() and entry.is_dir()]
+        except FileNotFoundError:
+            return []
+
+    def usage(self, user_id: int) -> int:
+        try:
+            with os.scandir(self.user_dir(user_id)) as entries:
+                return sum(entry.stat().st_size for entry in entries if entry.is_file())
+        except FileNotFoundError:
+            return 0
+
+    def compact(self, user_id: int) -> None:
+        manifest_path = self.manifest_path(user_id)
+        try:
+            up_to_date = not self._changed_since(user_id, manifest_path.stat().st_mtime_ns)
+        except FileNotFoundError:
+            up_to_date = False
+        compacted = False
+        for journal_path in self.user_dir(user_id).glob("*.log"):
+            journal = self.journal(user_id, journal_path.stem)
+            if journal.exists():
+                journal.compact()
+                compacted = True
+            else:
+                # A journal without its list file applies to nothing
+                journal_path.unlink(missing_ok=True)
+        if compacted and up_to_date:
+            # Compaction changes no counters, the manifest shouldn't look older than the lists for it
+            os.utime(manifest_path)
+
+    def backup_user(self, tar: tarfile.TarFile, user_id: int) -> None:
+        """Lists are added with their journals folded in: a journal only applies to the very file it was written for.
+
+        Nothing is written, not even the conversion of lists of the old
+        format: with worker processes the user may belong to another one.
+        """
+        user_dir = self.user_dir(user_id)
+        lists = {path.stem: path for path in user_dir.glob("*.txt") if path.is_file()}
+        # A converted list wins over its legacy file, left behind if a crash interrupted the migration
+        lists.update((path.stem, path) for path in user_dir.glob("*.jsonl") if path.is_file())
+        for list_name, path in sorted(lists.items()):
+            try:
+                items = read_legacy_list(path) if path.suffix == ".txt" else ListJournal(path).read()
+            except FileNotFoundError:
+                # Deleted or converted meanwhile
+                continue
+            lines = [FORMAT_HEADER, *(item.to_json() for item in items)]
+            data = "".join(f"{line}\n" for line in lines).encode("utf-8")
+            add_to_tar(tar, f"{user_id}/{list_name}.jsonl", data)
+        for path in (self.manifest_path(user_id), self.state_path(user_id), self.history_path(user_id)):
+            try:
+                data = path.read_bytes()
+            except FileNotFoundError:
+                continue
+            add_to_tar(tar, f"{user_id}/{path.name}", data)
+
+    def _ensure_user_dir(self, user_id: int) -> None:
+        if user_id not in self._created_dirs:
+            self.user_dir(user_id).mkdir(parents=True, exist_ok=True)
+            self._created_dirs.add(user_id)
+
+    def journal(self, user_id: int, list_name: str, create: bool = False) -> ListJournal:
+        self._migrate_legacy_lists(user_id)
+        if create:
+            self._ensure_user_dir(user_id)
+        return ListJournal(self.list_path(user_id, list_name))
+
+    def exists(self, user_id: int, list_name: str) -> bool:
+        return self.journal(user_id, list_name).exists()
+
+    def read(self, user_id: int, list_name: str) -> list[Item]:
+        return self.journal(user_id, list_name).read()
+
+    def read_slice(self, user_id: int, list_name: str, start: int, stop: int) -> list[Item]:
+        return self.journal(user_id, list_name).read_slice(start, stop)
+
+    def read_pages(self, user_id: int, list_name: str, size: int) -> Iterator[list[Item]]:
+        return self.journal(user_id, list_name).read_pages(size)
+
+    def write(self, user_id: int, list_name: str, items: list[Item]) -> None:
+        self.journal(user_id, list_name, create=True).write(items)
+
+    def delete(self, user_id: int, list_name: str) -> None:
+        self.journal(user_id, list_name).delete()
+
+    def append(self, user_id: int, list_name: str, items: list[Item]) -> None:
+        self.journal(user_id, list_name, create=True).append(
+            *(["+", item.text, item.ts, 1] if item.crossed else ["+", item.text, item.ts] for item in items)
+        )
+
+    def toggle(self, user_id: int, list_name: str, index: int) -> None:
+        self.journal(user_id, list_name, create=True).append(["t", index, int(time.time())])
+
+    def merge(self, user_id: int, list_name: str, changed: dict[int, Item], appended: list[Item]) -> None:
+        self.journal(user_id, list_name, create=True).append(
+            *(["s", index, item.text, item.ts] for index, item in changed.items()),
+            *(["+", item.text, item.ts] for item in appended),
+        )
+
+    def manifest_path(self, user_id: int) -> Path:
+        return self.user_dir(user_id) / ".manifest.json"
+
+    def load_manifest(self, user_id: int) -> Manifest:
+        path = self.manifest_path(user_id)
+        try:
+            saved = path.stat().st_mtime_ns
+            manifest = Manifest.from_json(path.read_text(encoding="utf-8"))
+        except FileNotFoundError:
+            pass
+        except (ValueError, TypeError):
+            logger.warning("Rebuilding corrupted manifest of user %s", user_id)
+        else:
+            return self._update_manifest(user_id, manifest, saved)
+        manifest = Manifest(
+            {
+                name: ListInfo.of(self.read(user_id, name), self.list_path(user_id, name).stat().st_mtime)
+                for name in self.list_names(user_id)
+            }
+        )
+        if len(manifest):
+            self.save_manifest(user_id, manifest)
+        return manifest
+
+    def _update_manifest(self, user_id: int, manifest: Manifest, saved: int) -> Manifest:
+        """Rebuild the counters of the lists written since the manifest was saved at ``saved`` (ns).
+
+        A list change and the manifest save that follows it are separate
+        writes, so a crash between them leaves the manifest behind the list.
+        Timestamps can be coarser than the time between the two writes, so
+        lists written in the same tick as the manifest are read again too.
+        """
+        names = set(self.list_names(user_id))
+        removed = [name for name in manifest.names if name not in names]
+        for name in removed:
+            manifest.remove(name)
+        changed = set(self._changed_since(user_id, saved))
+        changed.update(name for name in names if name not in manifest)
+        stale = len(removed)
+        for name in changed:
+            info = ListInfo.of(self.read(user_id, name), self.list_path(user_id, name).stat().st_mtime)
+            old = manifest.get(name)
+            if old is None or (old.items, old.crossed) != (info.items, info.crossed):
+                stale += 1
+            manifest.set(name, info)
+        if stale:
+            logger.warning("Rebuilt the counters of %s lists of user %s changed after the manifest", stale, user_id)
+        if removed or changed:
+            self.save_manifest(user_id, manifest)
+        return manifest
+
+    def _changed_since(self, user_id: int, since: int) -> list[str]:
+        """Lists whose file or journal was written at or after the time (ns)"""
+        changed = []
+        for path in self.user_dir(user_id).glob("*.jsonl"):
+            journal = ListJournal(path)
+            for written in (journal.snapshot_path, journal.journal_path):
+                try:
+                    if os.stat(written).st_mtime_ns >= since:
+                        changed.append(path.stem)
+                        break
+                except FileNotFoundError:
+                    continue
+        return changed
+
+    def save_manifest(self, user_id: int, manifest: Manifest) -> None:
+        self._ensure_user_dir(user_id)
+        atomic_write_lines(self.manifest_path(user_id), [manifest.to_json()])
+
+    def search_index_path(self, user_id: int) -> Path:
+        return self.user_dir(user_id) / ".search.json"
+
+    def load_search_index(self, user_id: int) -> SearchIndex | None:
+        try:
+            return SearchIndex.from_json(self.search_index_path(user_id).read_text(encoding="utf-8"))
+        except FileNotFoundError:
+            return None
+        except (ValueError, TypeError):
+            logger.warning("Rebuilding corrupted search index of user %s", user_id)
+            return None
+
+    def save_search_indexes(self, indexes: dict[int, str]) -> None:
+        for user_id, data in indexes.items():
+            self._ensure_user_dir(user_id)
+            atomic_write_lines(self.search_index_path(user_id), [data])
+
+    def state_path(self, user_id: int) -> Path:
+        return self.user_dir(user_id) / ".state.json"
+
+    def load_user_state(self, user_id: int) -> str | None:
+        try:
+            return self.state_path(user_id).read_text(encoding="utf-8").strip()
+        except FileNotFoundError:
+            return None
+
+    def save_user_states(self, states: dict[int, str]) -> None:
+        for user_id, state in states.items():
+            self._ensure_user_dir(user_id)
+            atomic_write_lines(self.state_path(user_id), [state])
+
+    def history_path(self, user_id: int) -> Path:
+        return self.user_dir(user_id) / ".history.json"
+
+    def load_history(self, user_id: int) -> str | None:
+        try:
+            return self.history_path(user_id).read_text(encoding="utf-8").strip()
+        except FileNotFoundError:
+            return None
+
+    def save_histories(self, histories: dict[int, str]) -> None:
+        for user_id, data in histories.items():
+            self._ensure_user_dir(user_id)
+            atomic_write_lines(self.history_path(user_id), [data])
+
+
+class SqliteStorage(Storage):
+    """All lists in a single SQLite database in WAL mode.
+
+    Every thread gets its own connection, so readers never block each other.
+    """
+
+    backs_up_at_once = True
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS lists (
+            user_id INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            item_count INTEGER NOT NULL DEFAULT 0,
+            crossed_count INTEGER NOT NULL DEFAULT 0,
+            mtime INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, name)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS items (
+            user_id INTEGER NOT NULL,
+            list_name TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            text TEXT NOT NULL,
+            crossed INTEGER NOT NULL DEFAULT 0,
+            ts INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, list_name, position)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS user_state (
+            user_id INTEGER PRIMARY KEY,
+            state TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS histories (
+            user_id INTEGER PRIMARY KEY,
+            history TEXT NOT NULL
+        );
+    """
+
+    # Positions may have gaps after removals, so the n-th item is located by offset
+    NTH_POSITION = "(SELECT position FROM items WHERE user_id = ? AND list_name = ? ORDER BY position LIMIT 1 OFFSET ?)"
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._local = threading.local()
+        self._connections: list[sqlite3.Connection] = []
+        self._connections_lock = threading.Lock()
+        with self._connection() as conn:
+            conn.executescript(self.SCHEMA)
+            self._migrate(conn)
+
+    @staticmethod
+    def _migrate(conn: sqlite3.Connection) -> None:
+        columns = {name for (_, name, *_) in conn.execute("PRAGMA table_info(lists)")}
+        if "item_count" not in columns:
+            # Databases created before the list counters were added, they are filled in below
+            conn.execute("ALTER TABLE lists ADD COLUMN item_count INTEGER NOT NULL DEFAULT 0")
+            conn.execute("ALTER TABLE lists ADD COLUMN crossed_count INTEGER NOT NULL DEFAULT 0")
+            conn.execute("ALTER TABLE lists ADD COLUMN mtime INTEGER NOT NULL DEFAULT 0")
+        elif "crossed" in {name for (_, name, *_) in conn.execute("PRAGMA table_info(items)")}:
+            return
+        # Databases created before items had a crossed flag, crossed texts were wrapped in '~'
+        conn.execute("ALTER TABLE items ADD COLUMN crossed INTEGER NOT NULL DEFAULT 0")
+        conn.execute("ALTER TABLE items ADD COLUMN ts INTEGER NOT NULL DEFAULT 0")
+        conn.execute(
+            "UPDATE items SET crossed = 1, text = substr(text, 2, length(text) - 2) "
+            "WHERE length(text) >= 2 AND text LIKE '~%~'"
+        )
+        conn.execute(
+            "UPDATE lists SET "
+            "item_count = (SELECT COUNT(*) FROM items WHERE items.user_id = lists.user_id AND list_name = name), "
+            "crossed_count = (SELECT COUNT(*) FROM items "
+            "WHERE items.user_id = lists.user_id AND list_name = name AND crossed = 1)"
+        )
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            # Lets reclaim() shrink the file; only takes effect while the database is still empty
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+
+    def list_names(self, user_id: int) -> list[str]:
+        rows = self._connection().execute("SELECT name FROM lists WHERE user_id = ?", (user_id,))
+        return order_list_names(name for (name,) in rows)
+
+    def exists(self, user_id: int, list_name: str) -> bool:
+        row = (
+            self._connection()
+            .execute("SELECT 1 FROM lists WHERE user_id = ? AND name = ?", (user_id, list_name))
+            .fetchone()
+        )
+        return row is not None
+
+    def read(self, user_id: int, list_name: str) -> list[Item]:
+        rows = self._connection().execute(
+            "SELECT text, crossed, ts FROM items WHERE user_id = ? AND list_name = ? ORDER BY position",
+            (user_id, list_name),
+        )
+        return [Item(text, bool(crossed), ts) for text, crossed, ts in rows]
+
+    def read_slice(self, user_id: int, list_name: str, start: int, stop: int) -> list[Item]:
+        rows = self._connection().execute(
+            "SELECT text, crossed, ts FROM items WHERE user_id = ? AND list_name = ? ORDER BY position LIMIT ? OFFSET ?",
+            (user_id, list_name, max(0, stop - start), start),
+        )
+        return [Item(text, bool(crossed), ts) for text, crossed, ts in rows]
+
+    def read_pages(self, user_id: int, list_name: str, size: int) -> Iterator[list[Item]]:
+        """Paged by position rather than OFFSET, so every page is a lookup in the primary key"""
+        position = -1
+        while True:
+            rows = (
+                self._connection()
+                .execute(
+                    "SELECT position, text, crossed, ts FROM items"
+                    " WHERE user_id = ? AND list_name = ? AND position > ? ORDER BY position LIMIT ?",
+                    (user_id, list_name, position, size),
+                )
+                .fetchall()
+            )
+            if not rows:
+                return
+            yield [Item(text, bool(crossed), ts) for _, text, crossed, ts in rows]
+            position = rows[-1][0]
+
+    def write(self, user_id: int, list_name: str, items: list[Item]) -> None:
+        info = ListInfo.of(items)
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO lists (user_id, name, item_count, crossed_count, mtime) VALUES (?, ?, ?, ?, ?)",
+                (user_id, list_name, info.items, info.crossed, info.mtime),
+            )
+            conn.execute("DELETE FROM items WHERE user_id = ? AND list_name = ?", (user_id, list_name))
+            conn.executemany(
+                "INSERT INTO items (user_id, list_name, position, text, crossed, ts) VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (user_id, list_name, position, item.text, int(item.crossed), item.ts)
+                    for position, item in enumerate(items)
+                ],
+            )
+
+    def delete(self, user_id: int, list_name: str) -> None:
+        with self._connection() as conn:
+            conn.execute("DELETE FROM items WHERE user_id = ? AND list_name = ?", (user_id, list_name))
+            conn.execute("DELETE FROM lists WHERE user_id = ? AND name = ?", (user_id, list_name))
+
+    def append(self, user_id: int, list_name: str, items: list[Item]) -> None:
+        with self._connection() as conn:
+            self._insert_items(conn, user_id, list_name, items)
+
+    @staticmethod
+    def _insert_items(conn: sqlite3.Connection, user_id: int, list_name: str, items: list[Item]) -> None:
+        conn.execute("INSERT OR IGNORE INTO lists (user_id, name) VALUES (?, ?)", (user_id, list_name))
+        conn.execute(
+            "UPDATE lists SET item_count = item_count + ?, crossed_count = crossed_count + ?, mtime = ?"
+            " WHERE user_id = ? AND name = ?",
+            (len(items), sum(1 for item in items if item.crossed), int(time.time()), user_id, list_name),
+        )
+        (last,) = conn.execute(
+            "SELECT COALESCE(MAX(position), -1) FROM items WHERE user_id = ? AND list_name = ?",
+            (user_id, list_name),
+        ).fetchone()
+        conn.executemany(
+            "INSERT INTO items (user_id, list_name, position, text, crossed, ts) VALUES (?, ?, ?, ?, ?, ?)",
+            [
+                (user_id, list_name, last + offset, item.text, int(item.crossed), item.ts)
+                for offset, item in enumerate(items, 1)
+            ],
+        )
+
+    def merge(self, user_id: int, list_name: str, changed: dict[int, Item], appended: list[Item]) -> None:
+        with self._connection() as conn:
+            conn.executemany(
+                f"UPDATE items SET text = ?, ts = ? WHERE user_id = ? AND list_name = ? AND position = {self.NTH_POSITION}",
+                [(item.text, item.ts, user_id, list_name, user_id, list_name, index) for index, item in changed.items()],
+            )
+            if appended:
+                self._insert_items(conn, user_id, list_name, appended)
+            elif changed:
+                conn.execute(
+                    "UPDATE lists SET mtime = ? WHERE user_id = ? AND name = ?", (int(time.time()), user_id, list_name)
+                )
+
+    def toggle(self, user_id: int, list_name: str, index: int) -> None:
+        nth_position = self.NTH_POSITION
+        params = (user_id, list_name, user_id, list_name, index)
+        now = int(time.time())
+        with self._connection() as conn:
+            crossed = conn.execute(
+                "UPDATE items SET crossed = 1, ts = ? "
+                f"WHERE user_id = ? AND list_name = ? AND position = {nth_position} AND crossed = 0",
+                (now, *params),
+            )
+            if crossed.rowcount:
+                counters = "crossed_count = crossed_count + 1"
+            else:
+                removed = conn.execute(
+                    f"DELETE FROM items WHERE user_id = ? AND list_name = ? AND position = {nth_position}",
+                    params,
+                )
+                if not removed.rowcount:
+                    return
+                counters = "item_count = item_count - 1, crossed_count = crossed_count - 1"
+            conn.execute(
+                f"UPDATE lists SET {counters}, mtime = ? WHERE user_id = ? AND name = ?",
+                (now, user_id, list_name),
+            )
+
+    def load_manifest(self, user_id: int) -> Manifest:
+        rows = self._connection().execute(
+            "SELECT name, item_count, crossed_count, mtime FROM lists WHERE user_id = ?", (user_id,)
+        )
+        return Manifest({name: ListInfo(items, crossed, mtime) for name, items, crossed, mtime in rows})
+
+    def load_search_index(self, user_id: int) -> SearchIndex:
+        """Built from the items table with one query, so there is nothing to store"""
+        conn = self._connection()
+        index = SearchIndex()
+        rows = conn.execute("SELECT list_name, text FROM items WHERE user_id = ? ORDER BY list_name", (user_id,))
+        for list_name, group in itertools.groupby(rows, key=lambda row: row[0]):
+            index.add(list_name, (text for _, text in group))
+        # Stamped after reading the items, a list changed meanwhile then looks stale and is indexed again
+        for name, items, crossed, mtime in conn.execute(
+            "SELECT name, item_count, crossed_count, mtime FROM lists WHERE user_id = ?", (user_id,)
+        ):
+            index.add(name, ())
+            index.stamp(name, ListInfo(items, crossed, mtime))
+        return index
+
+    def user_ids(self) -> list[int]:
+        return [user_id for (user_id,) in self._connection().execute("SELECT DISTINCT user_id FROM lists")]
+
+    def _file_sizes(self) -> int:
+        size = 0
+        for path in (self.path, self.path.with_name(self.path.name + "-wal")):
+            try:
+                size += path.stat().st_size
+            except FileNotFoundError:
+                pass
+        return size
+
+    def reclaim(self) -> int:
+        """Release free pages (databases created with incremental auto-vacuum only) and truncate the WAL"""
+        before = self._file_sizes()
+        conn = self._connection()
+        conn.execute("PRAGMA incremental_vacuum").fetchall()
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+        return before - self._file_sizes()
+
+    def backup(self, tar: tarfile.TarFile) -> bool:
+        """Copied with VACUUM INTO, which reads in one transaction and so doesn't hold up writers in WAL mode"""
+        with tempfile.TemporaryDirectory(dir=Path(tar.name).parent if tar.name else None) as tmp_dir:
+            copy_path = Path(tmp_dir) / self.path.name
+            self._connection().execute("VACUUM INTO ?", (str(copy_path),))
+            tar.add(copy_path, arcname=self.path.name)
+        return True
+
+    def load_user_state(self, user_id: int) -> str | None:
+        row = self._connection().execute("SELECT state FROM user_state WHERE user_id = ?", (user_id,)).fetchone()
+        return row[0] if row else None
+
+    def save_user_states(self, states: dict[int, str]) -> None:
+        with self._connection() as conn:
+            conn.executemany("INSERT OR REPLACE INTO user_state (user_id, state) VALUES (?, ?)", states.items())
+
+    def load_history(self, user_id: int) -> str | None:
+        row = self._connection().execute("SELECT history FROM histories WHERE user_id = ?", (user_id,)).fetchone()
+        return row[0] if row else None
+
+    def save_histories(self, histories: dict[int, str]) -> None:
+        with self._connection() as conn:
+            conn.executemany("INSERT OR REPLACE INTO histories (user_id, history) VALUES (?, ?)", histories.items())
+
+    def close(self) -> None:
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+
+
+def payload_size(items: list[Item]) -> int:
+    return sum(len(item.text.encode("utf-8")) for item in items)
+
+
+def read_page(pages: Iterator[list[Item]]) -> list[Item] | None:
+    """Next page of ``Storage.read_pages``, None after the last one"""
+    return next(pages, None)
+
+
+class AsyncStorage:
+    """Async front of a storage backend used by the handlers.
+
+    Backend calls run in a bounded thread pool, so slow disks never block the
+    event loop. Parsed lists are kept in a write-through LRU cache that lives
+    on the event loop: cache hits are answered without leaving it, and only
+    existing lists are cached, so a hit also answers ``exists``. At most
+    ``max_queued`` calls may be in flight, further callers wait for a slot.
+
+    The manifests of the ``max_manifests`` most recently active users are
+    kept in memory and updated along with every change, so listing lists and
+    checking that a list exists need no backend call once a user's manifest
+    is loaded.
+
+    Lists that items were added to with ``add_items`` get a ``DedupeIndex``
+    under their current version, it is updated along with appends, merges
+    and toggles and rebuilt from the list after other changes.
+
+    The ``SearchIndex`` of a user's lists is loaded on the first search and
+    then kept up to date by every change, like the manifest. Changed indexes
+    are stored together ``search_flush_delay`` seconds after the first
+    change; lists changed after an index was last stored are indexed again
+    when it is loaded.
+
+    ``open_snapshot`` and ``write_snapshot`` carry the manifests and search
+    indexes over to the next run, so users' first requests after a restart
+    need no backend call to find their lists.
+
+    ``purge_crossed``, ``compact`` and ``evict`` are meant for background
+    maintenance between a user's requests, see maintenance.Maintenance.
+    """
+
+    def __init__(
+        self,
+        backend: Storage,
+        cache: ListCache | None,
+        max_workers: int,
+        max_queued: int,
+        max_manifests: int = 10000,
+        max_dedupe_indexes: int = 5000,
+        search_flush_delay: float = 5,
+    ):
+        self.backend = backend
+        self.cache = cache
+        self.max_manifests = max_manifests
+        self.dedupe_indexes = VersionedCache(max_dedupe_indexes)
+        self._manifests: OrderedDict[int, Manifest] = OrderedDict()
+        self._search_indexes: OrderedDict[int, SearchIndex] = OrderedDict()
+        self.search_flush_delay = search_flush_delay
+        self._dirty_search_indexes: set[int] = set()
+        self._pending_search_write: asyncio.Future | None = None
+        self.snapshot: Snapshot | None = None
+        # Shared by all lists, so a version is never reused even after a manifest is reloaded
+        self._versions = itertools.count(1)
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(max_workers, thread_name_prefix="storage")
+        self._slots = asyncio.Semaphore(max_queued)
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.calls = 0
+        # Item text moved to and from the backend, in UTF-8 bytes
+        self.bytes_read = 0
+        self.bytes_written = 0
+        # Called with the duration in seconds and the name of every backend call
+        self.observer: Callable[[float, str], None] | None = None
+
+    @property
+    def queue_depth(self) -> int:
+        """Calls waiting for a free worker thread"""
+        return max(0, self.in_flight - self.max_workers)
+
+    async def _run(self, func, *args):
+        async with self._slots:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            started = time.perf_counter()
+            try:
+                return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+            finally:
+                self.in_flight -= 1
+                self.calls += 1
+                if self.observer is not None:
+                    self.observer(time.perf_counter() - started, func.__name__)
+
+    def _cached(self, user_id: int, list_name: str) -> list[Item] | None:
+        return self.cache.get(user_id, list_name) if self.cache is not None else None
+
+    def _cache_put(self, user_id: int, list_name: str, items: list[Item]) -> None:
+        if self.cache is not None:
+            self.cache.put(user_id, list_name, items)
+
+    def _cache_discard(self, user_id: int, list_name: str) -> None:
+        if self.cache is not None:
+            self.cache.discard(user_id, list_name)
+
+    def _change_failed(self, user_id: int, list_name: str) -> None:
+        """Forget what may no longer match the list after a failed backend call"""
+        self._cache_discard(user_id, list_name)
+        self._search_indexes.pop(user_id, None)
+
+    async def manifest(self, user_id: int) -> Manifest:
+        manifest = self._manifests.get(user_id)
+        if manifest is not None:
+            self._manifests.move_to_end(user_id)
+            return manifest
+        manifest = self._snapshot_manifest(user_id)
+        if manifest is None:
+            manifest = await self._run(self.backend.load_manifest, user_id)
+        # Another coroutine may have loaded it meanwhile, keep the one already in use
+        manifest = self._manifests.setdefault(user_id, manifest)
+        while len(self._manifests) > self.max_manifests:
+            self._manifests.popitem(last=False)
+        return manifest
+
+    def _snapshot_manifest(self, user_id: int) -> Manifest | None:
+        record = self.snapshot.take_manifest(user_id) if self.snapshot is not None else None
+        if record is None:
+            return None
+        data, known = record
+        if known:
+            self.backend.assume_known(user_id)
+        return Manifest.from_json(data)
+
+    def open_snapshot(self, path: Path, generation: bytes | None) -> None:
+        """Use the manifests and search indexes written by the previous run, if it stopped cleanly"""
+        self.snapshot = Snapshot.open(path, generation)
+        if self.snapshot is not None:
+            logger.info("Opened snapshot of %s users", self.snapshot.users)
+
+    def write_snapshot(self, path: Path, generation: bytes) -> None:
+        """Write the manifests and search indexes for the next run, call when no more changes are made"""
+        known = self.backend.known_users()
+        records = []
+        for user_id, manifest in self._manifests.items():
+            search_index = self._search_indexes.get(user_id)
+            if search_index is not None:
+                search = search_index.to_json().encode("utf-8")
+            elif self.snapshot is not None:
+                search = self.snapshot.untaken_search_index(user_id)
+            else:
+                search = None
+            flags = KNOWN if user_id in known else 0
+            records.append((user_id, flags, manifest.to_json().encode("utf-8"), search))
+        if self.snapshot is not None:
+            # Users not seen in this run, as the previous run left them; evicted users are left out
+            records.extend(self.snapshot.untaken())
+        try:
+            users = write_snapshot(path, records, generation)
+        except OSError:
+            logger.exception("Writing the snapshot failed")
+        else:
+            logger.info("Wrote snapshot of %s users", users)
+        if self.snapshot is not None:
+            self.snapshot.close()
+            self.snapshot = None
+
+    async def _list_changed(self, user_id: int, manifest: Manifest, list_name: str) -> None:
+        """Give the list a new version and store the updated manifest"""
+        info = manifest.get(list_name)
+        if info is not None:
+            info.version = next(self._versions)
+        search_index = self._search_indexes.get(user_id)
+        if search_index is not None:
+            if info is not None:
+                search_index.stamp(list_name, info)
+            self._search_index_changed(user_id)
+        await self._run(self.backend.save_manifest, user_id, manifest.copy())
+
+    async def version(self, user_id: int, list_name: str) -> int:
+        """Opaque version of a list, changes on every modification, 0 if the list doesn't exist"""
+        info = (await self.manifest(user_id)).get(list_name)
+        if info is None:
+            return 0
+        if not info.version:
+            info.version = next(self._versions)
+        return info.version
+
+    def _cached_dedupe_index(self, user_id: int, manifest: Manifest, list_name: str) -> DedupeIndex | None:
+        """Index of the list as it is before a change, if there is one to update"""
+        info = manifest.get(list_name)
+        if info is None or not info.version:
+            return None
+        return self.dedupe_indexes.get(user_id, list_name, info.version)
+
+    def _keep_dedupe_index(self, user_id: int, manifest: Manifest, list_name: str, index: DedupeIndex) -> None:
+        """File an index updated along with a change under the list's new version"""
+        info = manifest.get(list_name)
+        if info is not None:
+            self.dedupe_indexes.put(user_id, list_name, info.version, index)
+
+    async def dedupe_index(self, user_id: int, list_name: str) -> DedupeIndex:
+        version = await self.version(user_id, list_name)
+        index = self.dedupe_indexes.get(user_id, list_name, version)
+        if index is None:
+            index = DedupeIndex(await self.read(user_id, list_name))
+            self.dedupe_indexes.put(user_id, list_name, version, index)
+        return index
+
+    async def search_index(self, user_id: int) -> SearchIndex:
+        index = self._search_indexes.get(user_id)
+        if index is not None:
+            self._search_indexes.move_to_end(user_id)
+            return index
+        data = self.snapshot.take_search_index(user_id) if self.snapshot is not None else None
+        if data is not None:
+            index = await self._run(SearchIndex.from_json, data)
+        else:
+            index = await self._run(self.backend.load_search_index, user_id) or SearchIndex()
+        changed = False
+        while True:
+            manifest = await self.manifest(user_id)
+            stale, removed = index.stale_lists({name: manifest.get(name) for name in manifest.names})
+            if not stale and not removed:
+                break
+            changed = True
+            for name in removed:
+                index.remove_list(name)
+            for name in stale:
+                info = manifest.get(name)
+                if info is None:
+                    continue
+                # Stamped as the list was before reading it, so a change while reading is caught by the next pass
+                stamp = ListInfo(info.items, info.crossed, info.mtime)
+                index.replace_list(name, (item.text for item in await self.read(user_id, name)))
+                index.stamp(name, stamp)
+        if user_id in self._search_indexes:
+            # Loaded by another coroutine meanwhile
+            return await self.search_index(user_id)
+        self._search_indexes[user_id] = index
+        while len(self._search_indexes) > self.max_manifests:
+            self._search_indexes.popitem(last=False)
+        if changed:
+            self._search_index_changed(user_id)
+        return index
+
+    def _search_index_changed(self, user_id: int) -> None:
+        if not self.backend.stores_search_indexes:
+            return
+        self._dirty_search_indexes.add(user_id)
+        if self._pending_search_write is None:
+            self._pending_search_write = asyncio.ensure_future(self._write_search_indexes(self.search_flush_delay))
+
+    async def _write_search_indexes(self, delay: float) -> None:
+        await asyncio.sleep(delay)
+        self._pending_search_write = None
+        users, self._dirty_search_indexes = self._dirty_search_indexes, set()
+        # Indexes evicted meanwhile are brought up to date from the changed lists when loaded again
+        indexes = {
+            user_id: self._search_indexes[user_id].to_json() for user_id in users if user_id in self._search_indexes
+        }
+        if not indexes:
+            return
+        try:
+            await self._run(self.backend.save_search_indexes, indexes)
+        except Exception:
+            logger.exception("Failed to save the search indexes of %s users", len(indexes))
+
+    async def flush(self) -> None:
+        """Store changed search indexes now instead of after ``search_flush_delay``"""
+        if self._pending_search_write is not None:
+            self._pending_search_write.cancel()
+            self._pending_search_write = None
+        await self._write_search_indexes(0)
+
+    async def list_names(self, user_id: int) -> list[str]:
+        return (await self.manifest(user_id)).names
+
+    async def exists(self, user_id: int, list_name: str) -> bool:
+        if self.cache is not None and (user_id, list_name) in self.cache:
+            return True
+        return list_name in await self.manifest(user_id)
+
+    async def read(self, user_id: int, list_name: str) -> list[Item]:
+        items = self._cached(user_id, list_name)
+        if items is not None:
+            return items
+        if list_name not in await self.manifest(user_id):
+            return []
+        items = await self._run(self.backend.read, user_id, list_name)
+        self.bytes_read += payload_size(items)
+        self._cache_put(user_id, list_name, items)
+        return list(items)
+
+    async def read_slice(self, user_id: int, list_name: str, start: int, stop: int) -> list[Item]:
+        """A page of a list; read from the backend without caching the whole list on a cache miss"""
+        items = self._cached(user_id, list_name)
+        if items is not None:
+            return items[start:stop]
+        if list_name not in await self.manifest(user_id):
+            return []
+        items = await self._run(self.backend.read_slice, user_id, list_name, start, stop)
+        self.bytes_read += payload_size(items)
+        return items
+
+    async def read_pages(self, user_id: int, list_name: str, size: int) -> AsyncIterator[list[Item]]:
+        """All items of a list, ``size`` at a time, without caching the whole list on a cache miss"""
+        items = self._cached(user_id, list_name)
+        if items is not None:
+            for start in range(0, len(items), size):
+                yield items[start : start + size]
+            return
+        if list_name not in await self.manifest(user_id):
+            return
+        pages = self.backend.read_pages(user_id, list_name, size)
+        try:
+            while (page := await self._run(read_page, pages)) is not None:
+                self.bytes_read += payload_size(page)
+                yield page
+        finally:
+            pages.close()
+
+    async def write(self, user_id: int, list_name: str, items: list[Item]) -> None:
+        manifest = await self.manifest(user_id)
+        try:
+            await self._run(self.backend.write, user_id, list_name, items)
+        except Exception:
+            self._change_failed(user_id, list_name)
+            raise
+        self.bytes_written += payload_size(items)
+        self._cache_put(user_id, list_name, items)
+        search_index = self._search_indexes.get(user_id)
+        if search_index is not None:
+            search_index.replace_list(list_name, (item.text for item in items))
+        manifest.set(list_name, ListInfo.of(items))
+        await self._list_changed(user_id, manifest, list_name)
+
+    async def delete(self, user_id: int, list_name: str) -> None:
+        manifest = await self.manifest(user_id)
+        self._cache_discard(user_id, list_name)
+        try:
+            await self._run(self.backend.delete, user_id, list_name)
+        except Exception:
+            self._change_failed(user_id, list_name)
+            raise
+        search_index = self._search_indexes.get(user_id)
+        if search_index is not None:
+            search_index.remove_list(list_name)
+        manifest.remove(list_name)
+        await self._list_changed(user_id, manifest, list_name)
+
+    async def append(self, user_id: int, list_name: str, items: list[Item]) -> None:
+        manifest = await self.manifest(user_id)
+        cached = self._cached(user_id, list_name)
+        index = self._cached_dedupe_index(user_id, manifest, list_name)
+        try:
+            await self._run(self.backend.append, user_id, list_name, items)
+        except Exception:
+            self._change_failed(user_id, list_name)
+            raise
+        self.bytes_written += payload_size(items)
+        if cached is not None:
+            self._cache_put(user_id, list_name, cached + list(items))
+        search_index = self._search_indexes.get(user_id)
+        if search_index is not None:
+            search_index.add(list_name, (item.text for item in items))
+        if index is not None:
+            index.appended(manifest.get(list_name).items, items)
+        manifest.touch(list_name, added=len(items), crossed=sum(1 for item in items if item.crossed))
+        await self._list_changed(user_id, manifest, list_name)
+        if index is not None:
+            self._keep_dedupe_index(user_id, manifest, list_name, index)
+
+    async def add_items(self, user_id: int, list_name: str, items: list[Item]) -> list[Item]:
+        """Add items, an item equal to an active one (see ``normalize_item``) adds to its quantity instead.
+
+        Duplicates are looked up in the list's ``DedupeIndex``, all changes
+        are stored with one backend call. Returns the new or merged items in
+        the order they were first given, each once.
+        """
+        manifest = await self.manifest(user_id)
+        index = await self.dedupe_index(user_id, list_name)
+        info = manifest.get(list_name)
+        start = info.items if info is not None else 0
+        changed: dict[int, Item] = {}
+        # Texts the changed items had before
+        replaced: dict[int, str] = {}
+        appended: list[Item] = []
+        touched: dict[int, None] = {}
+        for item in items:
+            found = index.get(normalize_item(item.text)[0])
+            if found is None:
+                position = start + len(appended)
+                appended.append(item)
+                index.appended(position, [item])
+            else:
+                position, text = found
+                merged = Item(merge_quantity(text, item.text), False, item.ts)
+                if position >= start:
+                    appended[position - start] = merged
+                else:
+                    replaced.setdefault(position, text)
+                    changed[position] = merged
+                index.replaced(position, merged)
+            touched[position] = None
+
+        cached = self._cached(user_id, list_name)
+        try:
+            await self._run(self.backend.merge, user_id, list_name, changed, appended)
+        except Exception:
+            self._change_failed(user_id, list_name)
+            self.dedupe_indexes.discard(user_id, list_name)
+            raise
+        self.bytes_written += payload_size(appended) + payload_size(list(changed.values()))
+        if cached is not None:
+            for position, item in changed.items():
+                cached[position] = item
+            self._cache_put(user_id, list_name, cached + appended)
+        search_index = self._search_indexes.get(user_id)
+        if search_index is not None:
+            search_index.discard(list_name, replaced.values())
+            search_index.add(list_name, (item.text for item in [*changed.values(), *appended]))
+        manifest.touch(list_name, added=len(appended))
+        await self._list_changed(user_id, manifest, list_name)
+        self._keep_dedupe_index(user_id, manifest, list_name, index)
+        return [changed[position] if position < start else appended[position - start] for position in touched]
+
+    async def toggle(self, user_id: int, list_name: str, index: int) -> None:
+        manifest = await self.manifest(user_id)
+        items = await self.read(user_id, list_name)
+        if not 0 <= index < len(items):
+            return
+        dedupe_index = self._cached_dedupe_index(user_id, manifest, list_name)
+        try:
+            await self._run(self.backend.toggle, user_id, list_name, index)
+        except Exception:
+            self._change_failed(user_id, list_name)
+            raise
+        self._cache_put(user_id, list_name, toggle_items(items, index))
+        search_index = self._search_indexes.get(user_id)
+        if search_index is not None and items[index].crossed:
+            search_index.discard(list_name, [items[index].text])
+        if dedupe_index is not None:
+            dedupe_index.toggled(index, items[index])
+        if items[index].crossed:
+            manifest.touch(list_name, removed=1, crossed=-1)
+        else:
+            manifest.touch(list_name, crossed=1)
+        await self._list_changed(user_id, manifest, list_name)
+        if dedupe_index is not None:
+            self._keep_dedupe_index(user_id, manifest, list_name, dedupe_index)
+
+    async def purge_crossed(self, user_id: int, before: int) -> list[Item]:
+        """Remove the items crossed out before the timestamp from all lists of the user, returns them"""
+        manifest = await self.manifest(user_id)
+        purged = []
+        for list_name in manifest.names:
+            info = manifest.get(list_name)
+            if info is None or not info.crossed:
+                continue
+            cached = self._cached(user_id, list_name)
+            if cached is not None:
+                items = cached
+            else:
+                items = await self._run(self.backend.read, user_id, list_name)
+                self.bytes_read += payload_size(items)
+            kept = [item for item in items if not item.crossed or item.ts >= before]
+            if len(kept) == len(items):
+                continue
+            purged.extend(item for item in items if item.crossed and item.ts < before)
+            await self.write(user_id, list_name, kept)
+            if cached is None:
+                # A purge shouldn't push the lists users are working with out of the cache
+                self._cache_discard(user_id, list_name)
+        return purged
+
+    async def usage(self, user_id: int) -> int:
+        return await self._run(self.backend.usage, user_id)
+
+    async def compact(self, user_id: int) -> None:
+        await self._run(self.backend.compact, user_id)
+
+    async def reclaim(self) -> int:
+        return await self._run(self.backend.reclaim)
+
+    async def user_ids(self) -> list[int]:
+        return await self._run(self.backend.user_ids)
+
+    def is_loaded(self, user_id: int) -> bool:
+        return user_id in self._manifests
+
+    async def evict(self, user_id: int) -> list[str]:
+        """Drop everything kept in memory for the user, returns the names of their lists that were known"""
+        manifest = self._manifests.pop(user_id, None)
+        list_names = manifest.names if manifest is not None else []
+        for list_name in list_names:
+            self._cache_discard(user_id, list_name)
+            self.dedupe_indexes.discard(user_id, list_name)
+        search_index = self._search_indexes.pop(user_id, None)
+        if search_index is not None and user_id in self._dirty_search_indexes:
+            self._dirty_search_indexes.discard(user_id)
+            try:
+                await self._run(self.backend.save_search_indexes, {user_id: search_index.to_json()})
+            except Exception:
+                # Lists changed since the stored index was written are indexed again when it is loaded
+                logger.exception("Failed to save the search index of user %s", user_id)
+        return list_names
+
+    async def backup(self, tar: tarfile.TarFile) -> bool:
+        return await self._run(self.backend.backup, tar)
+
+    async def backup_user(self, tar: tarfile.TarFile, user_id: int) -> None:
+        await self._run(self.backend.backup_user, tar, user_id)
+
+    async def load_user_state(self, user_id: int) -> str | None:
+        return await self._run(self.backend.load_user_state, user_id)
+
+    async def save_user_states(self, states: dict[int, str]) -> None:
+        await self._run(self.backend.save_user_states, states)
+
+    async def load_history(self, user_id: int) -> str | None:
+        return await self._run(self.backend.load_history, user_id)
+
+    async def save_histories(self, histories: dict[int, str]) -> None:
+        await self._run(self.backend.save_histories, histories)
+
+    def stats(self) -> dict:
+        stats = {
+            "workers": self.max_workers,
+            "in_flight": self.in_flight,
+            "queue_depth": self.queue_depth,
+            "max_in_flight": self.max_in_flight,
+            "calls": self.calls,
+            "bytes_read": self.bytes_read,
+            "bytes_written": self.bytes_written,
+        }
+        stats["manifests"] = len(self._manifests)
+        stats["search_indexes"] = len(self._search_indexes)
+        stats["dedupe_indexes"] = self.dedupe_indexes.stats()
+        if self.cache is not None:
+            stats["cache"] = self.cache.stats()
+        return stats
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=True)
+        self.backend.close()
+
+
+def create_storage(backend: str, base_dir: Path, sqlite_path: Path | None = None) -> Storage:
+    if backend == "files":
+        return FileStorage(base_dir)
+    if backend == "sqlite":
+        return SqliteStorage(sqlite_path or Path(base_dir) / "lists.sqlite3")
+    raise ValueError(f"Unknown storage backend: {backend}")
@@ -0,0 +1,226 @@
+import asyncio
+import heapq
+import json
+import logging
+import time
+from collections import OrderedDict
+
+from items import WHITESPACE, normalize_item, split_quantity
+from storage import AsyncStorage
+
+logger = logging.getLogger("bot.suggest")
+
+# The weight of an item halves every two weeks it isn't added again
+HALF_LIFE = 14 * 24 * 3600
+
+
+class _Entry:
+    __slots__ = ("key", "text", "count", "last_used")
+
+    def __init__(self, key: str, text: str):
+        self.key = key
+        self.text = text
+        self.count = 0
+        self.last_used = 0
+
+    def score(self, now: float) -> float:
+        return self.count * 0.5 ** (max(0, now - self.last_used) / HALF_LIFE)
+
+
+class _Node:
+    __slots__ = ("children", "entry")
+
+    def __init__(self):
+        self.children: dict[str, _Node] = {}
+        self.entry: _Entry | None = None
+
+
+def normalize_prefix(prefix: str) -> str:
+    """A typed prefix in the form of ``normalize_item`` keys; a trailing space is kept, it ends a word"""
+    return WHITESPACE.sub(" ", prefix.lstrip()).casefold().replace("ё", "е")
+
+
+class HistoryTrie:
+    """Items a user added, in a prefix trie over their normalized text (see ``normalize_item``).
+
+    Suggestions for a prefix are ranked by how often an item was added,
+    decayed by how long ago it was last added (``HALF_LIFE``). At most
+    ``max_items`` items are kept, the lowest ranked are forgotten first.
+    Suggestions for the last ``max_cached_prefixes`` prefixes are kept
+    until the history changes, so retyping or deleting characters is
+    answered without walking the trie.
+    """
+
+    def __init__(self, max_items: int = 1000, max_cached_prefixes: int = 64):
+        self.max_items = max_items
+        self.max_cached_prefixes = max_cached_prefixes
+        self._root = _Node()
+        self._entries: dict[str, _Entry] = {}
+        self._cache: OrderedDict[tuple[str, int], list[str]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def record(self, text: str, ts: int | None = None, count: int = 1) -> None:
+        """An item was added ``count`` times, last at ``ts``; it is suggested as last spelled, without quantity"""
+        key = normalize_item(text)[0]
+        if not key:
+            return
+        entry = self._entry(key)
+        entry.text = WHITESPACE.sub(" ", split_quantity(text.strip())[0])
+        entry.count += count
+        entry.last_used = max(entry.last_used, int(time.time()) if ts is None else ts)
+        self._changed()
+
+    def keep(self, text: str, ts: int) -> None:
+        """An item left the lists: recorded once if the history doesn't know it, so it is still suggested"""
+        if normalize_item(text)[0] not in self._entries:
+            self.record(text, ts)
+
+    def _entry(self, key: str) -> _Entry:
+        entry = self._entries.get(key)
+        if entry is None:
+            node = self._root
+            for char in key:
+                child = node.children.get(char)
+                if child is None:
+                    child = node.children[char] = _Node()
+                node = child
+            entry = node.entry = self._entries[key] = _Entry(key, "")
+        return entry
+
+    def _changed(self) -> None:
+        self._cache.clear()
+        if len(self._entries) > self.max_items:
+            self._trim()
+
+    def to_json(self) -> str:
+        return json.dumps(
+            [[entry.key, entry.text, entry.count, entry.last_used] for entry in self._entries.values()],
+            ensure_ascii=False,
+            separators=(",", ":"),
+        )
+
+    @classmethod
+    def from_json(cls, data: str, max_items: int = 1000) -> "HistoryTrie":
+        history = cls(max_items)
+        for key, text, count, last_used in json.loads(data):
+            entry = history._entry(key)
+            entry.text, entry.count, entry.last_used = text, count, last_used
+        history._changed()
+        return history
+
+    def _trim(self) -> None:
+        # Make room for a tenth more items, so trimming doesn't happen on every addition
+        now = time.time()
+        kept = heapq.nlargest(self.max_items * 9 // 10, self._entries.values(), key=lambda entry: entry.score(now))
+        keep = {entry.key for entry in kept}
+        for key in [key for key in self._entries if key not in keep]:
+            self._remove(key)
+
+    def _remove(self, key: str) -> None:
+        del self._entries[key]
+        path = [self._root]
+        for char in key:
+            path.append(path[-1].children[char])
+        path[-1].entry = None
+        # Drop the nodes that lead to no other item
+        for depth in range(len(key), 0, -1):
+            if path[depth].children or path[depth].entry is not None:
+                break
+            del path[depth - 1].children[key[depth - 1]]
+
+    def suggest(self, prefix: str, limit: int = 10) -> list[str]:
+        """Texts of the best ranked items starting with the prefix, all items for an empty one"""
+        prefix = normalize_prefix(prefix)
+        cache_key = (prefix, limit)
+        cached = self._cache.get(cache_key)
+        if cached is not None:
+            self._cache.move_to_end(cache_key)
+            return cached
+        node = self._root
+        for char in prefix:
+            node = node.children.get(char)
+            if node is None:
+                break
+        entries = []
+        stack = [node] if node is not None else []
+        while stack:
+            node = stack.pop()
+            if node.entry is not None:
+                entries.append(node.entry)
+            stack.extend(node.children.values())
+        now = time.time()
+        suggestions = [entry.text for entry in heapq.nlargest(limit, entries, key=lambda entry: entry.score(now))]
+        self._cache[cache_key] = suggestions
+        while len(self._cache) > self.max_cached_prefixes:
+            self._cache.popitem(last=False)
+        return suggestions
+
+
+class UserHistories:
+    """``HistoryTrie`` of each of the ``max_users`` most recently active users.
+
+    Histories reported with ``changed`` are stored through the storage
+    together ``flush_delay`` seconds after the first change, so items that
+    are no longer on any list are still suggested after a restart or after
+    the user's state was dropped. A history dropped from memory before it
+    was stored is kept until then and used again if the user comes back.
+    """
+
+    def __init__(self, max_users: int, storage: AsyncStorage | None = None, flush_delay: float = 5):
+        self.max_users = max_users
+        self.storage = storage
+        self.flush_delay = flush_delay
+        self._histories: OrderedDict[int, HistoryTrie] = OrderedDict()
+        self._dirty: dict[int, HistoryTrie] = {}
+        self._pending_write: asyncio.Future | None = None
+
+    def __len__(self) -> int:
+        return len(self._histories)
+
+    def get(self, user_id: int) -> HistoryTrie | None:
+        history = self._histories.get(user_id)
+        if history is not None:
+            self._histories.move_to_end(user_id)
+        elif user_id in self._dirty:
+            history = self.setdefault(user_id, self._dirty[user_id])
+        return history
+
+    def changed(self, user_id: int, history: HistoryTrie) -> None:
+        if self.storage is None:
+            return
+        self._dirty[user_id] = history
+        if self._pending_write is None:
+            self._pending_write = asyncio.ensure_future(self._write(self.flush_delay))
+
+    async def _write(self, delay: float) -> None:
+        await asyncio.sleep(delay)
+        self._pending_write = None
+        dirty, self._dirty = self._dirty, {}
+        if not dirty:
+            return
+        try:
+            await self.storage.save_histories({user_id: history.to_json() for user_id, history in dirty.items()})
+        except Exception:
+            logger.exception("Failed to save the item histories of %s users", len(dirty))
+            for user_id, history in dirty.items():
+                self._dirty.setdefault(user_id, history)
+
+    async def flush(self) -> None:
+        """Store changed histories now instead of after ``flush_delay``"""
+        if self._pending_write is not None:
+            self._pending_write.cancel()
+            self._pending_write = None
+        await self._write(0)
+
+    def discard(self, user_id: int) -> None:
+        self._histories.pop(user_id, None)
+
+    def setdefault(self, user_id: int, history: HistoryTrie) -> HistoryTrie:
+        """Keep the history unless another one was stored for the user meanwhile, return the one kept"""
+        history = self._histories.setdefault(user_id, history)
+        self._histories.move_to_end(user_id)
+        while len(self._histories) > self.max_users:
+            self._histories.popitem(last=False)
+        return history
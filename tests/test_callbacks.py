@@ -0,0 +1,98 @@
+import asyncio
+import os
+from types import SimpleNamespace
+
+import pytest
+from telegram import CallbackQuery, Update, User
+from telegram.ext import CallbackQueryHandler, ConversationHandler
+
+from items import Item, item_id, short_id
+from manifest import ListInfo, Manifest
+
+# Different names with the same CRC32
+COLLIDING_NAMES = ("plumless", "buckeroo")
+
+
+@pytest.fixture(scope="module")
+def bot(tmp_path_factory):
+    directory = tmp_path_factory.mktemp("bot")
+    (directory / "TOKEN").write_text("123456:test\n")
+    cwd = os.getcwd()
+    # config reads the token from the working directory
+    os.chdir(directory)
+    try:
+        import bot
+    finally:
+        os.chdir(cwd)
+    return bot
+
+
+def callback_handlers(handlers):
+    for handler in handlers:
+        if isinstance(handler, ConversationHandler):
+            yield from callback_handlers(handler.entry_points)
+            for state_handlers in handler.states.values():
+                yield from callback_handlers(state_handlers)
+            yield from callback_handlers(handler.fallbacks)
+        elif isinstance(handler, CallbackQueryHandler):
+            yield handler
+
+
+def handler_for(application, data: str):
+    update = Update(1, callback_query=CallbackQuery("1", User(1, "user", False), chat_instance="1", data=data))
+    for group in application.handlers.values():
+        for handler in callback_handlers(group):
+            if handler.check_update(update):
+                # Handlers may be wrapped, e.g. to time them
+                return handler.callback.__name__
+    return None
+
+
+def test_colliding_list_ids_are_unique_and_independent_of_order():
+    assert short_id(COLLIDING_NAMES[0]) == short_id(COLLIDING_NAMES[1])
+    manifest = Manifest({name: ListInfo() for name in COLLIDING_NAMES})
+    reloaded = Manifest({name: ListInfo() for name in reversed(COLLIDING_NAMES)})
+    ids = [manifest.id_of(name) for name in COLLIDING_NAMES]
+    assert len(set(ids)) == 2
+    assert ids == [reloaded.id_of(name) for name in COLLIDING_NAMES]
+    assert [manifest.name_of(list_id) for list_id in ids] == list(COLLIDING_NAMES)
+
+    manifest.remove(min(COLLIDING_NAMES))
+    assert manifest.id_of(max(COLLIDING_NAMES)) == short_id(max(COLLIDING_NAMES))
+    assert manifest.name_of(short_id(max(COLLIDING_NAMES))) == max(COLLIDING_NAMES)
+
+
+def test_buttons_of_colliding_lists_reach_their_handlers(bot):
+    application = bot.build_application("123456:test")
+    manifest = Manifest({name: ListInfo() for name in COLLIDING_NAMES})
+    text_id = item_id(Item("молоко").text)
+    for name in COLLIDING_NAMES:
+        list_id = manifest.id_of(name)
+        assert handler_for(application, f"select_{list_id}") == "selectlist_callback"
+        assert handler_for(application, f"remove_{list_id}.{text_id}") == "remove_item_callback"
+
+
+def test_remove_button_of_an_item_crossed_out_since_keeps_it(bot, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    edits = []
+
+    class Query:
+        data = None
+
+        async def answer(self):
+            pass
+
+        async def edit_message_text(self, text, reply_markup=None):
+            edits.append(text)
+
+    async def main():
+        await bot.storage.write(7, "default", [Item("молоко", crossed=True), Item("хлеб")])
+        list_id = (await bot.get_lists_manifest(7)).id_of("default")
+        query = Query()
+        query.data = f"remove_{list_id}.{item_id('молоко')}"
+        update = SimpleNamespace(callback_query=query, effective_user=SimpleNamespace(id=7))
+        await bot.remove_item_callback(update, None)
+        return await bot.storage.read(7, "default")
+
+    assert asyncio.run(main()) == [Item("молоко", crossed=True), Item("хлеб")]
+    assert edits[0].startswith("Список изменился")
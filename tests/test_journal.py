@@ -0,0 +1,40 @@
+import random
+
+from items import Item
+from journal import ListJournal
+
+
+def test_slices_replay_the_journal_over_the_snapshot(tmp_path):
+    rng = random.Random(7)
+    journal = ListJournal(tmp_path / "list.jsonl")
+    # Keep every change in the journal
+    journal.compact_min_bytes = 1 << 30
+    journal.index_stride = 4
+    journal.write([Item(f"item {n}", crossed=rng.random() < 0.3, ts=n) for n in range(50)])
+    for step in range(300):
+        length = len(journal.read())
+        choice = rng.random()
+        if choice < 0.3 or not length:
+            journal.append(["+", f"new {step}", step])
+        elif choice < 0.8:
+            journal.append(["t", rng.randrange(length), step])
+        else:
+            journal.append(["s", rng.randrange(length), f"changed {step}", step])
+        items = journal.read()
+        start = rng.randrange(len(items) + 2)
+        stop = start + rng.randrange(1, 10)
+        assert [item.to_json() for item in journal.read_slice(start, stop)] == [
+            item.to_json() for item in items[start:stop]
+        ]
+        assert [item.to_json() for page in journal.read_pages(7) for item in page] == [
+            item.to_json() for item in items
+        ]
+
+
+def test_compaction_keeps_added_crossed_items(tmp_path):
+    journal = ListJournal(tmp_path / "list.jsonl")
+    journal.write([Item("молоко", ts=1)])
+    journal.append(["+", "хлеб", 2, 1], ["+", "сыр", 3])
+    journal.compact()
+    assert not journal.journal_path.exists()
+    assert journal.read() == [Item("молоко", ts=1), Item("хлеб", crossed=True, ts=2), Item("сыр", ts=3)]
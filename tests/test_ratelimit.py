@@ -0,0 +1,32 @@
+import asyncio
+
+from ratelimit import Priority, PriorityRateLimiter
+
+
+def test_interactive_sends_overtake_queued_background_ones():
+    async def main():
+        # The global bucket lets the first 50 requests through at once, the rest wait for it to refill
+        limiter = PriorityRateLimiter(global_rate=50, chat_rate=1, burst=1)
+        sent = []
+
+        async def send(endpoint, data):
+            sent.append(data["chat_id"])
+            return True
+
+        def request(chat_id, priority):
+            data = {"chat_id": chat_id}
+            return asyncio.ensure_future(
+                limiter.process_request(send, ("sendDocument", data), {}, "sendDocument", data, {"priority": priority})
+            )
+
+        background = [request(chat_id, Priority.BACKGROUND) for chat_id in range(1, 61)]
+        await asyncio.sleep(0)
+        interactive = request(1000, Priority.INTERACTIVE)
+        await asyncio.wait_for(asyncio.gather(*background, interactive), timeout=5)
+        await limiter.shutdown()
+        return sent
+
+    sent = asyncio.run(main())
+    assert len(sent) == 61
+    # Sent as soon as the global bucket had a token, ahead of the background requests still waiting
+    assert sent.index(1000) == 50
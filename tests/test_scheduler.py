@@ -0,0 +1,130 @@
+import asyncio
+import random
+
+import pytest
+
+from scheduler import UserScheduler
+
+
+def test_flood_keeps_order_per_user_and_runs_users_in_parallel():
+    """One user floods the scheduler while many others send a few updates each"""
+
+    async def main():
+        scheduler = UserScheduler(max_concurrency=16, max_pending=256)
+        events: dict[int, list[int]] = {}
+        running_keys: set[int] = set()
+        overlaps = []
+        peak = 0
+
+        async def handle(key: int, number: int) -> None:
+            nonlocal peak
+            if key in running_keys:
+                overlaps.append((key, number))
+            running_keys.add(key)
+            peak = max(peak, len(running_keys))
+            for _ in range(random.randint(0, 3)):
+                await asyncio.sleep(0)
+            events.setdefault(key, []).append(number)
+            running_keys.discard(key)
+
+        submissions = [(0, number) for number in range(500)]
+        submissions += [(key, number) for key in range(1, 100) for number in range(20)]
+        # Interleaved as they would arrive from Telegram, each user's updates still in their order
+        random.Random(1).shuffle(submissions)
+        counters: dict[int, int] = {}
+        for key, _ in submissions:
+            number = counters.get(key, 0)
+            counters[key] = number + 1
+            await scheduler.submit(key, handle(key, number))
+        await scheduler.join()
+        return events, overlaps, peak, scheduler
+
+    events, overlaps, peak, scheduler = asyncio.run(main())
+    assert not overlaps
+    assert events[0] == list(range(500))
+    for key in range(1, 100):
+        assert events[key] == list(range(20))
+    assert 1 < peak <= 16
+    assert scheduler.pending == 0 and scheduler.active_keys == 0
+    assert scheduler.processed == 500 + 99 * 20
+
+
+def test_run_returns_result_after_earlier_work_of_the_key():
+    async def main():
+        scheduler = UserScheduler(max_concurrency=4, max_pending=16)
+        order = []
+
+        async def step(name: str) -> str:
+            await asyncio.sleep(0)
+            order.append(name)
+            return name
+
+        await scheduler.submit(1, step("update"))
+        result = await scheduler.run(1, step("maintenance"))
+        return result, order
+
+    assert asyncio.run(main()) == ("maintenance", ["update", "maintenance"])
+
+
+def test_run_raises_the_error_of_the_coroutine():
+    async def main():
+        scheduler = UserScheduler(max_concurrency=4, max_pending=16)
+
+        async def fail():
+            raise KeyError("gone")
+
+        await scheduler.run(1, fail())
+
+    with pytest.raises(KeyError):
+        asyncio.run(main())
+
+
+def test_run_does_not_hang_when_the_coroutine_is_cancelled():
+    async def main():
+        scheduler = UserScheduler(max_concurrency=4, max_pending=16)
+
+        async def cancelled():
+            raise asyncio.CancelledError()
+
+        await asyncio.wait_for(scheduler.run(1, cancelled()), timeout=1)
+
+    with pytest.raises(asyncio.CancelledError):
+        asyncio.run(main())
+
+
+def test_run_does_not_hang_when_the_worker_is_cancelled_before_it_runs():
+    async def main():
+        scheduler = UserScheduler(max_concurrency=4, max_pending=16)
+        blocker = asyncio.Event()
+        await scheduler.submit(1, blocker.wait())
+        waiting = asyncio.ensure_future(scheduler.run(1, asyncio.sleep(0, "never")))
+        await asyncio.sleep(0)
+        for worker in list(scheduler._workers):
+            worker.cancel()
+        return await asyncio.wait_for(waiting, timeout=1)
+
+    with pytest.raises(asyncio.CancelledError):
+        asyncio.run(main())
+
+
+def test_work_raising_a_base_exception_gives_back_the_room_of_the_leftovers():
+    class Stop(BaseException):
+        pass
+
+    async def main():
+        scheduler = UserScheduler(max_concurrency=4, max_pending=3)
+
+        async def stop():
+            raise Stop()
+
+        await scheduler.submit(1, stop())
+        await scheduler.submit(1, asyncio.sleep(0))
+        await scheduler.submit(1, asyncio.sleep(0))
+        await scheduler.join()
+        assert scheduler.pending == 0 and scheduler.active_keys == 0
+        # All of the room is back, another key gets it without waiting
+        for _ in range(3):
+            await asyncio.wait_for(scheduler.submit(2, asyncio.sleep(0)), timeout=1)
+        await scheduler.join()
+
+    asyncio.run(main())
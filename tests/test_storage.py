@@ -0,0 +1,35 @@
+from items import Item
+from storage import FileStorage
+
+
+def test_manifest_catches_up_with_lists_written_after_it(tmp_path):
+    storage = FileStorage(tmp_path)
+    storage.write(1, "default", [Item("молоко")])
+    storage.write(1, "old", [Item("хлеб")])
+    storage.save_manifest(1, storage.load_manifest(1))
+
+    # Changes whose manifest save was cut short by a crash
+    storage.write(1, "default", [Item("молоко"), Item("хлеб", crossed=True)])
+    storage.append(1, "new", [Item("сыр"), Item("яйца")])
+    storage.delete(1, "old")
+
+    manifest = FileStorage(tmp_path).load_manifest(1)
+    assert manifest.names == ["default", "new"]
+    assert manifest.get("default").done == "1/2"
+    assert manifest.get("new").done == "0/2"
+    # Stored again, so the next load needs no repair
+    assert FileStorage(tmp_path).load_manifest(1).get("new").done == "0/2"
+
+
+def test_compaction_keeps_the_manifest_up_to_date(tmp_path):
+    storage = FileStorage(tmp_path)
+    storage.write(1, "default", [Item("молоко")])
+    storage.toggle(1, "default", 0)
+    manifest = storage.load_manifest(1)
+    assert manifest.get("default").done == "1/1"
+    storage.save_manifest(1, manifest)
+
+    storage.compact(1)
+    list_path = storage.list_path(1, "default")
+    assert not list_path.with_suffix(".log").exists()
+    assert storage.manifest_path(1).stat().st_mtime_ns >= list_path.stat().st_mtime_ns
@@ -0,0 +1,41 @@
+import asyncio
+import time
+
+from storage import AsyncStorage, FileStorage
+from suggest import HistoryTrie, UserHistories
+
+
+def test_histories_are_stored_and_read_back(tmp_path):
+    async def main():
+        storage = AsyncStorage(FileStorage(tmp_path), None, max_workers=2, max_queued=16)
+        histories = UserHistories(10, storage, flush_delay=60)
+        history = histories.setdefault(1, HistoryTrie())
+        now = int(time.time())
+        history.record("Молоко x2", ts=now - 20)
+        history.record("молоко", ts=now)
+        history.record("хлеб", ts=now - 10)
+        histories.changed(1, history)
+        # Dropped before it was stored: kept until then and used again
+        histories.discard(1)
+        assert histories.get(1) is history
+        histories.discard(1)
+        await histories.flush()
+        data = await storage.load_history(1)
+        storage.close()
+        return data
+
+    data = asyncio.run(main())
+    history = HistoryTrie.from_json(data)
+    assert history.suggest("мо") == ["молоко"]
+    assert history.suggest("") == ["молоко", "хлеб"]
+
+
+def test_keep_records_only_unknown_items():
+    now = int(time.time())
+    history = HistoryTrie()
+    history.record("хлеб", ts=now)
+    history.record("молоко", ts=now - 10)
+    # Known already, the count stays 1 and "хлеб" added later still ranks first
+    history.keep("Молоко", now)
+    history.keep("сыр", now - 20)
+    assert history.suggest("") == ["хлеб", "молоко", "сыр"]
@@ -0,0 +1,44 @@
+import asyncio
+import tarfile
+
+from items import Item
+from storage import AsyncStorage, FileStorage
+from transfer import IMPORT_CHUNK, export_lists, import_lists, write_backup
+
+
+def test_export_and_import_lists_page_by_page(tmp_path):
+    async def main():
+        storage = AsyncStorage(FileStorage(tmp_path / "lists"), None, max_workers=2, max_queued=8)
+        long_list = [Item(f"товар {n}", crossed=n % 3 == 0, ts=n) for n in range(IMPORT_CHUNK * 2 + 10)]
+        await storage.write(1, "default", long_list)
+        await storage.write(1, "empty", [])
+        # Left in the journal, the export replays it
+        await storage.toggle(1, "default", 1)
+        exported = await storage.read(1, "default")
+
+        path = tmp_path / "export.zip"
+        assert await export_lists(storage, 1, path, compress=True) == (2, len(exported))
+        assert await import_lists(storage, 2, path, str) == (2, len(exported))
+        assert await storage.list_names(2) == ["default", "empty"]
+        assert await storage.read(2, "empty") == []
+        fresh = FileStorage(tmp_path / "lists")
+        assert fresh.read(2, "default") == exported
+        assert fresh.load_manifest(2).get("default").done == (await storage.manifest(1)).get("default").done
+
+    asyncio.run(main())
+
+
+def test_backup_parts_hold_the_users_of_their_shard(tmp_path):
+    async def run_for(user_id, coroutine):
+        return await coroutine
+
+    async def main():
+        storage = AsyncStorage(FileStorage(tmp_path / "lists"), None, max_workers=2, max_queued=8)
+        for user_id in (1, 2, 3):
+            await storage.write(user_id, "default", [Item("хлеб")])
+        for shard in (0, 1):
+            assert await write_backup(storage, tmp_path / f"part-{shard}.tar.gz", run_for, shard, 2) == 1 + shard
+        with tarfile.open(tmp_path / "part-1.tar.gz") as tar:
+            assert {name.split("/")[0] for name in tar.getnames() if "/" in name} == {"1", "3"}
+
+    asyncio.run(main())
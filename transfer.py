@@ -0,0 +1,188 @@
+import asyncio
+import io
+import json
+import os
+import tarfile
+import zipfile
+import zlib
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Coroutine, Iterator, TextIO
+
+from items import Item
+from snapshot import GENERATION_NAME
+from storage import AsyncStorage, add_to_tar
+from workers import shard_of
+
+EXPORT_HEADER = {"export": "lists", "format": 1}
+# Name of the export inside a ZIP
+EXPORT_NAME = "lists.jsonl"
+# Items read from the storage and written to an export at once
+EXPORT_PAGE = 500
+# Items of an export parsed and written to the storage at once
+IMPORT_CHUNK = 500
+
+
+async def export_lists(storage: AsyncStorage, user_id: int, path: Path, compress: bool = False) -> tuple[int, int]:
+    """Write all lists of the user to an export file, returns the number of lists and items.
+
+    The export is JSON Lines: a header, then for every list a ``{"list":
+    name}`` line followed by one ``[text, crossed, timestamp]`` line per
+    item. Lists are read and written a page at a time, each list as it was
+    when its first page was read; memory use is a page plus the changes not
+    yet compacted into the list's file (see ``ListJournal.read_pages``), not
+    the size of the lists. With ``compress`` the finished file is put into a
+    ZIP.
+    """
+    jsonl_path = path.with_name(path.name + ".jsonl") if compress else path
+    out = await asyncio.to_thread(open, jsonl_path, "wb")
+    lists = items = 0
+    try:
+        await asyncio.to_thread(out.write, f"{json.dumps(EXPORT_HEADER)}\n".encode())
+        for list_name in await storage.list_names(user_id):
+            lists += 1
+            lines = [json.dumps({"list": list_name}, ensure_ascii=False)]
+            async for page in storage.read_pages(user_id, list_name, EXPORT_PAGE):
+                lines.extend(item.to_json() for item in page)
+                await asyncio.to_thread(out.write, "".join(f"{line}\n" for line in lines).encode("utf-8"))
+                lines = []
+                items += len(page)
+            if lines:
+                await asyncio.to_thread(out.write, f"{lines[0]}\n".encode("utf-8"))
+    finally:
+        await asyncio.to_thread(out.close)
+    if compress:
+        await asyncio.to_thread(_zip_file, jsonl_path, path)
+        jsonl_path.unlink()
+    return lists, items
+
+
+def _zip_file(source: Path, path: Path) -> None:
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as archive:
+        archive.write(source, EXPORT_NAME)
+
+
+def read_export(path: Path) -> Iterator[tuple[str, list[Item], bool]]:
+    """Lists of an export file, plain or zipped, as (name, items, first) chunks of up to IMPORT_CHUNK items.
+
+    Every list starts with a chunk with ``first`` set, empty for an empty
+    list. Raises ValueError if the file is not an export or is damaged; the
+    chunks before the damage have been yielded by then.
+    """
+    if zipfile.is_zipfile(path):
+        try:
+            with zipfile.ZipFile(path) as archive:
+                try:
+                    stream = archive.open(EXPORT_NAME)
+                except KeyError:
+                    raise ValueError(f"No {EXPORT_NAME} in the archive") from None
+                with io.TextIOWrapper(stream, encoding="utf-8") as lines:
+                    yield from _read_lists(lines)
+        except (zipfile.BadZipFile, zlib.error, EOFError) as error:
+            raise ValueError(f"Damaged archive: {error}") from error
+    else:
+        with open(path, "r", encoding="utf-8") as lines:
+            yield from _read_lists(lines)
+
+
+def _read_lists(lines: TextIO) -> Iterator[tuple[str, list[Item], bool]]:
+    try:
+        if json.loads(lines.readline()) != EXPORT_HEADER:
+            raise ValueError("Not an export of lists")
+        list_name: str | None = None
+        items: list[Item] = []
+        first = True
+        for line in lines:
+            if not line.strip():
+                continue
+            if line.startswith("{"):
+                if list_name is not None and (items or first):
+                    yield list_name, items, first
+                list_name, items, first = json.loads(line)["list"], [], True
+                if not isinstance(list_name, str):
+                    raise ValueError("List name is not a string")
+                continue
+            if list_name is None:
+                raise ValueError("Item before the first list")
+            item = Item.from_json(line)
+            if not isinstance(item.text, str) or not isinstance(item.ts, int):
+                raise ValueError("Malformed item")
+            if item.text.strip():
+                items.append(item)
+                if len(items) == IMPORT_CHUNK:
+                    yield list_name, items, first
+                    items, first = [], False
+        if list_name is not None and (items or first):
+            yield list_name, items, first
+    except (KeyError, TypeError) as error:
+        raise ValueError(f"Malformed export: {error}") from error
+
+
+async def import_lists(
+    storage: AsyncStorage, user_id: int, path: Path, list_name_of: Callable[[str], str]
+) -> tuple[int, int]:
+    """Write the lists of an export file over the user's lists of the same name, returns the number of lists and items.
+
+    Names are passed through ``list_name_of`` first. A list is written in
+    chunks: the first replaces the list, the others are appended to it, so a
+    chunk of items is held in memory rather than a whole list. A list the file
+    breaks off in is left with the chunks before the damage.
+    """
+    lists = items = 0
+    entries = read_export(path)
+    try:
+        while True:
+            # Parsed off the event loop, a long list takes a while
+            entry = await asyncio.to_thread(next, entries, None)
+            if entry is None:
+                break
+            list_name, chunk, first = entry
+            if first:
+                await storage.write(user_id, list_name_of(list_name), chunk)
+                lists += 1
+            else:
+                await storage.append(user_id, list_name_of(list_name), chunk)
+            items += len(chunk)
+    finally:
+        entries.close()
+    return lists, items
+
+
+async def write_backup(
+    storage: AsyncStorage,
+    path: Path,
+    run_for: Callable[[int, Coroutine[Any, Any, Any]], Awaitable[Any]],
+    shard: int = 0,
+    shards: int = 1,
+) -> int:
+    """Write a gzipped tarball of all stored data to path, returns the number of users copied one by one.
+
+    Backends that can't copy everything at a single point in time (see
+    ``Storage.backup``) are copied user by user, each through
+    ``run_for(user_id, coroutine)``, which is expected to run it between the
+    updates of that user. Only the users of the given shard are copied that
+    way: ``run_for`` orders the copy only against the updates handled by this
+    process, so with worker processes every worker writes the archive of its
+    own users. The archive is written under a temporary name and renamed when
+    complete.
+    """
+    tmp_path = path.with_name(path.name + ".tmp")
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # The default level 9 is more than twice as slow, and backups are written while the bot is busy
+    tar = await asyncio.to_thread(tarfile.open, tmp_path, "w:gz", compresslevel=6)
+    users = 0
+    try:
+        # An empty marker: once restored, the snapshots of the data it replaces are not trusted
+        await asyncio.to_thread(add_to_tar, tar, GENERATION_NAME, b"")
+        if not await storage.backup(tar):
+            for user_id in sorted(await storage.user_ids()):
+                if shard_of(user_id, shards) != shard:
+                    continue
+                await run_for(user_id, storage.backup_user(tar, user_id))
+                users += 1
+        await asyncio.to_thread(tar.close)
+    except BaseException:
+        tar.close()
+        tmp_path.unlink(missing_ok=True)
+        raise
+    os.replace(tmp_path, path)
+    return users
@@ -0,0 +1,139 @@
+import asyncio
+import hmac
+import json
+import logging
+import secrets
+
+from telegram import Update
+from telegram.ext import Application
+
+logger = logging.getLogger("bot.webhook")
+
+SECRET_TOKEN_HEADER = b"x-telegram-bot-api-secret-token"
+MAX_BODY_SIZE = 1024 * 1024
+
+
+class WebhookApp:
+    """ASGI app accepting Telegram webhook requests and feeding the Application's update queue.
+
+    Requests without the expected secret token are rejected. The update queue
+    should be bounded: when it is full, a request waits up to ``put_timeout``
+    seconds for room and is then answered with 503, so Telegram backs off and
+    redelivers the update later instead of us buffering without limit.
+    """
+
+    def __init__(self, application: Application, secret_token: str, path: str, put_timeout: float = 5.0):
+        self.application = application
+        self.secret_token = secret_token.encode()
+        self.path = path
+        self.put_timeout = put_timeout
+        self.accepted = 0
+        self.rejected = 0
+        self.overloaded = 0
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] == "lifespan":
+            # The Application lifecycle is managed by serve_webhook, not by the server
+            while (await receive())["type"] != "lifespan.shutdown":
+                await send({"type": "lifespan.startup.complete"})
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+        if scope["type"] != "http":
+            return
+
+        if scope["path"] != self.path:
+            await self._respond(send, 404)
+            return
+        if scope["method"] != "POST":
+            await self._respond(send, 405)
+            return
+        secret_token = dict(scope["headers"]).get(SECRET_TOKEN_HEADER, b"")
+        if not hmac.compare_digest(secret_token, self.secret_token):
+            self.rejected += 1
+            await self._respond(send, 403)
+            return
+
+        body = await self._read_body(receive)
+        if body is None:
+            await self._respond(send, 413)
+            return
+        try:
+            update = Update.de_json(json.loads(body), self.application.bot)
+        except (ValueError, TypeError, KeyError):
+            logger.warning("Received malformed webhook update")
+            await self._respond(send, 400)
+            return
+
+        try:
+            await asyncio.wait_for(self.application.update_queue.put(update), self.put_timeout)
+        except asyncio.TimeoutError:
+            self.overloaded += 1
+            await self._respond(send, 503)
+            return
+        self.accepted += 1
+        await self._respond(send, 200)
+
+    @staticmethod
+    async def _read_body(receive) -> bytes | None:
+        chunks = []
+        size = 0
+        while True:
+            message = await receive()
+            chunk = message.get("body", b"")
+            size += len(chunk)
+            if size > MAX_BODY_SIZE:
+                return None
+            chunks.append(chunk)
+            if not message.get("more_body", False):
+                return b"".join(chunks)
+
+    @staticmethod
+    async def _respond(send, status: int) -> None:
+        await send({"type": "http.response.start", "status": status, "headers": [(b"content-length", b"0")]})
+        await send({"type": "http.response.body", "body": b""})
+
+    def stats(self) -> dict:
+        return {
+            "accepted": self.accepted,
+            "rejected": self.rejected,
+            "overloaded": self.overloaded,
+            "queue_size": self.application.update_queue.qsize(),
+        }
+
+
+async def serve_webhook(
+    application: Application,
+    url: str,
+    listen: str,
+    port: int,
+    path: str,
+    secret_token: str | None = None,
+    max_connections: int = 40,
+) -> None:
+    """Run the Application with updates delivered to an embedded ASGI server until it is stopped"""
+    import uvicorn
+
+    secret_token = secret_token or secrets.token_urlsafe(32)
+    webhook_app = WebhookApp(application, secret_token, path)
+    server = uvicorn.Server(uvicorn.Config(webhook_app, host=listen, port=port, log_level="warning"))
+
+    async with application:
+        if application.post_init:
+            await application.post_init(application)
+        await application.bot.set_webhook(
+            url=url.rstrip("/") + path,
+            secret_token=secret_token,
+            allowed_updates=Update.ALL_TYPES,
+            max_connections=max_connections,
+        )
+        await application.start()
+        logger.info("Webhook server listening on %s:%s%s", listen, port, path)
+        try:
+            await server.serve()
+        finally:
+            logger.info("Webhook stats: %s", webhook_app.stats())
+            await application.stop()
+            if application.post_stop:
+                await application.post_stop(application)
+    if application.post_shutdown:
+        await application.post_shutdown(application)
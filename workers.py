@@ -0,0 +1,167 @@
+import asyncio
+import json
+import logging
+import multiprocessing
+import queue
+from typing import Awaitable, Callable
+
+from telegram import Update
+from telegram.ext import Application
+
+from scheduler import update_key
+
+logger = logging.getLogger("bot.workers")
+
+# Updates a worker moves from its pipe to the Application at once
+BATCH_SIZE = 100
+
+
+def shard_of(key, shards: int) -> int:
+    """Worker responsible for a user (or chat) id; updates without either go to the first one"""
+    return key % shards if isinstance(key, int) else 0
+
+
+class WorkerPool:
+    """Worker processes, each handling the updates of the users of one shard.
+
+    ``target(index, count, updates)`` runs in every process and handles the
+    updates put on its ``updates`` queue until it gets ``None``. Processes
+    are started with "spawn", so the target must be importable and nothing
+    of the ingress' event loop or connections leaks into a worker. A worker
+    that died is restarted with a new queue: the dead process may still hold
+    the old queue's lock, so updates that were waiting for it are lost.
+    """
+
+    def __init__(self, target: Callable, count: int, max_queued: int):
+        self.target = target
+        self.count = count
+        self.max_queued = max_queued
+        self._context = multiprocessing.get_context("spawn")
+        self.queues = [self._context.Queue(max_queued) for _ in range(count)]
+        self.processes: list[multiprocessing.Process] = [None] * count
+        self.restarts = 0
+
+    def _spawn(self, index: int) -> None:
+        process = self._context.Process(
+            target=self.target, args=(index, self.count, self.queues[index]), name=f"worker-{index}"
+        )
+        process.start()
+        self.processes[index] = process
+
+    def start(self) -> None:
+        for index in range(self.count):
+            self._spawn(index)
+        logger.info("Started %s worker processes", self.count)
+
+    def ensure_alive(self, index: int) -> None:
+        process = self.processes[index]
+        if not process.is_alive():
+            logger.error("Worker %s exited with code %s, restarting it", index, process.exitcode)
+            self.restarts += 1
+            self.queues[index].cancel_join_thread()
+            self.queues[index] = self._context.Queue(self.max_queued)
+            self._spawn(index)
+
+    async def submit(self, index: int, data: str) -> None:
+        """Queue a serialized update for a worker, waiting for room if its queue is full"""
+        try:
+            self.queues[index].put_nowait(data)
+        except queue.Full:
+            await asyncio.to_thread(self.queues[index].put, data)
+
+    def stop(self, timeout: float = 30) -> None:
+        """Let every worker finish the updates queued for it, then wait for the processes to exit"""
+        for updates in self.queues:
+            updates.put(None)
+        for index, process in enumerate(self.processes):
+            process.join(timeout)
+            if process.is_alive():
+                logger.warning("Worker %s did not stop within %ss, terminating it", index, timeout)
+                process.terminate()
+                process.join()
+        logger.info("Worker pool stopped (%s restarts)", self.restarts)
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.count,
+            "alive": sum(1 for process in self.processes if process is not None and process.is_alive()),
+            "restarts": self.restarts,
+        }
+
+
+class ShardRouter(Application):
+    """Application of the ingress process: passes updates on to the worker of their user.
+
+    Updates are routed one after another in the order they arrive, so the
+    updates of a user reach their worker in order; handlers run only in the
+    workers. Updates for which ``broadcast(update)`` is true go to every
+    worker instead, for commands that each worker carries out on its own users.
+    """
+
+    def __init__(self, pool: WorkerPool, broadcast: Callable[[Update], bool] | None = None, **kwargs):
+        super().__init__(**kwargs)
+        self.pool = pool
+        self.broadcast = broadcast
+        self.routed = [0] * pool.count
+
+    async def process_update(self, update: object) -> None:
+        if not isinstance(update, Update):
+            return
+        if self.broadcast is not None and self.broadcast(update):
+            indexes = range(self.pool.count)
+        else:
+            indexes = [shard_of(update_key(update), self.pool.count)]
+        data = update.to_json()
+        for index in indexes:
+            self.pool.ensure_alive(index)
+            await self.pool.submit(index, data)
+            self.routed[index] += 1
+
+
+def _next_batch(updates: multiprocessing.Queue, parent_alive: Callable[[], bool]) -> list:
+    """Block for the next serialized update, then take whatever else is already waiting"""
+    while True:
+        try:
+            batch = [updates.get(timeout=1)]
+            break
+        except queue.Empty:
+            if not parent_alive():
+                return [None]
+    while batch[-1] is not None and len(batch) < BATCH_SIZE:
+        try:
+            batch.append(updates.get_nowait())
+        except queue.Empty:
+            break
+    return batch
+
+
+async def serve_worker(
+    application: Application,
+    updates: multiprocessing.Queue,
+    post_init: Callable[[Application], Awaitable[None]] | None = None,
+) -> None:
+    """Run the Application on updates from the ingress until it sends None or goes away.
+
+    Updates already taken from the queue are handled before the Application
+    stops, so a worker stopped by ``WorkerPool.stop`` loses none.
+    """
+    parent = multiprocessing.parent_process()
+    loop = asyncio.get_running_loop()
+    async with application:
+        if post_init is not None:
+            await post_init(application)
+        await application.start()
+        try:
+            stopping = False
+            while not stopping:
+                for data in await loop.run_in_executor(None, _next_batch, updates, parent.is_alive):
+                    if data is None:
+                        stopping = True
+                        break
+                    await application.update_queue.put(Update.de_json(json.loads(data), application.bot))
+        finally:
+            await application.stop()
+            if application.post_stop:
+                await application.post_stop(application)
+    if application.post_shutdown:
+        await application.post_shutdown(application)